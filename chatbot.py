@@ -23,6 +23,7 @@ logging.basicConfig(level=logging.INFO)
 mcp_base_url = os.environ.get('MCP_BASE_URL')
 mcp_command_list = ["uvx", "npx", "node", "python","docker","uv"]
 COOKIE_NAME = "mcp_chat_user_id"
+TOOL_RESULT_DISPLAY_BYTES = 64 * 1024  # 文本工具结果最多显示的字节数
 local_storage = LocalStorage()
 # 用户会话管理
 def initialize_user_session():
@@ -106,6 +107,21 @@ def request_add_mcp_server(server_id, server_name, command, args=[], env=None, c
         logging.error('request add mcp servers error: %s' % e)
     return status, msg
 
+def request_blob(blob_id, max_bytes=None):
+    """按引用获取工具结果内容，max_bytes只取开头部分；失败返回None"""
+    url = mcp_base_url.rstrip('/') + f'/v1/blobs/{blob_id}'
+    headers = get_auth_headers()
+    if max_bytes:
+        headers['Range'] = f'bytes=0-{max_bytes - 1}'
+    try:
+        response = requests.get(url, headers=headers)
+        if response.status_code in (200, 206):
+            return response.content
+        logging.error(f'request blob {blob_id} error: {response.status_code}')
+    except Exception as e:
+        logging.error('request blob error: %s' % e)
+    return None
+
 def process_stream_response(response):
     """Process streaming response and yield content chunks"""
     for line in response.iter_lines():
@@ -395,7 +411,9 @@ if prompt := st.chat_input():
                         temperature=st.session_state.temperature, extra_params={
                             "only_n_most_recent_images": st.session_state.only_n_most_recent_images,
                             "budget_tokens": st.session_state.budget_tokens,
-                            "enable_thinking": st.session_state.enable_thinking
+                            "enable_thinking": st.session_state.enable_thinking,
+                            # 大的工具结果只在流中发送引用，显示时再获取
+                            "tool_result_refs": True
                         }
                     )
         # Get streaming response
@@ -453,6 +471,20 @@ if prompt := st.chat_input():
                                                     images_data.append(BytesIO(base64.b64decode(block['image']['source']['base64'])))
                                                     # 替换base64字符串为提示信息
                                                     display_tool_block['content'][j]['image']['source']['base64'] = "[BASE64 IMAGE DATA - NOT DISPLAYED]"
+                                                elif 'blob_ref' in block:
+                                                    ref = block['blob_ref']
+                                                    if ref['mime'].startswith('image/'):
+                                                        image_bytes = request_blob(ref['id'])
+                                                        if image_bytes is not None:
+                                                            images_data.append(BytesIO(image_bytes))
+                                                        display_tool_block['content'][j] = {"image": f"[{ref['mime']} {ref['size']} bytes - NOT DISPLAYED]"}
+                                                    else:
+                                                        # 文本只获取需要显示的开头部分
+                                                        text_bytes = request_blob(ref['id'], max_bytes=TOOL_RESULT_DISPLAY_BYTES)
+                                                        text = text_bytes.decode('utf-8', errors='ignore') if text_bytes is not None else ref.get('preview') or ''
+                                                        if ref['size'] > len(text_bytes or b''):
+                                                            text += f"\n[... {ref['size']} bytes in total]"
+                                                        display_tool_block['content'][j] = {"text": text}
                                         
                                         # 显示处理后的JSON
                                         st.code(json.dumps(display_tool_block, ensure_ascii=False, indent=2), language="json")
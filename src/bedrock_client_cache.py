@@ -0,0 +1,125 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Process-wide boto3 client cache
+
+Building a boto3 client resolves credentials, loads the service model and endpoint
+rules and opens a new connection pool, so doing it per request costs milliseconds
+plus a fresh TLS handshake. Clients are thread-safe, so one client per
+(credentials, region, service) is shared by all sessions and stream threads, with a
+connection pool sized for BEDROCK_STREAM_WORKERS and TCP keep-alive enabled.
+"""
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+import boto3
+from botocore.config import Config
+from bedrock_stream import BEDROCK_STREAM_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# 每个客户端的连接池大小，默认与Bedrock流线程数一致，避免线程等待连接
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", BEDROCK_STREAM_WORKERS))
+# 启动时每个客户端预先建立的TLS连接数，0为不预热
+BEDROCK_PREWARM_CONNECTIONS = int(os.environ.get("BEDROCK_PREWARM_CONNECTIONS", 0))
+
+_clients: Dict[Tuple[str, str, str, str], object] = {}
+_clients_lock = threading.Lock()
+_prewarm_stop = threading.Event()
+
+
+def _client_config() -> Config:
+    return Config(
+        retries={
+            "max_attempts": 3,
+            "mode": "standard",
+        },
+        read_timeout=300,
+        max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+    )
+
+
+def get_bedrock_client(ak: str = '', sk: str = '', region: str = '', runtime: bool = True):
+    """Shared client for these credentials; empty ak/sk uses the default credential chain"""
+    service = 'bedrock-runtime' if runtime else 'bedrock'
+    key = (ak or '', sk or '', region or '', service)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    # boto3默认session不是线程安全的，创建客户端需要加锁
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            kwargs = {"aws_access_key_id": ak, "aws_secret_access_key": sk} if ak and sk else {}
+            client = boto3.client(service_name=service, region_name=region or None,
+                                  config=_client_config(), **kwargs)
+            _clients[key] = client
+            logger.info(f"创建 {service} 客户端 (region {client.meta.region_name}), 共 {len(_clients)} 个")
+    return client
+
+
+def _connection_pool(client):
+    """urllib3 pool the client sends its requests through (same lookup as URLLib3Session.send)"""
+    endpoint = client._endpoint
+    session = endpoint.http_session
+    proxy_url = session._proxy_config.proxy_url_for(endpoint.host)
+    return session._get_connection_manager(endpoint.host, proxy_url).connection_from_url(endpoint.host)
+
+
+def _open_connection(conn) -> bool:
+    # 只建立TCP/TLS连接，不发送任何API请求
+    if _prewarm_stop.is_set():
+        return False
+    try:
+        conn.connect()
+        return True
+    except Exception as e:
+        logger.debug(f"预热连接失败: {e}")
+        conn.close()
+        return False
+
+
+def prewarm_connections(connections: int = BEDROCK_PREWARM_CONNECTIONS):
+    """Open `connections` TLS connections per cached bedrock-runtime client (blocking).
+
+    The connections are opened directly in the client's connection pool, so no request
+    reaches Bedrock; cancel_prewarm() stops before the next connection.
+    """
+    _prewarm_stop.clear()
+    if connections <= 0:
+        return
+    runtime_clients = [c for key, c in list(_clients.items()) if key[3] == 'bedrock-runtime']
+    if not runtime_clients:
+        return
+    connections = min(connections, BEDROCK_MAX_POOL_CONNECTIONS)
+    opened = 0
+    with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="bedrock-prewarm") as executor:
+        for client in runtime_clients:
+            if _prewarm_stop.is_set():
+                break
+            try:
+                pool = _connection_pool(client)
+            except AttributeError as e:
+                logger.warning(f"botocore内部接口不兼容，跳过连接预热: {e}")
+                return
+            conns = [pool._get_conn() for _ in range(connections)]
+            try:
+                opened += sum(executor.map(_open_connection, conns))
+            finally:
+                for conn in conns:
+                    pool._put_conn(conn)
+    logger.info(f"已为 {len(runtime_clients)} 个Bedrock客户端预热 {opened} 个连接")
+
+
+def cancel_prewarm():
+    """Stop a running prewarm_connections() before it opens further connections"""
+    _prewarm_stop.set()
+
+
+def cache_size() -> int:
+    return len(_clients)
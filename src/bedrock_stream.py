@@ -0,0 +1,105 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Async streaming engine for Bedrock
+
+boto3 is synchronous: converse/converse_stream block on the HTTP call and iterating
+response['stream'] blocks on every chunk. Both are moved to a bounded thread pool so
+one slow token stream never stalls the event loop serving other users.
+"""
+import os
+import asyncio
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict
+
+logger = logging.getLogger(__name__)
+
+# 同时进行中的Bedrock流数量上限（每个流占用一个线程）
+BEDROCK_STREAM_WORKERS = int(os.environ.get("BEDROCK_STREAM_WORKERS", 64))
+
+_executor = None
+_executor_lock = threading.Lock()
+_STREAM_END = object()
+
+
+class _StreamError:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def get_stream_executor() -> ThreadPoolExecutor:
+    """Process-wide bounded executor for blocking Bedrock I/O"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=BEDROCK_STREAM_WORKERS,
+                                               thread_name_prefix="bedrock-stream")
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking boto3 call on the stream executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_stream_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def converse_stream_async(bedrock_client, **request_params) -> Dict:
+    """Non-blocking bedrock_client.converse_stream"""
+    return await run_blocking(bedrock_client.converse_stream, **request_params)
+
+
+async def iter_event_stream(stream) -> AsyncIterator[Dict]:
+    """Decode a botocore EventStream on a worker thread and yield its events on the loop.
+
+    Tokens arrive at network speed, so the queue is unbounded; the worker stops as soon as
+    the consumer goes away (client disconnect or cancellation).
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+
+    def _put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # event loop already closed
+            stopped.set()
+
+    def _pump():
+        try:
+            for event in stream:
+                if stopped.is_set():
+                    break
+                _put(event)
+        except BaseException as e:
+            if not stopped.is_set():
+                _put(_StreamError(e))
+        finally:
+            _put(_STREAM_END)
+
+    pump_future = loop.run_in_executor(get_stream_executor(), _pump)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        if not pump_future.done():
+            stopped.set()
+            close = getattr(stream, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.debug(f"close event stream error: {e}")
@@ -4,26 +4,33 @@ SPDX-License-Identifier: MIT-0
 """
 import os
 import sys
+import uuid
 import asyncio
 import logging
-from typing import Dict
-import boto3
-from botocore.config import Config
+from typing import Dict, Optional, Tuple
 from dotenv import load_dotenv
-from mcp_client import MCPClient
-from utils import maybe_filter_to_n_most_recent_images
-import pandas as pd
+from mcp_client import MCPClient, ToolNameRegistry
+from utils import ImageTracker
+from image_blob import image_blob_store
+from bedrock_stream import run_blocking
+from credential_pool import credential_pool
+from bedrock_client_cache import get_bedrock_client
+from prompt_cache import PromptCache, PROMPT_CACHE_ENABLED
+from tool_executor import tool_executor
+from usage_metrics import UsageTotals
+from tracing import log_sampled
+from context_window import ContextWindow, render_transcript, CONTEXT_TOKEN_BUDGET, CONTEXT_SUMMARIZE
 load_dotenv()  # load environment variables from .env
 
 logger = logging.getLogger(__name__)
 
 CLAUDE_37_SONNET_MODEL_ID = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
+SUMMARY_PROMPT = ("Summarize the following earlier part of an agent conversation. Keep the user's goals, "
+                  "decisions made, facts and values found by tools, and open tasks. Be concise.")
 
 class ChatClient:
     """Bedrock simple chat wrapper"""
 
-    bedrock_client_pool = []
-    
     def __init__(self, credential_file='', access_key_id='', secret_access_key='', region=''):
         self.env = {
             'AWS_ACCESS_KEY_ID': access_key_id or os.environ.get('AWS_ACCESS_KEY_ID'),
@@ -31,59 +38,65 @@ class ChatClient:
             'AWS_REGION': region or os.environ.get('AWS_REGION'),
         }
         if credential_file:
-            credentials = pd.read_csv(credential_file)
-            for index, row in credentials.iterrows():
-                self.bedrock_client_pool.append(self._get_bedrock_client(ak=row['ak'],sk=row['sk']))
-            logger.info(f"Loaded {len(self.bedrock_client_pool)} bedrock clients from {credential_file}")
+            # 进程级凭证池，按access key去重，重复创建ChatClient不会重复加载
+            credential_pool.load_csv(credential_file, lambda ak, sk: self._get_bedrock_client(ak=ak, sk=sk))
 
     def _get_bedrock_client(self, ak='', sk='', region='', runtime=True):
+        # 进程级共享客户端，复用连接池，不再每次请求新建
         if ak and sk:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                aws_access_key_id=ak,
-                aws_secret_access_key=sk,
-                region_name=region or os.environ.get('AWS_REGION'),
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=300,
-                )
-            )
+            return get_bedrock_client(ak, sk, region or os.environ.get('AWS_REGION'), runtime)
         if self.env['AWS_ACCESS_KEY_ID'] and self.env['AWS_SECRET_ACCESS_KEY']:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'],
-                region_name=self.env['AWS_REGION'],
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=300,
-                )
-            )
-        else:
-            bedrock_client = boto3.client(
-                service_name='bedrock-runtime' if runtime else 'bedrock',
-                config=Config(
-                    retries={
-                        "max_attempts": 3,
-                        "mode": "standard",
-                    },
-                    read_timeout=300,
-                ))
-
-        return bedrock_client
+            return get_bedrock_client(self.env['AWS_ACCESS_KEY_ID'], self.env['AWS_SECRET_ACCESS_KEY'],
+                                      self.env['AWS_REGION'], runtime)
+        return get_bedrock_client(runtime=runtime)
     
+    async def get_tool_config(self, mcp_clients, mcp_server_ids) -> Tuple[Dict, ToolNameRegistry]:
+        """Merge the cached tool configs of the requested mcp servers.
+
+        Servers whose catalog is not cached yet are fetched concurrently. Returns the
+        bedrock tool config and the tool name registry for this request.
+        """
+        tool_config = {"tools": []}
+        if mcp_clients is None or not mcp_server_ids:
+            return tool_config, ToolNameRegistry()
+        responses = await asyncio.gather(*[
+            mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
+            for mcp_server_id in mcp_server_ids
+        ])
+        responses = [x for x in responses if x]
+        for tool_config_response in responses:
+            tool_config['tools'].extend(tool_config_response["tools"])
+        return tool_config, ToolNameRegistry.merge([x["tool_names"] for x in responses])
+
+    async def summarize_messages(self, model_id: str, messages: list, usage: Optional[UsageTotals] = None) -> str:
+        """Summarize earlier messages for the context window (one converse call)"""
+        response = await run_blocking(
+            self._get_bedrock_client().converse,
+            modelId=model_id,
+            system=[{"text": SUMMARY_PROMPT}],
+            messages=[{"role": "user", "content": [{"text": render_transcript(messages)}]}],
+            inferenceConfig={"maxTokens": 1024, "temperature": 0},
+        )
+        if usage is not None:
+            usage.add(response.get('usage'), response.get('metrics'))
+        return "".join(block.get("text", "") for block in response['output']['message']['content'])
+
+    def _context_window(self, model_id: str, extra_params: dict, usage: Optional[UsageTotals]) -> ContextWindow:
+        """Token budget of the history; extra_params context_token_budget/context_summarize override the env"""
+        summarize = None
+        if extra_params.get('context_summarize', CONTEXT_SUMMARIZE):
+            summarize = lambda dropped: self.summarize_messages(model_id, dropped, usage)
+        return ContextWindow(budget=int(extra_params.get('context_token_budget', CONTEXT_TOKEN_BUDGET)),
+                             summarize=summarize)
+
     async def process_query(self, query: str = "", 
             model_id="amazon.nova-lite-v1:0", max_tokens=1024, temperature=0.1,max_turns=30,
-            history=[], system=[], mcp_clients=None, mcp_server_ids=[],extra_params={}) -> Dict:
+            history=[], system=[], mcp_clients=None, mcp_server_ids=[],extra_params={},
+            usage: Optional[UsageTotals] = None) -> Dict:
         """Submit user query or history messages, and then get the response answer.
 
         Note the specified mcp servers' tool maybe used.
+        Token usage and latency of every call are added to `usage` if given.
         """
         if query:
             history.append({
@@ -93,18 +106,19 @@ class ChatClient:
         messages = history
 
         # get tools from mcp server
-        tool_config = {"tools": []}
-        if mcp_clients is not None:        
-            for mcp_server_id in mcp_server_ids:
-                tool_config_response = await mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                tool_config['tools'].extend(tool_config_response["tools"])
+        tool_config, tool_names = await self.get_tool_config(mcp_clients, mcp_server_ids)
 
-        logger.info(f"tool_config: {tool_config}")
+        log_sampled(logger, "tool_config: %s", tool_config)
         bedrock_client = self._get_bedrock_client()
         
         enable_thinking = extra_params.get('enable_thinking', False) and model_id in CLAUDE_37_SONNET_MODEL_ID
         only_n_most_recent_images = extra_params.get('only_n_most_recent_images', 3)
         image_truncation_threshold = only_n_most_recent_images or 0
+        # 增量记录工具结果中的图片，不再每轮重新扫描整个历史
+        image_tracker = ImageTracker(only_n_most_recent_images, image_truncation_threshold)
+        if only_n_most_recent_images:
+            for message in messages:
+                image_tracker.add(message)
         
         if enable_thinking:
             additionalModelRequestFields = {"reasoning_config": { "type": "enabled","budget_tokens": extra_params.get("budget_tokens",1024)}}
@@ -122,14 +136,24 @@ class ChatClient:
                     additionalModelRequestFields = additionalModelRequestFields
         )
         requestParams = {**requestParams, 'toolConfig': tool_config} if  tool_config['tools'] else requestParams
+        prompt_cache = PromptCache(model_id, extra_params.get('prompt_cache', PROMPT_CACHE_ENABLED))
+        # 工具结果缓存中conversation范围的条目只在本次调用内复用
+        conversation_id = uuid.uuid4().hex
+        # 历史超出token预算时压缩较早的消息
+        context_window = self._context_window(model_id, extra_params, usage)
         
         # logger.info(f"requestParams: {requestParams}")
 
         # invoke bedrock llm with user query
-        response = bedrock_client.converse(
-                    **requestParams
+        if await context_window.fit(messages):
+            prompt_cache.reset_checkpoint()
+        response = await run_blocking(
+                    bedrock_client.converse, **prompt_cache.apply(requestParams)
         )
-        logger.info(f"response: {response}")
+        prompt_cache.record_usage(response.get('usage', {}))
+        if usage is not None:
+            usage.add(response.get('usage'), response.get('metrics'))
+        log_sampled(logger, "response: %s", response)
 
         # the response may or not request tool use
         output_message = response['output']['message']
@@ -157,20 +181,22 @@ class ChatClient:
                         tool_calls.append(tool)
                 # 并行执行所有工具调用
                 async def execute_tool_call(tool):
-                    logger.info("Call tool: %s" % tool)
+                    log_sampled(logger, "Call tool: %s", tool)
                     try:
                         tool_name, tool_args = tool['name'], tool['input']
                         if tool_args == "":
                             tool_args = {}
                         #parse the tool_name
-                        server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
+                        server_id, llm_tool_name = tool_names.get_tool_name4mcp(tool_name)
                         mcp_client = mcp_clients.get(server_id)
                         if mcp_client is None:
                             raise Exception(f"mcp_client is None, server_id:{server_id}")
                                     
-                        result = await mcp_client.call_tool(llm_tool_name, tool_args)
+                        result = await mcp_client.call_tool(llm_tool_name, tool_args, conversation_id=conversation_id)
                         result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
-                        image_content =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":base64.b64decode(x.data)} } } for x in result.content if x.type == 'image']
+                        # 每张图片只解码保存一份，相同的截图共用
+                        image_content = [image_blob_store.put_base64(x.data, x.mimeType.replace('image/','')).bedrock_block()
+                                         for x in result.content if x.type == 'image']
                         return  [{ 
                                                 "toolUseId": tool['toolUseId'],
                                                 "content": result_content+image_content
@@ -186,14 +212,23 @@ class ChatClient:
                                                 "content": [{"text": err_msg}],
                                                 "status": 'error'
                                   }]*2
-                # 使用 asyncio.gather 并行执行所有工具调用
-                call_results = await asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls])
+                # 并行执行所有工具调用，受服务器并发上限和超时限制
+                call_results = await tool_executor.run(
+                    tool_calls, execute_tool_call,
+                    on_error=lambda tool, err_msg: [{
+                        "toolUseId": tool['toolUseId'],
+                        "content": [{"text": err_msg}],
+                        "status": 'error'
+                    }]*2,
+                    resolve=lambda tool: tool_names.get_tool_name4mcp(tool['name']),
+                    mcp_clients=mcp_clients,
+                    turn_timeout=extra_params.get('tool_turn_timeout'))
                 tool_results = []
                 tool_text_results = []
                 for result in call_results:
                     tool_results.append(result[0])
                     tool_text_results.append(result[1])
-                logger.info(f'tool_text_results {tool_text_results}')
+                log_sampled(logger, 'tool_text_results %s', tool_text_results)
                 # 处理所有工具调用的结果
                 tool_results_content = []
                 for tool_result in tool_results:
@@ -207,24 +242,29 @@ class ChatClient:
                 messages.append(tool_result_message)
                 
                 if only_n_most_recent_images:
-                    maybe_filter_to_n_most_recent_images(
-                        messages,
-                        only_n_most_recent_images,
-                        min_removal_threshold=image_truncation_threshold,
-                )
+                    image_tracker.add(tool_result_message)
+                    context_window.invalidate(image_tracker.evict())
                 # return tool use results
                 yield tool_result_message
 
                 # send the tool results to the model.
-                response = bedrock_client.converse(
-                   **requestParams
+                if await context_window.fit(messages):
+                    prompt_cache.reset_checkpoint()
+                response = await run_blocking(
+                   bedrock_client.converse, **prompt_cache.apply(requestParams)
                 )
+                prompt_cache.record_usage(response.get('usage', {}))
+                if usage is not None:
+                    usage.add(response.get('usage'), response.get('metrics'))
                 stop_reason = response['stopReason']
                 output_message = response['output']['message']
                 messages.append(output_message)
                 # return user query's answer
                 yield output_message
                 turn_i += 1
+
+        if prompt_cache.enabled:
+            logger.info(f"Prompt cache usage: {prompt_cache.usage()}")
     
     async def chat_loop_cli(self, model_id="amazon.nova-lite-v1:0", mcp_client=None):
         """Run an interactive chat loop"""
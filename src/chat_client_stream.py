@@ -4,20 +4,26 @@ SPDX-License-Identifier: MIT-0
 """
 import os
 import sys
+import uuid
 import asyncio
 import logging
+import time
 from typing import Dict, AsyncGenerator, Optional, List, AsyncIterator
 import json
 import boto3
 from botocore.config import Config
 from dotenv import load_dotenv
 from chat_client import ChatClient
-import base64
-from mcp_client import MCPClient
-from utils import maybe_filter_to_n_most_recent_images
+from utils import ImageTracker
+from image_blob import image_blob_store
+from bedrock_stream import converse_stream_async, iter_event_stream
+from throttle import throttle_scheduler, RetryBudgetExhausted
+from credential_pool import credential_pool
+from prompt_cache import PromptCache, PROMPT_CACHE_ENABLED
+from tool_executor import tool_executor
+from usage_metrics import UsageTotals
+from tracing import tracer, log_sampled
 from botocore.exceptions import ClientError
-import random
-import time
 load_dotenv()  # load environment variables from .env
 logger = logging.getLogger(__name__)
 CLAUDE_37_SONNET_MODEL_ID = 'us.anthropic.claude-3-7-sonnet-20250219-v1:0'
@@ -28,25 +34,18 @@ class ChatClientStream(ChatClient):
     
     def __init__(self,credential_file=''):
         super().__init__(credential_file)
-        self.max_retries = 10 # Maximum number of retry attempts
-        self.base_delay = 10 # Initial backoff delay in seconds
-        self.max_delay = 60 # Maximum backoff delay in seconds
-        self.client_index = 0 
+        self.max_retries = 10 # Maximum number of backoff waits per request
+
+    def _acquire_bedrock_client(self):
+        """(client, credential): credential is None when no credential pool is configured"""
+        credential = credential_pool.acquire()
+        if credential is None:
+            return self._get_bedrock_client(), None
+        return credential.client, credential
 
-    def get_bedrock_client_from_pool(self):
-        if self.bedrock_client_pool:
-            logger.info(f"get_bedrock_client_from_pool index: [{self.client_index}]")
-            if self.client_index and self.client_index %(len(self.bedrock_client_pool)-1) == 0:
-                self.client_index = 0
-            bedrock_client = self.bedrock_client_pool[self.client_index]
-            self.client_index += 1
-        else:
-            bedrock_client = self._get_bedrock_client()
-        return bedrock_client
-        
     async def _process_stream_response(self, response) -> AsyncIterator[Dict]:
         """Process the raw response from converse_stream"""
-        for event in response['stream']:
+        async for event in iter_event_stream(response['stream']):
             # logger.infos(event)
             # Handle message start
             if "messageStart" in event:
@@ -80,18 +79,14 @@ class ChatClientStream(ChatClient):
                 yield {"type": "metadata", "data": event["metadata"]}
                 continue
             
-    def exponential_backoff(self, attempt):
-        """Calculate exponential backoff delay with jitter"""
-        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
-        jitter = random.uniform(0, 0.1 * delay)  # 10% jitter
-        return delay + jitter
-    
     async def process_query_stream(self, query: str = "",
             model_id="amazon.nova-lite-v1:0", max_tokens=1024, max_turns=30,temperature=0.1,
-            history=[], system=[],mcp_clients=None, mcp_server_ids=[],extra_params={}) -> AsyncGenerator[Dict, None]:
+            history=[], system=[],mcp_clients=None, mcp_server_ids=[],extra_params={},
+            usage: Optional[UsageTotals] = None) -> AsyncGenerator[Dict, None]:
         """Submit user query or history messages, and get streaming response.
         
         Similar to process_query but uses converse_stream API for streaming responses.
+        Token usage and latency of every turn are added to `usage` if given.
         """
         if query:
             history.append({
@@ -101,20 +96,9 @@ class ChatClientStream(ChatClient):
         messages = history
 
         # get tools from mcp server
-        tool_config = {"tools": []}
-        if mcp_clients is not None:
-            for mcp_server_id in mcp_server_ids:
-                tool_config_response = await mcp_clients[mcp_server_id].get_tool_config(server_id=mcp_server_id)
-                tool_config['tools'].extend(tool_config_response["tools"])
-        logger.info(f"Tool config: {tool_config}")
+        tool_config, tool_names = await self.get_tool_config(mcp_clients, mcp_server_ids)
+        log_sampled(logger, "Tool config: %s", tool_config)
         
-        use_client_pool = True if self.bedrock_client_pool else False
-
-        bedrock_client = self.get_bedrock_client_from_pool()
-        
-        # Track the current tool use state
-        current_tool_use = None
-        current_tooluse_input = ''
         tool_results = []
         stop_reason = ''
         turn_i = 1
@@ -122,6 +106,11 @@ class ChatClientStream(ChatClient):
         enable_thinking = extra_params.get('enable_thinking', False) and model_id in CLAUDE_37_SONNET_MODEL_ID
         only_n_most_recent_images = extra_params.get('only_n_most_recent_images', 3)
         image_truncation_threshold = only_n_most_recent_images or 0
+        # 增量记录工具结果中的图片，不再每轮重新扫描整个历史
+        image_tracker = ImageTracker(only_n_most_recent_images, image_truncation_threshold)
+        if only_n_most_recent_images:
+            for message in messages:
+                image_tracker.add(message)
 
         if enable_thinking:
             additionalModelRequestFields = {"reasoning_config": { "type": "enabled","budget_tokens": extra_params.get("budget_tokens",1024)}}
@@ -139,77 +128,170 @@ class ChatClientStream(ChatClient):
                     additionalModelRequestFields = additionalModelRequestFields
         )
         requestParams = {**requestParams, 'toolConfig': tool_config} if tool_config['tools'] else requestParams
+        # system、tools和历史前缀的cachePoint（仅支持的模型）
+        prompt_cache = PromptCache(model_id, extra_params.get('prompt_cache', PROMPT_CACHE_ENABLED))
+        # 工具结果缓存中conversation范围的条目只在本次调用内复用
+        conversation_id = uuid.uuid4().hex
+        # 历史超出token预算时压缩较早的消息，每轮节省的token随metadata返回
+        context_window = self._context_window(model_id, extra_params, usage)
+
+        async def execute_tool_call(tool):
+            log_sampled(logger, "Call tool: %s", tool)
+            try:
+                tool_name, tool_args = tool['name'], tool['input']
+                if tool_args == "":
+                    tool_args = {}
+                #parse the tool_name
+                server_id, llm_tool_name = tool_names.get_tool_name4mcp(tool_name)
+                mcp_client = mcp_clients.get(server_id)
+                if mcp_client is None:
+                    raise Exception(f"mcp_client is None, server_id:{server_id}")
+
+                result = await mcp_client.call_tool(llm_tool_name, tool_args, conversation_id=conversation_id)
+                # logger.info(f"call_tool result:{result}")
+                result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
+                # 每张图片只解码保存一份，相同的截图共用
+                blobs = [image_blob_store.put_base64(x.data, x.mimeType.replace('image/','')) for x in result.content if x.type == 'image']
+                image_content = [blob.bedrock_block() for blob in blobs]
+
+                #content block for json serializable, base64 is only produced when the SSE frame is written
+                image_content_base64 = [blob.serializable_block() for blob in blobs]
 
+                return [{ 
+                            "toolUseId": tool['toolUseId'],
+                            "content": result_content+image_content
+                        },
+                        { 
+                            "toolUseId": tool['toolUseId'],
+                            "content": result_content
+                        },
+                        { 
+                            "toolUseId": tool['toolUseId'],
+                            "content": result_content+image_content_base64
+                        },
+                        ]
+
+            except Exception as err:
+                err_msg = f"{tool['name']} tool call is failed. error:{err}"
+                return [{
+                            "toolUseId": tool['toolUseId'],
+                            "content": [{"text": err_msg}],
+                            "status": 'error'
+                        }]*3
+
+        def tool_error(tool, err_msg):
+            return [{
+                        "toolUseId": tool['toolUseId'],
+                        "content": [{"text": err_msg}],
+                        "status": 'error'
+                    }]*3
+
+        tool_batch = None
         while turn_i <= max_turns and stop_reason != 'end_turn':
             text = ''
             thinking_text = ''
             thinking_signature = ''
+            # 本轮的span是工具调用span的父span
+            turn_span = tracer.start_span("agent.turn", activate=True, turn=turn_i, model=model_id)
+            call_span = None
             # invoke bedrock llm with user query
             try:
                 attempt = 0
                 pool_attempt = 0
-                while attempt <= self.max_retries:
+                # 每次调用都按凭证余量重新选择
+                bedrock_client, credential = self._acquire_bedrock_client()
+                context_saved = await context_window.fit(messages)
+                if context_saved:
+                    # 历史前缀已改写，之前的缓存点不再有效
+                    prompt_cache.reset_checkpoint()
+                turn_span.set(context_tokens=context_window.tokens, context_saved=context_saved)
+                callParams = prompt_cache.apply(requestParams)
+                call_span = tracer.start_span("bedrock.converse_stream", model=model_id, messages=len(messages))
+                while True:
+                    call_start = time.monotonic()
                     try:
-                        response = bedrock_client.converse_stream(
-                            **requestParams
+                        response = await converse_stream_async(
+                            bedrock_client, **callParams
                         )
+                        throttle_scheduler.record_success()
+                        if credential:
+                            credential_pool.record_success(credential, time.monotonic() - call_start)
+                        call_span.set(attempts=attempt + pool_attempt + 1,
+                                      response_ms=round(call_span.duration_ms, 1))
                         break
                     except ClientError as error:
                         logger.info(str(error))
-                        if error.response['Error']['Code'] == 'ThrottlingException':
-                            if use_client_pool:
-                                bedrock_client = self.get_bedrock_client_from_pool()
-            
-                                if pool_attempt > len(self.bedrock_client_pool): # 如果都轮巡了一遍
-                                    delay = self.exponential_backoff(attempt)
-                                    msg = f"Throttling exception encountered. Retrying in {delay:.2f} seconds (attempt {attempt+1}/{self.max_retries})\n"
-                                    logger.warning(msg)
-                                    time.sleep(delay)
-                                    attempt += 1
-                                    attempt = min(attempt,2) ##最多退2步
-                                    pool_attempt = 0 #重置一下
-                                pool_attempt+=1
-                                continue
-                            else:
-                                bedrock_client = self._get_bedrock_client()
-                                if attempt < self.max_retries:
-                                    delay = self.exponential_backoff(attempt)
-                                    msg = f"Throttling exception encountered. Retrying in {delay:.2f} seconds (attempt {attempt+1}/{self.max_retries})\n"
-                                    logger.warning(msg)
-                                    # yield {"type": "error", "data": {"error":msg}}
-
-                                    time.sleep(delay)
-                                    attempt += 1
-                                else:
-                                    logger.error(f"Maximum retry attempts ({self.max_retries}) reached. Throttling persists.")
-                                    raise Exception("Maximum retry attempts reached. Service is still throttling requests.")
-                        else:
+                        if error.response['Error']['Code'] != 'ThrottlingException':
+                            if credential:
+                                credential_pool.record_error(credential)
                             raise error
+                        throttle_scheduler.record_throttle()
+                        if credential:
+                            credential_pool.record_throttle(credential)
+                        if credential and pool_attempt < len(credential_pool) and credential_pool.has_alternative(credential):
+                            # 先换到余量最多的其他凭证，换凭证同样消耗全局重试额度
+                            if not throttle_scheduler.acquire_retry():
+                                raise RetryBudgetExhausted("Retry budget exhausted. Service is still throttling requests.")
+                            bedrock_client, credential = self._acquire_bedrock_client()
+                            pool_attempt += 1
+                            continue
+                        if attempt >= self.max_retries:
+                            logger.error(f"Maximum retry attempts ({self.max_retries}) reached. Throttling persists.")
+                            raise Exception("Maximum retry attempts reached. Service is still throttling requests.")
+                        # 异步等待，不阻塞其他会话
+                        await throttle_scheduler.wait(attempt)
+                        attempt += 1
+                        pool_attempt = 0
+                        bedrock_client, credential = self._acquire_bedrock_client()
 
                 turn_i += 1
-                # 收集所有需要调用的工具请求
+                # 收集所有需要调用的工具请求，每个toolUse块结束时立即启动
                 tool_calls = []
+                tool_inputs = {}  # contentBlockIndex -> (tool, input fragments)
+                tool_batch = tool_executor.batch(
+                    execute_tool_call, tool_error,
+                    resolve=lambda tool: tool_names.get_tool_name4mcp(tool['name']),
+                    mcp_clients=mcp_clients,
+                    turn_timeout=extra_params.get('tool_turn_timeout'))
                 async for event in self._process_stream_response(response):
-                    logger.info(event)
+                    log_sampled(logger, "%s", event)
                     # continue
-                    yield event
+                    if event["type"] == "metadata":
+                        # 先累计用量再产出事件，消费方收到metadata时usage已是最新
+                        prompt_cache.record_usage(event["data"].get("usage", {}))
+                        event["data"]["conversation_cache_usage"] = prompt_cache.usage()
+                        event["data"]["context_window"] = context_window.usage(context_saved)
+                        if usage is not None:
+                            usage.add(event["data"].get("usage"), event["data"].get("metrics"))
+                        call_usage = event["data"].get("usage", {})
+                        call_span.end(input_tokens=call_usage.get("inputTokens", 0),
+                                      output_tokens=call_usage.get("outputTokens", 0),
+                                      cache_read_tokens=call_usage.get("cacheReadInputTokens", 0),
+                                      latency_ms=event["data"].get("metrics", {}).get("latencyMs"))
+                    try:
+                        yield event
+                    except BaseException:
+                        # 客户端断开时取消已启动的工具调用
+                        tool_batch.cancel()
+                        call_span.end(error="cancelled")
+                        turn_span.end(error="cancelled")
+                        raise
                     # Handle tool use in content block start
                     if event["type"] == "block_start":
                         block_start = event["data"]
                         if "toolUse" in block_start.get("start", {}):
-                            current_tool_use = block_start["start"]["toolUse"]
-                            tool_calls.append(current_tool_use)
-                            logger.info("Tool use detected: %s", current_tool_use)
+                            tool_use = block_start["start"]["toolUse"]
+                            tool_calls.append(tool_use)
+                            tool_inputs[block_start.get("contentBlockIndex")] = (tool_use, [])
+                            logger.info("Tool use detected: %s", tool_use)
 
                     if event["type"] == "block_delta":
                         delta = event["data"]
                         if "toolUse" in delta.get("delta", {}):
                             #Claude 是stream输出input，而Nova是一次性输出
-                            #取出最近添加的tool,追加input参数
-                            current_tool_use = tool_calls[-1]
-                            if current_tool_use:
-                                current_tooluse_input += delta["delta"]["toolUse"]["input"]
-                                current_tool_use["input"] = current_tooluse_input 
+                            #先缓存input片段，块结束时一次性解析
+                            if delta.get("contentBlockIndex") in tool_inputs:
+                                tool_inputs[delta.get("contentBlockIndex")][1].append(delta["delta"]["toolUse"]["input"])
                         if "text" in delta.get("delta", {}):
                             text += delta["delta"]["text"]
                         if "reasoningContent" in delta.get("delta", {}):
@@ -221,12 +303,13 @@ class ChatClientStream(ChatClient):
 
                     # Handle tool use input in content block stop
                     if event["type"] == "block_stop":
-                        if current_tooluse_input:
-                            #取出最近添加的tool,把input str转成json
-                            current_tool_use = tool_calls[-1]
-                            if current_tool_use:
-                                current_tool_use["input"] = json.loads(current_tooluse_input)
-                                current_tooluse_input = ''
+                        block = tool_inputs.pop(event["data"].get("contentBlockIndex"), None)
+                        if block is not None:
+                            #把input片段拼接后转成json，并立即启动该工具调用
+                            tool_use, fragments = block
+                            tool_use["input"] = json.loads("".join(fragments) or "{}")
+                            if mcp_clients is not None:
+                                tool_batch.dispatch(tool_use)
 
 
                     # Handle message stop and tool use
@@ -235,50 +318,8 @@ class ChatClientStream(ChatClient):
                         
                         # Handle tool use if needed
                         if stop_reason == "tool_use" and tool_calls:
-                            # 并行执行所有工具调用
-                            async def execute_tool_call(tool):
-                                logger.info("Call tool: %s" % tool)
-                                try:
-                                    tool_name, tool_args = tool['name'], tool['input']
-                                    if tool_args == "":
-                                        tool_args = {}
-                                    #parse the tool_name
-                                    server_id, llm_tool_name = MCPClient.get_tool_name4mcp(tool_name)
-                                    mcp_client = mcp_clients.get(server_id)
-                                    if mcp_client is None:
-                                        raise Exception(f"mcp_client is None, server_id:{server_id}")
-                                    
-                                    result = await mcp_client.call_tool(llm_tool_name, tool_args)
-                                    # logger.info(f"call_tool result:{result}")
-                                    result_content = [{"text": "\n".join([x.text for x in result.content if x.type == 'text'])}]
-                                    image_content =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"bytes":base64.b64decode(x.data)} } } for x in result.content if x.type == 'image']
-                                    
-                                    #content block for json serializable.
-                                    image_content_base64 =  [{"image":{"format":x.mimeType.replace('image/',''), "source":{"base64":x.data} } } for x in result.content if x.type == 'image']
-
-                                    return [{ 
-                                                "toolUseId": tool['toolUseId'],
-                                                "content": result_content+image_content
-                                            },
-                                            { 
-                                                "toolUseId": tool['toolUseId'],
-                                                "content": result_content
-                                            },
-                                            { 
-                                                "toolUseId": tool['toolUseId'],
-                                                "content": result_content+image_content_base64
-                                            },
-                                            ]
-                                    
-                                except Exception as err:
-                                    err_msg = f"{tool['name']} tool call is failed. error:{err}"
-                                    return [{
-                                                "toolUseId": tool['toolUseId'],
-                                                "content": [{"text": err_msg}],
-                                                "status": 'error'
-                                            }]*3
-                            # 使用 asyncio.gather 并行执行所有工具调用
-                            call_results = await asyncio.gather(*[execute_tool_call(tool) for tool in tool_calls])
+                            # 等待已在contentBlockStop时启动的工具调用，受服务器并发上限和超时限制
+                            call_results = await tool_batch.join(tool_calls)
                             # Correctly unpack the results - each call_result is a list of [tool_result, tool_text_result]
                             tool_results = []
                             tool_results_serializable = []
@@ -287,7 +328,7 @@ class ChatClientStream(ChatClient):
                                 tool_results.append(result[0])
                                 tool_text_results.append(result[1])
                                 tool_results_serializable.append(result[2])
-                            logger.info(f'tool_text_results {tool_text_results}')
+                            log_sampled(logger, 'tool_text_results %s', tool_text_results)
                             # 处理所有工具调用的结果
                             tool_results_content = []
                             for tool_result in tool_results:
@@ -300,7 +341,6 @@ class ChatClientStream(ChatClient):
                             }
                             # output tool results
                             event["data"]["tool_results"] = [item for pair in zip(tool_calls, tool_results_serializable) for item in pair]
-                            logger.info('yield event*****')
                             yield event
                             #append assistant message   
                             thinking_block = [{
@@ -336,27 +376,32 @@ class ChatClientStream(ChatClient):
                             messages.append(tool_result_message)
                             
                             if only_n_most_recent_images:
-                                maybe_filter_to_n_most_recent_images(
-                                    messages,
-                                    only_n_most_recent_images,
-                                    min_removal_threshold=image_truncation_threshold,
-                            )
+                                image_tracker.add(tool_result_message)
+                                context_window.invalidate(image_tracker.evict())
 
                             logger.info(f"Call new turn : message length:{len(messages)}")
                             
-                            # Reset tool state
-                            current_tool_use = None
-                            
                             continue
 
                         # normal chat finished
                         elif stop_reason in ['end_turn','max_tokens','stop_sequence']:
                             # yield event
+                            tool_batch.cancel()
                             turn_i = max_turns
                             continue
+                call_span.end()
+                turn_span.end(stop_reason=stop_reason)
 
             except Exception as e:
                 logger.error(f"Stream processing error: {e}")
+                if call_span is not None:
+                    call_span.end(error=str(e))
+                turn_span.end(error=str(e))
+                if tool_batch is not None:
+                    tool_batch.cancel()
                 yield {"type": "error", "data": {"error": str(e)}}
                 turn_i = max_turns
                 break
+
+        if prompt_cache.enabled:
+            logger.info(f"Prompt cache usage: {prompt_cache.usage()}")
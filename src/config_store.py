@@ -0,0 +1,190 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Persistence store for user MCP server configs
+
+Writes are per user, debounced and run on a single background thread, so adding a
+server never rewrites every user's configs on the event loop.
+- SQLiteConfigStore: one row per user, WAL mode (default)
+- JSONConfigStore: the legacy whole-file JSON format
+"""
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigStore(ABC):
+    """Base store: user_id -> {server_id: config}
+
+    put_user/delete_user only record the change; a flush task writes all pending
+    users after `debounce` seconds, or when flush() is awaited.
+    """
+
+    def __init__(self, debounce: float = 1.0):
+        self.debounce = debounce
+        self._pending: Dict[str, Optional[str]] = {}  # user_id -> json, None means delete
+        self._flush_task: Optional[asyncio.Task] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="config-store")
+
+    @abstractmethod
+    def load_all(self) -> Dict[str, dict]:
+        """All persisted users' configs"""
+
+    @abstractmethod
+    def _write_batch(self, pending: Dict[str, Optional[str]]):
+        """Write pending changes (user_id -> json, None means delete); runs on the store's thread"""
+
+    def put_user(self, user_id: str, configs: dict):
+        # 在事件循环中序列化快照，避免后台线程读取正在修改的dict
+        self._pending[user_id] = json.dumps(configs, ensure_ascii=False)
+        self._schedule_flush()
+
+    def delete_user(self, user_id: str):
+        self._pending[user_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+        except RuntimeError:
+            # no running loop, write synchronously
+            self._flush_sync()
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.debounce)
+        await self.flush()
+
+    async def flush(self):
+        """Write all pending changes"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._write_batch, pending)
+            logger.info(f"已保存 {len(pending)} 个用户的MCP服务器配置")
+        except Exception as e:
+            logger.error(f"保存用户MCP配置失败: {e}")
+            # 保留未写入的修改，下次重试
+            self._pending = {**pending, **self._pending}
+
+    def _flush_sync(self):
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._executor.submit(self._write_batch, pending).result()
+
+    def close(self):
+        self._flush_sync()
+        self._executor.shutdown(wait=True)
+
+
+class SQLiteConfigStore(ConfigStore):
+    """One row per user in SQLite (WAL mode)"""
+
+    def __init__(self, path: str, debounce: float = 1.0):
+        super().__init__(debounce)
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_mcp_configs (user_id TEXT PRIMARY KEY, configs TEXT NOT NULL)")
+        return self._conn
+
+    def load_all(self) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._connect().execute("SELECT user_id, configs FROM user_mcp_configs").fetchall()
+        return {user_id: json.loads(configs) for user_id, configs in rows}
+
+    def _write_batch(self, pending: Dict[str, Optional[str]]):
+        upserts = [(user_id, configs) for user_id, configs in pending.items() if configs is not None]
+        deletes = [(user_id,) for user_id, configs in pending.items() if configs is None]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                if upserts:
+                    conn.executemany(
+                        "INSERT INTO user_mcp_configs (user_id, configs) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET configs=excluded.configs", upserts)
+                if deletes:
+                    conn.executemany("DELETE FROM user_mcp_configs WHERE user_id=?", deletes)
+
+    def import_json(self, json_file: str) -> int:
+        """Import a legacy user_mcp_configs.json, return number of users imported"""
+        with open(json_file, 'r') as f:
+            configs = json.load(f)
+        self._write_batch({user_id: json.dumps(c, ensure_ascii=False) for user_id, c in configs.items()})
+        return len(configs)
+
+    def close(self):
+        super().close()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JSONConfigStore(ConfigStore):
+    """Legacy format: all users in one JSON file, rewritten on each flush"""
+
+    def __init__(self, path: str, debounce: float = 1.0):
+        super().__init__(debounce)
+        self.path = path
+        self._configs: Dict[str, dict] = {}  # 仅后台线程访问
+
+    def load_all(self) -> Dict[str, dict]:
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self._configs = json.load(f)
+        return {user_id: dict(c) for user_id, c in self._configs.items()}
+
+    def _write_batch(self, pending: Dict[str, Optional[str]]):
+        for user_id, configs in pending.items():
+            if configs is None:
+                self._configs.pop(user_id, None)
+            else:
+                self._configs[user_id] = json.loads(configs)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._configs, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def create_config_store() -> ConfigStore:
+    """Build the store selected by USER_MCP_CONFIG_STORE (sqlite|json).
+
+    On first start with sqlite, an existing USER_MCP_CONFIG_FILE is imported.
+    """
+    backend = os.environ.get('USER_MCP_CONFIG_STORE', 'sqlite')
+    json_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
+    debounce = float(os.environ.get('USER_MCP_CONFIG_DEBOUNCE', 1.0))
+    if backend == 'json':
+        return JSONConfigStore(json_file, debounce=debounce)
+
+    db_file = os.environ.get('USER_MCP_CONFIG_DB', 'conf/user_mcp_configs.db')
+    is_new = not os.path.exists(db_file)
+    store = SQLiteConfigStore(db_file, debounce=debounce)
+    if is_new and os.path.exists(json_file):
+        try:
+            count = store.import_json(json_file)
+            logger.info(f"已从 {json_file} 导入 {count} 个用户的MCP服务器配置")
+        except Exception as e:
+            logger.error(f"导入用户MCP配置失败: {e}")
+    return store
@@ -0,0 +1,211 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Token-budgeted context window for long agent loops
+
+The agent loop appends every assistant message, reasoning block and tool result to
+the history and resends all of it each turn. ContextWindow keeps a per-message token
+estimate (computed for new or replaced messages, and again for messages edited in
+place that are passed to invalidate(), such as ImageTracker.evict()'s) and, when
+the history exceeds the budget, compacts it down to a lower target, oldest messages
+first and never touching the first message or the most recent turns:
+1. drop reasoning blocks of older assistant messages
+2. elide the content of older tool results (toolUseId/status are kept)
+3. remove whole older assistant/user pairs, optionally replacing them with a summary
+   appended to the preceding user message
+Removed ranges always start and end at an assistant message, so roles still alternate
+and every toolResult still follows its toolUse.
+"""
+import os
+import json
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 150000))  # 0表示不限制
+CONTEXT_TARGET_RATIO = float(os.environ.get("CONTEXT_TARGET_RATIO", 0.7))  # 超出预算后压缩到预算的这个比例
+CONTEXT_KEEP_TURNS = int(os.environ.get("CONTEXT_KEEP_TURNS", 3))  # 最近几轮（assistant+user）保持原样
+CONTEXT_SUMMARIZE = os.environ.get("CONTEXT_SUMMARIZE", "0") == "1"
+ELIDED_TOOL_RESULT_CHARS = int(os.environ.get("CONTEXT_ELIDED_TOOL_RESULT_CHARS", 300))  # 省略后保留的开头字符数
+
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+DOCUMENT_TOKENS = 2000
+# 比这个还小的工具结果不值得省略
+ELIDE_MIN_TOKENS = ELIDED_TOOL_RESULT_CHARS // CHARS_PER_TOKEN + 50
+
+
+def _text_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_block_tokens(block: dict) -> int:
+    if "text" in block:
+        return _text_tokens(block["text"])
+    if "toolResult" in block:
+        return 8 + sum(estimate_block_tokens(x) for x in block["toolResult"].get("content", []))
+    if "toolUse" in block:
+        tool_use = block["toolUse"]
+        return 8 + _text_tokens(tool_use.get("name", "")) + _text_tokens(json.dumps(tool_use.get("input", {}), ensure_ascii=False))
+    if "json" in block:
+        return _text_tokens(json.dumps(block["json"], ensure_ascii=False))
+    if "reasoningContent" in block:
+        return _text_tokens(block["reasoningContent"].get("reasoningText", {}).get("text", ""))
+    if "image" in block:
+        return IMAGE_TOKENS
+    if "document" in block:
+        return DOCUMENT_TOKENS
+    return 0
+
+
+def estimate_message_tokens(message: dict) -> int:
+    content = message.get("content")
+    if not isinstance(content, list):
+        return _text_tokens(str(content or ""))
+    return 4 + sum(estimate_block_tokens(block) for block in content if isinstance(block, dict))
+
+
+def render_transcript(messages: List[dict], max_chars: int = 2000) -> str:
+    """Plain-text rendering of messages for the summarizer (images dropped, long parts cut)"""
+    lines = []
+    for message in messages:
+        for block in message.get("content", []):
+            if "text" in block:
+                lines.append(f"{message['role']}: {block['text'][:max_chars]}")
+            elif "toolUse" in block:
+                args = json.dumps(block["toolUse"].get("input", {}), ensure_ascii=False)
+                lines.append(f"{message['role']} called tool {block['toolUse'].get('name')}: {args[:max_chars]}")
+            elif "toolResult" in block:
+                text = "\n".join(x["text"] for x in block["toolResult"].get("content", []) if "text" in x)
+                lines.append(f"tool result: {text[:max_chars]}")
+    return "\n".join(lines)
+
+
+class ContextWindow:
+    """Token estimate and compaction of one conversation's messages (one process_query call)"""
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, keep_turns: int = CONTEXT_KEEP_TURNS,
+                 target_ratio: float = CONTEXT_TARGET_RATIO,
+                 summarize: Optional[Callable[[List[dict]], Awaitable[str]]] = None):
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.target = int(budget * target_ratio)
+        self.summarize = summarize
+        # id(message) -> (message, tokens)；持有message引用保证id不被复用
+        self._estimates: Dict[int, Tuple[dict, int]] = {}
+        self.tokens = 0
+        self.saved_tokens = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def _tokens(self, message: dict) -> int:
+        cached = self._estimates.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        tokens = estimate_message_tokens(message)
+        self._estimates[id(message)] = (message, tokens)
+        return tokens
+
+    def invalidate(self, messages: List[dict]):
+        """Forget the estimates of messages edited in place; they are recomputed by the next count"""
+        for message in messages:
+            self._estimates.pop(id(message), None)
+
+    def count(self, messages: List[dict]) -> int:
+        """Estimated tokens of messages; only new or replaced messages are estimated"""
+        estimates = {}
+        total = 0
+        for message in messages:
+            total += self._tokens(message)
+            estimates[id(message)] = self._estimates[id(message)]
+        self._estimates = estimates
+        self.tokens = total
+        return total
+
+    def _compact_message(self, message: dict) -> dict:
+        """Copy of an older message without reasoning blocks and with elided tool results"""
+        content = []
+        changed = False
+        for block in message["content"]:
+            if "reasoningContent" in block:
+                changed = True
+                continue
+            if "toolResult" in block and estimate_block_tokens(block) > ELIDE_MIN_TOKENS:
+                result = block["toolResult"]
+                text = "\n".join(x["text"] for x in result.get("content", []) if "text" in x)
+                elided = text[:ELIDED_TOOL_RESULT_CHARS]
+                note = f"[tool output elided to fit the context window: {len(text)} chars"
+                images = sum(1 for x in result.get("content", []) if "image" in x)
+                if images:
+                    note += f", {images} images"
+                block = {"toolResult": {**result, "content": [{"text": f"{elided}\n{note}]"}]}}
+                changed = True
+            content.append(block)
+        if not changed:
+            return message
+        if not content:
+            # 只有reasoning块的消息，保留一个占位文本使消息不为空
+            content = [{"text": "..."}]
+        return {**message, "content": content}
+
+    async def fit(self, messages: List[dict]) -> int:
+        """Compact messages in place when they exceed the budget; returns the tokens saved"""
+        if not self.enabled or self.count(messages) <= self.budget:
+            return 0
+        before = self.tokens
+        total = before
+        tail_start = max(1, len(messages) - 2 * self.keep_turns)
+
+        # 1、2：较早的消息去掉reasoning，省略工具结果，从最早的开始
+        for i in range(1, tail_start):
+            if total <= self.target:
+                break
+            if not isinstance(messages[i].get("content"), list):
+                continue
+            compacted = self._compact_message(messages[i])
+            if compacted is not messages[i]:
+                total += self._tokens(compacted) - self._tokens(messages[i])
+                messages[i] = compacted
+
+        # 3：仍然超出时移除较早的整轮，范围的起止都是assistant消息
+        if total > self.target:
+            start = next((i for i in range(1, tail_start) if messages[i]["role"] == "assistant"), None)
+            end = start
+            if start is not None:
+                removed = 0
+                for i in range(start + 1, tail_start + 1):
+                    if i < len(messages) and messages[i]["role"] == "assistant":
+                        removed += sum(self._tokens(m) for m in messages[end:i])
+                        end = i
+                        if total - removed <= self.target:
+                            break
+            if start is not None and end > start:
+                dropped = messages[start:end]
+                note = f"[{len(dropped)} earlier messages were removed to fit the context window]"
+                if self.summarize is not None:
+                    try:
+                        note = f"[Summary of {len(dropped)} earlier messages]\n{await self.summarize(dropped)}"
+                    except Exception as e:
+                        logger.warning(f"上下文摘要失败，直接移除较早的消息: {e}")
+                anchor = messages[start - 1]
+                del messages[start:end]
+                messages[start - 1] = {**anchor, "content": list(anchor["content"]) + [{"text": note}]}
+
+        after = self.count(messages)
+        saved = max(0, before - after)
+        self.saved_tokens += saved
+        logger.info(f"上下文压缩: {before} -> {after} tokens (预算 {self.budget})")
+        return saved
+
+    def usage(self, saved: int = 0) -> dict:
+        return {
+            "estimated_tokens": self.tokens,
+            "budget": self.budget,
+            "saved_tokens": saved,
+            "saved_tokens_total": self.saved_tokens,
+        }
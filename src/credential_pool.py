@@ -0,0 +1,190 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Health- and rate-aware scheduler for the Bedrock credential pool
+
+Each credential (conf/credentials.csv row) gets a token bucket whose refill rate is
+learned from ThrottlingException feedback (additive increase on success,
+multiplicative decrease on throttle). Every converse_stream call is routed to the
+credential with the most headroom; credentials that keep throttling are quarantined
+for a while. The pool is process-wide, so all sessions share what it has learned.
+"""
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class Credential:
+    """One access key with its learned rate and stats"""
+    __slots__ = ("name", "client", "rate", "tokens", "updated", "quarantined_until",
+                 "consecutive_throttles", "requests", "successes", "throttles", "errors", "latency_total", "latency_ewma")
+
+    def __init__(self, name: str, client, rate: float, burst: float):
+        self.name = name
+        self.client = client
+        self.rate = rate  # 学习到的请求速率 (req/s)
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.quarantined_until = 0.0
+        self.consecutive_throttles = 0
+        self.requests = 0
+        self.successes = 0
+        self.throttles = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_ewma = 0.0
+
+
+class CredentialPool:
+    """Token-bucket scheduler over a set of Bedrock clients.
+
+    - acquire(): credential with the most tokens among the healthy ones
+    - record_success(): rate += increase, up to max_rate
+    - record_throttle(): rate *= decrease, bucket drained; after
+      quarantine_after consecutive throttles the credential is skipped for
+      quarantine_seconds (doubling while it keeps throttling)
+    """
+
+    def __init__(self, initial_rate=2.0, min_rate=0.05, max_rate=50.0, burst=5.0,
+                 increase=0.05, decrease=0.5, quarantine_after=3, quarantine_seconds=10.0,
+                 max_quarantine=120.0):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.quarantine_after = quarantine_after
+        self.quarantine_seconds = quarantine_seconds
+        self.max_quarantine = max_quarantine
+        self._credentials: Dict[str, Credential] = {}
+        self._loaded_files: Dict[str, float] = {}  # path -> mtime
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._credentials)
+
+    def add(self, name: str, client_factory: Callable[[], object]) -> bool:
+        """Register a credential once; name is its access key id"""
+        with self._lock:
+            if name in self._credentials:
+                return False
+            self._credentials[name] = Credential(name, client_factory(), self.initial_rate, self.burst)
+            return True
+
+    def load_csv(self, credential_file: str, client_factory: Callable[[str, str], object]) -> int:
+        """Load ak/sk rows from a credentials csv, skipping keys already in the pool.
+
+        The file is only re-read when its mtime changes.
+        """
+        mtime = os.path.getmtime(credential_file)
+        if self._loaded_files.get(credential_file) == mtime:
+            return 0
+        self._loaded_files[credential_file] = mtime
+        credentials = pd.read_csv(credential_file)
+        added = 0
+        for _, row in credentials.iterrows():
+            ak, sk = row['ak'], row['sk']
+            if self.add(ak, lambda: client_factory(ak, sk)):
+                added += 1
+        if added:
+            logger.info(f"Loaded {added} bedrock clients from {credential_file}, pool size {len(self)}")
+        return added
+
+    def _refill(self, cred: Credential, now: float):
+        cred.tokens = min(self.burst, cred.tokens + (now - cred.updated) * cred.rate)
+        cred.updated = now
+
+    def acquire(self) -> Optional[Credential]:
+        """Pick the credential with the most headroom and take one token from it.
+
+        When every credential is quarantined, the one released soonest is used;
+        an empty bucket only lowers priority, it never blocks the request.
+        """
+        with self._lock:
+            if not self._credentials:
+                return None
+            now = time.monotonic()
+            best = None
+            for cred in self._credentials.values():
+                self._refill(cred, now)
+                if cred.quarantined_until > now:
+                    continue
+                # 令牌相同时优先选择近期延迟较低的凭证
+                if best is None or (cred.tokens, -cred.latency_ewma) > (best.tokens, -best.latency_ewma):
+                    best = cred
+            if best is None:
+                best = min(self._credentials.values(), key=lambda c: c.quarantined_until)
+            best.tokens -= 1
+            best.requests += 1
+            return best
+
+    def record_success(self, cred: Credential, latency: float):
+        with self._lock:
+            cred.successes += 1
+            cred.consecutive_throttles = 0
+            cred.rate = min(self.max_rate, cred.rate + self.increase)
+            cred.latency_total += latency
+            cred.latency_ewma = latency if not cred.latency_ewma else 0.8 * cred.latency_ewma + 0.2 * latency
+
+    def record_throttle(self, cred: Credential):
+        with self._lock:
+            now = time.monotonic()
+            cred.throttles += 1
+            cred.consecutive_throttles += 1
+            cred.rate = max(self.min_rate, cred.rate * self.decrease)
+            cred.tokens = min(cred.tokens, 0.0)
+            if cred.consecutive_throttles >= self.quarantine_after:
+                seconds = min(self.max_quarantine, self.quarantine_seconds *
+                              2 ** (cred.consecutive_throttles - self.quarantine_after))
+                cred.quarantined_until = now + seconds
+                logger.warning(f"凭证 {self._mask(cred.name)} 连续限流 {cred.consecutive_throttles} 次，"
+                               f"隔离 {seconds:.0f} 秒 (rate {cred.rate:.2f}/s)")
+
+    def record_error(self, cred: Credential):
+        with self._lock:
+            cred.errors += 1
+
+    def has_alternative(self, cred: Credential) -> bool:
+        """Whether another non-quarantined credential could take a retry right now"""
+        now = time.monotonic()
+        with self._lock:
+            return any(c is not cred and c.quarantined_until <= now for c in self._credentials.values())
+
+    @staticmethod
+    def _mask(name: str) -> str:
+        return f"{name[:4]}...{name[-4:]}" if len(name) > 8 else name
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self._lock:
+            result = []
+            for cred in self._credentials.values():
+                self._refill(cred, now)
+                result.append({
+                    "credential": self._mask(cred.name),
+                    "rate": round(cred.rate, 3),
+                    "tokens": round(cred.tokens, 2),
+                    "quarantined_seconds": round(max(0.0, cred.quarantined_until - now), 1),
+                    "requests": cred.requests,
+                    "successes": cred.successes,
+                    "throttles": cred.throttles,
+                    "errors": cred.errors,
+                    "avg_latency": round(cred.latency_total / cred.successes, 3) if cred.successes else None,
+                    "recent_latency": round(cred.latency_ewma, 3),
+                })
+            return result
+
+
+credential_pool = CredentialPool(
+    initial_rate=float(os.environ.get("CREDENTIAL_INITIAL_RATE", 2.0)),
+    max_rate=float(os.environ.get("CREDENTIAL_MAX_RATE", 50.0)),
+    quarantine_seconds=float(os.environ.get("CREDENTIAL_QUARANTINE_SECONDS", 10.0)),
+)
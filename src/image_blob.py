@@ -0,0 +1,135 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Single-copy, content-addressed images from tool results
+
+A tool result image arrives as base64. ImageBlobStore decodes it once and keeps one
+ImageBlob per distinct image (keyed on a digest of the base64 data, so identical
+screenshots share one copy). The conversation history holds blob.data, which boto3
+accepts as the image bytes; SSE results hold the ImageBlob itself and base64 is only
+produced while the JSON is written (json_default). Blobs of IMAGE_BLOB_SPILL_KB or
+more can be spilled to an unlinked temp file and memory-mapped, so the OS may page
+them out.
+"""
+import os
+import mmap
+import base64
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+IMAGE_BLOB_STORE_MB = float(os.environ.get("IMAGE_BLOB_STORE_MB", 256))  # 去重索引覆盖的图片总大小
+IMAGE_BLOB_SPILL_KB = int(os.environ.get("IMAGE_BLOB_SPILL_KB", 0))  # 不小于该大小的图片写入mmap临时文件，0表示不启用
+IMAGE_BLOB_SPILL_DIR = os.environ.get("IMAGE_BLOB_SPILL_DIR") or None
+
+
+class ImageBlob:
+    """One decoded image; immutable, so copies share it"""
+    __slots__ = ("digest", "format", "data", "size")
+
+    def __init__(self, digest: str, format: str, data: Union[bytes, mmap.mmap]):
+        self.digest = digest
+        self.format = format
+        self.data = data  # bytes，或溢出到磁盘时的只读mmap（boto3都可直接序列化）
+        self.size = len(data)
+
+    @property
+    def spilled(self) -> bool:
+        return isinstance(self.data, mmap.mmap)
+
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("ascii")
+
+    def bedrock_block(self) -> dict:
+        """Image content block for converse(_stream)"""
+        return {"image": {"format": self.format, "source": {"bytes": self.data}}}
+
+    def serializable_block(self) -> dict:
+        """Image content block for SSE results; base64 is written by json_default"""
+        return {"image": {"format": self.format, "source": {"base64": self}}}
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f"ImageBlob({self.digest[:12]}, {self.format}, {self.size} bytes)"
+
+
+def json_default(obj):
+    """json.dumps default= hook that writes ImageBlobs as base64"""
+    if isinstance(obj, ImageBlob):
+        return obj.base64()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _spill(raw: bytes) -> mmap.mmap:
+    with tempfile.TemporaryFile(dir=IMAGE_BLOB_SPILL_DIR) as f:
+        f.write(raw)
+        f.flush()
+        # 文件关闭（且已unlink）后映射仍然有效，内存由页缓存管理
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ImageBlobStore:
+    """Dedup index of recent blobs, LRU-bounded by total bytes.
+
+    Dropping a blob from the index does not free it while a conversation still
+    refers to it; it only stops later identical images from sharing it.
+    """
+
+    def __init__(self, max_bytes: int, spill_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.spill_bytes = spill_bytes
+        self._blobs: "OrderedDict[str, ImageBlob]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spilled = 0
+
+    def put_base64(self, data: str, format: str) -> ImageBlob:
+        # 按base64数据取摘要，命中时不需要解码
+        digest = hashlib.sha256(data.encode("ascii") if isinstance(data, str) else data).hexdigest()
+        key = f"{format}:{digest}"
+        blob = self._blobs.get(key)
+        if blob is not None:
+            self._blobs.move_to_end(key)
+            self.hits += 1
+            return blob
+        self.misses += 1
+        raw = base64.b64decode(data)
+        if self.spill_bytes and len(raw) >= self.spill_bytes:
+            try:
+                raw = _spill(raw)
+                self.spilled += 1
+            except OSError as e:
+                logger.warning(f"图片写入临时文件失败，保留在内存中: {e}")
+        blob = ImageBlob(digest, format, raw)
+        if blob.size <= self.max_bytes:
+            self._blobs[key] = blob
+            self._bytes += blob.size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._blobs.popitem(last=False)
+                self._bytes -= evicted.size
+        return blob
+
+    def stats(self) -> dict:
+        return {
+            "image_blobs": len(self._blobs),
+            "image_blob_bytes": self._bytes,
+            "image_blob_hits": self.hits,
+            "image_blob_misses": self.misses,
+            "image_blob_spilled": self.spilled,
+        }
+
+
+image_blob_store = ImageBlobStore(max_bytes=int(IMAGE_BLOB_STORE_MB * 1024 * 1024),
+                                  spill_bytes=IMAGE_BLOB_SPILL_KB * 1024)
@@ -12,17 +12,15 @@ import time
 import argparse
 import logging
 import asyncio
-from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Literal, AsyncGenerator
 import uuid
-import threading
 from contextlib import asynccontextmanager
 import os
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, HTTPException, Depends, BackgroundTasks, Security
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Security
@@ -30,7 +28,24 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from fastapi.exceptions import RequestValidationError
 from mcp_client import MCPClient
+from mcp_server_pool import mcp_server_pool
+from tool_catalog_store import tool_catalog_store
+from config_store import create_config_store
+from session_manager import SessionManager
+from state_backend import create_state_backend
+from worker_router import WorkerRouter
+from sse_encoder import SSEEncoder, DONE_FRAME
 from chat_client_stream import ChatClientStream
+from credential_pool import credential_pool
+from bedrock_client_cache import prewarm_connections, cancel_prewarm, BEDROCK_PREWARM_CONNECTIONS
+from throttle import throttle_scheduler
+from prompt_cache import prompt_cache_stats
+from response_cache import response_cache, make_cache_key, tool_catalog_version
+from tool_executor import tool_executor
+from usage_metrics import UsageTotals, usage_metrics
+from tracing import tracer, new_id, log_sampled, Span
+from image_blob import image_blob_store, json_default
+from result_blobs import SessionBlobCache, parse_range, TOOL_RESULT_REFS
 from mcp.shared.exceptions import McpError
 
 # 全局模型和服务器配置
@@ -39,8 +54,19 @@ llm_model_list = {}
 shared_mcp_server_list = {}  # 共享的MCP服务器描述信息
 global_mcp_server_configs = {}  # 全局MCP服务器配置 server_id -> config
 user_mcp_server_configs = {}  # 用户特有的MCP服务器配置 user_id -> {server_id: config}
+config_store = None  # 用户MCP服务器配置的持久化存储
+prewarm_future: Optional[asyncio.Future] = None  # Bedrock连接预热任务
+state_backend = None  # 多worker共享的状态（服务器描述、会话元数据）
+WORKER_ID = os.environ.get("WORKER_ID", "0")
 MAX_TURNS = int(os.environ.get("MAX_TURNS",200))
 INACTIVE_TIME = int(os.environ.get("INACTIVE_TIME",60*24))  #mins
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", 0))  # 合并文本delta的时间窗口(ms)，0表示不合并
+SSE_COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", 0))  # 合并文本delta的字符数，0表示不合并
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 10000))  # 会话数上限，0表示不限制
+MAX_MCP_PROCESSES = int(os.environ.get("MAX_MCP_PROCESSES", 0))  # MCP进程数上限，0表示不限制
+MCP_LAZY_START = os.environ.get("MCP_LAZY_START", "1") == "1"  # 首次使用时才启动MCP服务器
+MCP_WARM_POOL_SIZE = int(os.environ.get("MCP_WARM_POOL_SIZE", 0))  # 全局MCP服务器的默认预热进程数
+CREDENTIAL_FILE = os.environ.get("CREDENTIAL_FILE", "conf/credentials.csv")  # Bedrock凭证池 (ak,sk)
 
 
 API_KEY = os.environ.get("API_KEY")
@@ -49,21 +75,41 @@ security = HTTPBearer()
 logger = logging.getLogger(__name__)
 
 
+# 所有会话共享的ChatClientStream：它不保存会话状态，持有进程级的Bedrock客户端和凭证池
+chat_client: Optional[ChatClientStream] = None
+
+def get_chat_client() -> ChatClientStream:
+    global chat_client
+    if chat_client is None:
+        chat_client = ChatClientStream(credential_file=CREDENTIAL_FILE if os.path.exists(CREDENTIAL_FILE) else '')
+    return chat_client
+
 # 用户会话管理
 class UserSession:
+    # 会话只保存自身状态，重量级对象（Bedrock客户端、MCP进程）都是共享的
+    __slots__ = ("user_id", "mcp_clients", "last_active", "session_id", "lock", "result_blobs")
+
     def __init__(self, user_id):
         self.user_id = user_id
-        if os.path.exists("conf/credentials.csv"):
-            self.chat_client = ChatClientStream(credential_file="conf/credentials.csv")
-        else:
-            self.chat_client = ChatClientStream()
         self.mcp_clients = {}  # 用户特定的MCP客户端
-        self.last_active = datetime.now()
+        self.last_active = time.monotonic()
         self.session_id = str(uuid.uuid4())
         self.lock = asyncio.Lock()  # 用于同步会话内的操作
+        self.result_blobs: Optional[SessionBlobCache] = None  # 工具结果引用的内容，首次使用时创建
+
+    @property
+    def chat_client(self) -> ChatClientStream:
+        return get_chat_client()
+
+    def blob_cache(self) -> SessionBlobCache:
+        if self.result_blobs is None:
+            self.result_blobs = SessionBlobCache()
+        return self.result_blobs
 
     async def cleanup(self):
         """清理用户会话资源"""
+        if state_backend is not None:
+            await state_backend.delete("sessions", self.user_id)
         cleanup_tasks = []
         for client_id, client in self.mcp_clients.items():
             cleanup_tasks.append(client.cleanup())
@@ -72,10 +118,24 @@ class UserSession:
             await asyncio.gather(*cleanup_tasks)
             logger.info(f"用户 {self.user_id} 的 {len(cleanup_tasks)} 个MCP客户端已清理")
 
-# 用户会话存储
-user_sessions = {}
-# 会话锁，防止会话创建和访问的竞争条件
-session_lock = threading.RLock()
+async def create_user_session(user_id: str) -> UserSession:
+    """创建用户会话并初始化用户的MCP服务器"""
+    session = UserSession(user_id)
+    logger.info(f"为用户 {user_id} 创建新会话: {session.session_id}")
+    await initialize_user_servers(session)
+    if state_backend is not None:
+        await state_backend.set("sessions", user_id, {
+            "session_id": session.session_id, "worker": WORKER_ID, "created": time.time()})
+    return session
+
+# 用户会话存储，LRU淘汰 + 定时过期
+session_manager = SessionManager(
+    create_session=create_user_session,
+    inactive_seconds=INACTIVE_TIME * 60,
+    max_sessions=MAX_SESSIONS,
+    max_mcp_processes=MAX_MCP_PROCESSES,
+    process_count=lambda: mcp_server_pool.stats()["processes"],
+)
 
 async def get_api_key(auth: HTTPAuthorizationCredentials = Security(security)):
     if auth.credentials == API_KEY:
@@ -92,15 +152,24 @@ def save_global_server_config( server_id: str, config: dict):
     
 # 保存用户MCP服务器配置
 def save_user_server_config(user_id: str, server_id: str, config: dict):
-    """保存用户的MCP服务器配置"""
-    global user_mcp_server_configs
-    with session_lock:
-        if user_id not in user_mcp_server_configs:
-            user_mcp_server_configs[user_id] = {}
-        
-        user_mcp_server_configs[user_id][server_id] = config
-        # 在实际应用中，这里应该将配置持久化到数据库或文件系统
-        logger.info(f"为用户 {user_id} 保存服务器配置 {server_id}")
+    """保存用户的MCP服务器配置（增量写入该用户的配置）"""
+    if user_id not in user_mcp_server_configs:
+        user_mcp_server_configs[user_id] = {}
+    if user_mcp_server_configs[user_id].get(server_id) == config:
+        return
+    user_mcp_server_configs[user_id][server_id] = config
+    if config_store is not None:
+        config_store.put_user(user_id, user_mcp_server_configs[user_id])
+    logger.info(f"为用户 {user_id} 保存服务器配置 {server_id}")
+
+# 删除用户MCP服务器配置
+def delete_user_server_config(user_id: str, server_id: str):
+    """删除用户的MCP服务器配置"""
+    if server_id not in user_mcp_server_configs.get(user_id, {}):
+        return
+    del user_mcp_server_configs[user_id][server_id]
+    if config_store is not None:
+        config_store.put_user(user_id, user_mcp_server_configs[user_id])
 
 # 获取用户MCP服务器配置
 def get_user_server_configs(user_id: str) -> dict:
@@ -114,33 +183,18 @@ def get_global_server_configs() -> dict:
 
 async def load_user_mcp_configs():
     """加载用户MCP服务器配置"""
-    # 从文件或数据库加载
+    global config_store, user_mcp_server_configs
     try:
-        config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
-        if os.path.exists(config_file):
-            with session_lock:
-                with open(config_file, 'r') as f:
-                    configs = json.load(f)
-                    global user_mcp_server_configs
-                    user_mcp_server_configs = configs
-                    logger.info(f"已加载 {len(configs)} 个用户的MCP服务器配置")
+        config_store = create_config_store()
+        user_mcp_server_configs = await asyncio.to_thread(config_store.load_all)
+        logger.info(f"已加载 {len(user_mcp_server_configs)} 个用户的MCP服务器配置")
     except Exception as e:
         logger.error(f"加载用户MCP配置失败: {e}")
 
 async def save_user_mcp_configs():
-    global user_mcp_server_configs
-    # user_mcp_server_configs[user_id] = server_configs
-    """保存用户MCP服务器配置"""
-    # 保存到文件或数据库
-    try:
-        config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
-        #add thread lock
-        with session_lock:
-            with open(config_file, 'w') as f:
-                json.dump(user_mcp_server_configs, f, indent=2)
-                logger.info(f"已保存 {len(user_mcp_server_configs)} 个用户的MCP服务器配置")
-    except Exception as e:
-        logger.error(f"保存用户MCP配置失败: {e}")
+    """保存所有未写入的用户MCP服务器配置"""
+    if config_store is not None:
+        await config_store.flush()
         
 async def initialize_user_servers(session: UserSession):
     """初始化用户特有的MCP服务器"""
@@ -152,31 +206,30 @@ async def initialize_user_servers(session: UserSession):
     #合并全局和用户的servers
     server_configs = {**server_configs,**global_server_configs}
     
-    logger.info(f"server_configs:{server_configs}")
-    # 初始化服务器连接
+    log_sampled(logger, "server_configs:%s", server_configs)
+    span = tracer.start_span("session.init", user_id=user_id, servers=len(server_configs))
+    # 注册服务器，进程在首次使用时才启动（使用持久化的工具目录）
+    eager_server_ids = []
     for server_id, config in server_configs.items():
         if server_id in session.mcp_clients:  # 跳过已存在的服务器
             continue
-            
-        try:
-            # 创建并连接MCP服务器
-            mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
-            await mcp_client.connect_to_server(
-                command=config["command"],
-                server_script_args=config.get("args", []),
-                server_script_envs=config.get("env", {})
-            )
-            
-            # 添加到用户的客户端列表
-            session.mcp_clients[server_id] = mcp_client
-            
-            save_user_server_config(user_id, server_id, config)
-
-            await save_user_mcp_configs()
+        session.mcp_clients[server_id] = mcp_server_pool.lazy(
+            name=f"{session.user_id}_{server_id}",
+            config=config,
+        )
+        if config.get("eager") or not MCP_LAZY_START:
+            eager_server_ids.append(server_id)
+
+    # 需要立即启动的服务器并发连接
+    results = await asyncio.gather(*[session.mcp_clients[server_id].connect()
+                                     for server_id in eager_server_ids], return_exceptions=True)
+    for server_id, result in zip(eager_server_ids, results):
+        if isinstance(result, BaseException):
+            logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {result}")
+            del session.mcp_clients[server_id]
+        else:
             logger.info(f"User Id {session.user_id} initialize server {server_id}")
-            
-        except Exception as e:
-            logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {e}")
+    span.end(eager=len(eager_server_ids), failed=sum(isinstance(r, BaseException) for r in results))
 
 async def get_or_create_user_session(
     request: Request,
@@ -189,48 +242,10 @@ async def get_or_create_user_session(
     # 尝试从请求头获取用户ID，如果不存在则使用API密钥作为备用ID
     user_id = request.headers.get("X-User-ID", auth.credentials)
     
-    with session_lock:
-        is_new_session = user_id not in user_sessions
-        if is_new_session:
-            user_sessions[user_id] = UserSession(user_id)
-            logger.info(f"为用户 {user_id} 创建新会话: {user_sessions[user_id].session_id}")
-        
-        # 更新最后活跃时间
-        user_sessions[user_id].last_active = datetime.now()
-        session = user_sessions[user_id]
-    
-    # 如果是新会话，初始化用户的MCP服务器
-    if is_new_session:
-        await initialize_user_servers(session)
-    
+    # 新会话会初始化用户的MCP服务器，同一用户的并发请求等待同一次初始化
+    session, _ = await session_manager.get_or_create(user_id)
     return session
 
-async def cleanup_inactive_sessions():
-    """定期清理不活跃的用户会话"""
-    while True:
-        await asyncio.sleep(300)  # 每5分钟检查一次
-        current_time = datetime.now()
-        inactive_users = []
-        
-        # 找出不活跃的用户
-        with session_lock:
-            for user_id, session in user_sessions.items():
-                if (current_time - session.last_active) > timedelta(minutes=INACTIVE_TIME):
-                    inactive_users.append(user_id)
-        
-        for user_id in inactive_users:
-            with session_lock:
-                if user_id in user_sessions:
-                    session = user_sessions.pop(user_id)
-                    try:
-                        await session.cleanup()
-                    except Exception as e:
-                        logger.error(f"清理用户 {user_id} 会话失败: {e}")
-        
-        if inactive_users:
-            logger.info(f"已清理 {len(inactive_users)} 个不活跃用户会话")
-
-            
 class Message(BaseModel):
     role: str
     content: str
@@ -274,8 +289,12 @@ class AddMCPServerResponse(BaseModel):
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """服务器启动时执行的任务"""
+    global state_backend
+    state_backend = create_state_backend()
     # 加载持久化的用户MCP配置
     await load_user_mcp_configs()
+    # 加载持久化的工具目录
+    tool_catalog_store.load()
     # 启动其他初始化任务
     await startup_event()
     yield
@@ -284,23 +303,40 @@ async def lifespan(app: FastAPI):
     
 async def startup_event():
     """服务器启动时执行的任务"""
-    # 启动会话清理任务
-    asyncio.create_task(cleanup_inactive_sessions())
+    # 启动会话过期任务
+    session_manager.start()
+    # 为全局MCP服务器预热进程
+    for server_id, config in get_global_server_configs().items():
+        mcp_server_pool.set_warm_pool(config, int(config.get("warm_pool", MCP_WARM_POOL_SIZE)))
+    # 预先创建共享Bedrock客户端并预热TLS连接（BEDROCK_PREWARM_CONNECTIONS>0时）
+    if BEDROCK_PREWARM_CONNECTIONS > 0:
+        global prewarm_future
+        get_chat_client()._get_bedrock_client()
+        prewarm_future = asyncio.get_running_loop().run_in_executor(None, prewarm_connections)
+        prewarm_future.add_done_callback(_log_prewarm_result)
+
+def _log_prewarm_result(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning(f"预热Bedrock连接失败: {future.exception()}")
 
 async def shutdown_event():
     """服务器关闭时执行的任务"""
-    # 保存用户MCP配置
+    # 停止未完成的连接预热，正在建立的连接无法中断，最多等待几秒
+    if prewarm_future is not None and not prewarm_future.done():
+        cancel_prewarm()
+        await asyncio.wait([prewarm_future], timeout=5)
+    # 保存用户MCP配置，关闭存储（SQLite在关闭时checkpoint WAL）
     await save_user_mcp_configs()
+    if config_store is not None:
+        await asyncio.to_thread(config_store.close)
     
     # 清理所有会话
-    cleanup_tasks = []
-    with session_lock:
-        for user_id, session in user_sessions.items():
-            cleanup_tasks.append(session.cleanup())
-    
-    if cleanup_tasks:
-        await asyncio.gather(*cleanup_tasks)
-        logger.info(f"已清理所有 {len(cleanup_tasks)} 个用户会话")
+    await session_manager.close()
+    # 停止剩余的共享MCP服务器进程
+    await mcp_server_pool.shutdown()
+    state_backend.close()
+    # 写出剩余的span
+    tracer.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -343,7 +379,7 @@ async def list_mcp_server(
     session = await get_or_create_user_session(request, auth)
     
     # 合并全局和用户特定的服务器列表
-    server_list = {**shared_mcp_server_list}
+    server_list = {**shared_mcp_server_list, **(await state_backend.items("mcp_server_desc"))}
     
     # 添加用户特有的服务器
     for server_id in session.mcp_clients:
@@ -354,6 +390,69 @@ async def list_mcp_server(
         "server_id": sid, 
         "server_name": name} for sid, name in server_list.items()]})
 
+@app.get("/v1/stats/mcp_pool")
+async def mcp_pool_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    # 只需验证API密钥，返回MCP进程池、预热池和会话的统计
+    await get_api_key(auth)
+    return JSONResponse(content={**mcp_server_pool.stats(), **session_manager.stats()})
+
+@app.get("/v1/stats/bedrock")
+async def bedrock_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    # 每个凭证的请求数、限流次数、学习到的速率和延迟，全局重试额度，以及提示缓存命中
+    await get_api_key(auth)
+    return JSONResponse(content={"credentials": credential_pool.stats(), "throttle": throttle_scheduler.stats(),
+                                 "prompt_cache": prompt_cache_stats.stats(),
+                                 "response_cache": response_cache.stats()})
+
+@app.get("/v1/stats/tools")
+async def tool_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    # 每个服务器/工具的调用延迟直方图和结果（ok/timeout/cancelled），以及工具结果图片的去重情况
+    await get_api_key(auth)
+    return JSONResponse(content={"tools": tool_executor.stats(), "image_blobs": image_blob_store.stats()})
+
+@app.get("/v1/stats/usage")
+async def usage_stats(
+    request: Request,
+    top: int = 20,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    # 按模型汇总的token用量，以及用量最多的用户
+    await get_api_key(auth)
+    return JSONResponse(content=usage_metrics.stats(top=top))
+
+@app.get("/v1/blobs/{blob_id}")
+async def get_blob(
+    blob_id: str,
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """获取工具结果引用的完整内容，支持Range请求"""
+    await get_api_key(auth)
+    user_id = request.headers.get("X-User-ID", auth.credentials)
+    session = session_manager.get(user_id)
+    blob = session.result_blobs.get(blob_id) if session is not None and session.result_blobs is not None else None
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Blob not found or expired")
+    headers = {"Accept-Ranges": "bytes"}
+    try:
+        byte_range = parse_range(request.headers.get("Range"), blob.size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{blob.size}"})
+    if byte_range is None:
+        return Response(content=bytes(blob.data), media_type=blob.mime, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{blob.size}"
+    return Response(content=bytes(blob.data[start:end + 1]), status_code=206, media_type=blob.mime, headers=headers)
+
 @app.post("/v1/add/mcp_server")
 async def add_mcp_server(
     request: Request,
@@ -397,32 +496,31 @@ async def add_mcp_server(
             server_script_args = config_json[server_id]["args"]
             server_script_envs = config_json[server_id].get('env',{})
             
+        # 保存用户服务器配置以便将来恢复
+        server_config = {
+            "command": server_cmd,
+            "args": server_script_args,
+            "env": server_script_envs,
+            "description": server_desc
+        }
         # 连接MCP服务器
-        mcp_client = MCPClient(name=f"{session.user_id}_{server_id}")
+        mcp_client = None
         try:
-            await mcp_client.connect_to_server(
-                command=server_cmd,
-                server_script_args=server_script_args,
-                server_script_envs=server_script_envs
+            mcp_client = mcp_server_pool.lazy(
+                name=f"{session.user_id}_{server_id}",
+                config=server_config,
             )
+            await mcp_client.connect()
             tool_conf = await mcp_client.get_tool_config(server_id=server_id)
             logger.info(f"User {session.user_id} connected to MCP server {server_id}, tools={tool_conf}")
             
-            # 保存用户服务器配置以便将来恢复
-            server_config = {
-                "command": server_cmd,
-                "args": server_script_args,
-                "env": server_script_envs,
-                "description": server_desc
-            }
             save_user_server_config(user_id, server_id, server_config)
             
-            #save conf
-            await save_user_mcp_configs()
-            
         except Exception as e:
             tool_conf = {}
             logger.error(f"User {session.user_id} connect to MCP server {server_id} error: {e}")
+            if mcp_client is not None:
+                await mcp_client.cleanup()
             return JSONResponse(content=AddMCPServerResponse(
                 errno=-1,
                 msg="MCP server connect failed!"
@@ -432,7 +530,7 @@ async def add_mcp_server(
         session.mcp_clients[server_id] = mcp_client
         # 更新全局服务器列表描述
         shared_mcp_server_list[server_id] = server_desc
-        await save_user_mcp_configs()
+        await state_backend.set("mcp_server_desc", server_id, server_desc)
         return JSONResponse(content=AddMCPServerResponse(
             errno=0,
             msg="The server already been added!",
@@ -465,8 +563,7 @@ async def remove_mcp_server(
             del session.mcp_clients[server_id]
             
             # 从用户配置中删除
-            if user_id in user_mcp_server_configs and server_id in user_mcp_server_configs[user_id]:
-                del user_mcp_server_configs[user_id][server_id]
+            delete_user_server_config(user_id, server_id)
             
             return JSONResponse(content=AddMCPServerResponse(
                 errno=0,
@@ -480,8 +577,43 @@ async def remove_mcp_server(
                 msg=f"Failed to remove server: {str(e)}"
             ).model_dump())
 
-async def stream_chat_response(data: ChatCompletionRequest, session: UserSession) -> AsyncGenerator[str, None]:
+async def get_response_cache_key(data: ChatCompletionRequest, session: UserSession,
+                                 system: list, messages: list) -> Optional[str]:
+    """精确匹配响应缓存的key，请求不可缓存时返回None（须在history被修改前计算）"""
+    if not response_cache.eligible(data.temperature, data.extra_params):
+        return None
+    try:
+        tool_config, _ = await session.chat_client.get_tool_config(session.mcp_clients, data.mcp_server_ids)
+    except Exception as e:
+        logger.warning(f"response cache key skipped for user {session.user_id}: {e}")
+        return None
+    # 工具描述相同但配置不同的服务器（如不同用户的目录）结果不同，key中包含服务器配置
+    servers = [(sid, getattr(session.mcp_clients.get(sid), "key", None)) for sid in data.mcp_server_ids or []]
+    return make_cache_key(data.model, system, messages, tool_catalog_version(tool_config["tools"]), {
+        "stream": data.stream,
+        "max_tokens": data.max_tokens,
+        "temperature": data.temperature,
+        "max_turns": MAX_TURNS,
+        "servers": servers,
+        "extra_params": data.extra_params or {},
+    })
+
+def finish_frame(encoder: SSEEncoder, stop_reason: str, message_extras: Optional[dict], usage: UsageTotals) -> str:
+    """结束帧；最后一轮带上整个请求的用量并发送结束标记"""
+    if stop_reason == 'tool_use':
+        return encoder.finish(stop_reason, message_extras)
+    frame = encoder.finish(stop_reason, message_extras, usage.to_openai())
+    if stop_reason == 'end_turn':
+        frame += DONE_FRAME
+    return frame
+
+async def stream_chat_response(data: ChatCompletionRequest, session: UserSession,
+                               request_span: Optional[Span] = None) -> AsyncGenerator[str, None]:
     """为特定用户生成流式聊天响应"""
+    if request_span is None:
+        request_span = tracer.start_span("chat.request", model=data.model, stream=True, user_id=session.user_id)
+    # 生成器在StreamingResponse中执行，在这里把请求span设为当前span
+    request_span.activate()
     messages = [{
         "role": x.role,
         "content": [{"text": x.content}],
@@ -495,13 +627,23 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
     if messages and messages[0]['role'] == 'assistant':
         messages = messages[1:]
 
+    extra_params = data.extra_params or {}
+    encoder = SSEEncoder(
+        data.model,
+        coalesce_ms=extra_params.get("sse_coalesce_ms", SSE_COALESCE_MS),
+        coalesce_bytes=extra_params.get("sse_coalesce_bytes", SSE_COALESCE_BYTES),
+    )
+    usage = UsageTotals()
     try:
-        current_content = ""
         thinking_start = False
         thinking_text_index = 0
-        
+        # message_stop之后才收到该轮的metadata，结束帧等到metadata再发送以带上用量
+        pending_finish = None
+        first_token = True
+
+        cache_key = await get_response_cache_key(data, session, system, messages)
         # 使用用户特定的chat_client和mcp_clients
-        async for response in session.chat_client.process_query_stream(
+        events = session.chat_client.process_query_stream(
                 model_id=data.model,
                 max_tokens=data.max_tokens,
                 temperature=data.temperature,
@@ -511,80 +653,79 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                 mcp_clients=session.mcp_clients,
                 mcp_server_ids=data.mcp_server_ids,
                 extra_params=data.extra_params,
-                ):
-            
-            event_data = {
-                "id": f"chat{time.time_ns()}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": data.model,
-                "choices": [{
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": None
-                }]
-            }
-            
-            # 处理不同的事件类型
-            if response["type"] == "message_start":
-                event_data["choices"][0]["delta"] = {"role": "assistant"}
-            
-            elif response["type"] == "block_delta":
-                if "text" in response["data"]["delta"]:
+                usage=usage,
+                )
+        if cache_key:
+            events = response_cache.wrap(cache_key, events)
+        async for response in events:
+            # 处理不同的事件类型，block_start/block_stop/metadata等空delta事件不发送
+            event_type = response["type"]
+            frame = ""
+            if event_type == "block_delta":
+                delta = response["data"]["delta"]
+                if "text" in delta:
                     text = ""
                     if thinking_text_index >= 1 and thinking_start:    
                         thinking_start = False
                         text = "</thinking>"
-                    text += response["data"]["delta"]["text"]
-                    current_content += text
-                    event_data["choices"][0]["delta"] = {"content": text}
+                    text += delta["text"]
+                    frame = encoder.content(text)
                     thinking_text_index = 0
                     
-                if "reasoningContent" in response["data"]["delta"]:
-                    if 'text' in response["data"]["delta"]["reasoningContent"]:
+                elif "reasoningContent" in delta:
+                    if 'text' in delta["reasoningContent"]:
                         if not thinking_start:
-                            text = "<thinking>" + response["data"]["delta"]["reasoningContent"]["text"]
+                            text = "<thinking>" + delta["reasoningContent"]["text"]
                             thinking_start = True
                         else:
-                            text = response["data"]["delta"]["reasoningContent"]["text"]
-                        event_data["choices"][0]["delta"] = {"content": text}
+                            text = delta["reasoningContent"]["text"]
+                        frame = encoder.content(text)
                         thinking_text_index += 1
+
+            elif event_type == "message_start":
+                frame = encoder.role()
                     
-            elif response["type"] == "message_stop":
-                event_data["choices"][0]["finish_reason"] = response["data"]["stopReason"]
+            elif event_type == "message_stop":
+                message_extras = None
                 if response["data"].get("tool_results"):
-                    event_data["choices"][0]["message_extras"] = {
-                        "tool_use": json.dumps(response["data"]["tool_results"],ensure_ascii=False)
+                    tool_results = response["data"]["tool_results"]
+                    if extra_params.get("tool_result_refs", TOOL_RESULT_REFS):
+                        # 大的文本和图片只发送引用，客户端按需从 /v1/blobs/{id} 获取
+                        tool_results = session.blob_cache().compact(tool_results)
+                    message_extras = {
+                        "tool_use": json.dumps(tool_results,ensure_ascii=False,default=json_default)
                     }
+                pending_finish = (response["data"]["stopReason"], message_extras)
 
-            elif response["type"] == "error":
-                event_data["choices"][0]["finish_reason"] = "error"
-                event_data["choices"][0]["delta"] = {
-                    "content": f"Error: {response['data']['error']}"
-                }
+            elif event_type == "metadata" and pending_finish:
+                frame = finish_frame(encoder, *pending_finish, usage)
+                pending_finish = None
 
-            # 发送事件
-            yield f"data: {json.dumps(event_data)}\n\n"
+            elif event_type == "error":
+                frame = encoder.error(response['data']['error'])
 
-            # 发送结束标记
-            if response["type"] == "message_stop" and response["data"]["stopReason"] == 'end_turn':
-                yield "data: [DONE]\n\n"
+            # 发送事件
+            if frame:
+                if first_token and event_type == "block_delta":
+                    first_token = False
+                    tracer.start_span("time_to_first_token", parent=request_span,
+                                      start_ns=request_span.start_ns).end()
+                    request_span.set(ttft_ms=round(request_span.duration_ms, 1))
+                yield frame
+
+        # 响应缓存回放等没有metadata的情况
+        if pending_finish:
+            yield finish_frame(encoder, *pending_finish, usage)
 
     except Exception as e:
         logger.error(f"Stream error for user {session.user_id}: {e}")
-        error_data = {
-            "id": f"error{time.time_ns()}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": data.model,
-            "choices": [{
-                "index": 0,
-                "delta": {"content": f"Error: {str(e)}"},
-                "finish_reason": "error"
-            }]
-        }
-        yield f"data: {json.dumps(error_data)}\n\n"
-        yield "data: [DONE]\n\n"
+        request_span.record_error(str(e))
+        yield encoder.error(str(e))
+        yield DONE_FRAME
+    finally:
+        usage_metrics.record(session.user_id, data.model, usage)
+        request_span.end(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.output_tokens,
+                         bedrock_calls=usage.calls, frames=encoder.frames)
 
 @app.post("/v1/chat/completions")
 async def chat_completions(
@@ -593,13 +734,24 @@ async def chat_completions(
     background_tasks: BackgroundTasks,
     auth: HTTPAuthorizationCredentials = Security(security)
 ):
+    # 关联ID：优先使用客户端传入的X-Request-ID
+    request_id = request.headers.get("X-Request-ID") or new_id(16)
+    headers = {"X-Request-ID": request_id}
+    request_span = tracer.start_span("chat.request", trace_id=request_id, activate=True,
+                                     model=data.model, stream=bool(data.stream))
     # 获取用户会话
-    session = await get_or_create_user_session(request, auth)
+    try:
+        session = await get_or_create_user_session(request, auth)
+    except Exception as e:
+        request_span.end(error=str(e))
+        raise
+    request_span.set(user_id=session.user_id)
     # 记录会话活动
-    session.last_active = datetime.now()
+    session_manager.touch(session)
 
     if not data.messages:
-        return JSONResponse(content=ChatResponse(
+        request_span.end()
+        return JSONResponse(headers=headers, content=ChatResponse(
             id=f"chat{time.time_ns()}",
             model=data.model,
             created=int(time.time()),
@@ -614,8 +766,9 @@ async def chat_completions(
     # 处理流式请求
     if data.stream:
         return StreamingResponse(
-            stream_chat_response(data, session),
-            media_type="text/event-stream"
+            stream_chat_response(data, session, request_span),
+            media_type="text/event-stream",
+            headers=headers,
         )
 
     # 处理非流式请求
@@ -633,10 +786,13 @@ async def chat_completions(
         system = [{"text":messages[0]['content'][0]["text"]}] if messages[0]['content'][0]["text"] else []
         messages = messages[1:]
 
+    usage = UsageTotals()
     try:
         tool_use_info = {}
+        chat_response = None
         async with session.lock:  # 确保当前用户的请求按顺序处理
-            async for response in session.chat_client.process_query(
+            cache_key = await get_response_cache_key(data, session, system, messages)
+            responses = session.chat_client.process_query(
                     model_id=data.model,
                     max_tokens=data.max_tokens,
                     temperature=data.temperature,
@@ -646,8 +802,13 @@ async def chat_completions(
                     mcp_clients=session.mcp_clients,
                     mcp_server_ids=data.mcp_server_ids,
                     extra_params=data.extra_params,
-                    ):
-                logger.info(f"response body for user {session.user_id}: {response}")
+                    usage=usage,
+                    )
+            if cache_key:
+                responses = response_cache.wrap(cache_key, responses)
+            # 读完整个结果流（最终回答是最后一条），以便记录到响应缓存
+            async for response in responses:
+                log_sampled(logger, "response body for user %s: %s", session.user_id, response)
                 is_tool_use = any([bool(x.get('toolUse')) for x in response['content']])
                 is_tool_result = any([bool(x.get('toolResult')) for x in response['content']])
                 is_answer = any([bool(x.get('text')) for x in response['content']])
@@ -696,17 +857,21 @@ async def chat_completions(
                             "finish_reason": "stop", 
                         }
                     ],
-                    usage={
-                        "prompt_tokens": 0, 
-                        "completion_tokens": 0,
-                        "total_tokens": 0,
-                    }
+                    usage={}
                 )
-                
-                return JSONResponse(content=chat_response.model_dump())
+
+        if chat_response is not None:
+            # 所有轮次（含工具调用轮）的累计用量
+            chat_response.usage = usage.to_openai()
+            return JSONResponse(content=chat_response.model_dump(), headers=headers)
     except Exception as e:
         logger.error(f"Error processing request for user {session.user_id}: {str(e)}")
+        request_span.record_error(str(e))
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        usage_metrics.record(session.user_id, data.model, usage)
+        request_span.end(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.output_tokens,
+                         bedrock_calls=usage.calls)
 
 
 if __name__ == '__main__':
@@ -717,10 +882,38 @@ if __name__ == '__main__':
     parser.add_argument('--mcp-conf', default='', help="the mcp servers json config file")
     parser.add_argument('--user-conf', default='conf/user_mcp_configs.json', 
                        help="用户MCP服务器配置文件路径")
+    parser.add_argument('--workers', type=int, default=1,
+                       help="worker进程数，大于1时由路由进程按X-User-ID一致性哈希分发请求")
+    parser.add_argument('--worker-base-port', type=int, default=0,
+                       help="worker监听的起始端口，默认为port+1")
     args = parser.parse_args()
     
     # 设置用户配置文件路径环境变量
     os.environ['USER_MCP_CONFIG_FILE'] = args.user_conf
+
+    if args.workers > 1:
+        import subprocess
+        # 多worker模式：共享状态和用户配置必须放在所有进程可见的存储中
+        os.environ.setdefault('STATE_BACKEND', 'sqlite')
+        os.environ['USER_MCP_CONFIG_STORE'] = 'sqlite'
+        create_config_store().close()  # 在启动worker前完成一次性的JSON导入
+        base_port = args.worker_base_port or args.port + 1
+        workers = []
+        for i in range(args.workers):
+            cmd = [sys.executable, os.path.abspath(__file__), '--host', '127.0.0.1', '--port', str(base_port + i),
+                   '--user-conf', args.user_conf]
+            if args.mcp_conf:
+                cmd += ['--mcp-conf', args.mcp_conf]
+            workers.append(subprocess.Popen(cmd, env={**os.environ, 'WORKER_ID': str(i)}))
+        try:
+            router = WorkerRouter([('127.0.0.1', base_port + i) for i in range(args.workers)])
+            asyncio.run(router.serve(args.host, args.port))
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+        sys.exit(0)
     
     try:
         loop = asyncio.new_event_loop()
@@ -744,12 +937,7 @@ if __name__ == '__main__':
         loop.run_until_complete(server.serve())
     finally:
         # 确保退出时清理资源并保存用户配置
-        cleanup_tasks = []
-        for user_id, session in user_sessions.items():
-            cleanup_tasks.append(session.cleanup())
-        
-        if cleanup_tasks:
-            loop.run_until_complete(asyncio.gather(*cleanup_tasks))
+        loop.run_until_complete(session_manager.close())
         
         # 保存用户配置
         try:
@@ -16,13 +16,63 @@ from mcp.client.stdio import stdio_client, get_default_environment
 from mcp.types import Resource, Tool, TextContent, ImageContent, EmbeddedResource,CallToolResult,NotificationParams
 from mcp.shared.exceptions import McpError
 from dotenv import load_dotenv
+from tracing import tracer, log_sampled
 
 load_dotenv()  # load environment variables from .env
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 delimiter = "___"
-tool_name_mapping = {}
-tool_name_mapping_r = {}
+TOOLS_LIST_CHANGED = "notifications/tools/list_changed"
+
+class NotifyingClientSession(ClientSession):
+    """ClientSession that forwards server notifications to a callback"""
+
+    def __init__(self, *args, on_notification=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_notification = on_notification
+
+    async def _received_notification(self, notification):
+        await super()._received_notification(notification)
+        if self._on_notification is not None:
+            await self._on_notification(notification)
+
+class ToolNameRegistry:
+    """Bidirectional map between llm tool names and (server_id, MCP tool name).
+
+    One registry is built with each cached tool config (per server id and catalog
+    version); a request merges the registries of its servers, so nothing outlives
+    the catalogs and sessions that use it.
+    """
+    __slots__ = ("_to_mcp", "_to_llm")
+
+    def __init__(self):
+        self._to_mcp = {}
+        self._to_llm = {}
+
+    def add(self, server_id, tool_name, norm=True):
+        tool_name4llm = MCPClient.get_tool_name4llm(server_id, tool_name, norm=norm)
+        self._to_mcp[tool_name4llm] = (server_id, tool_name)
+        self._to_llm[(server_id, tool_name)] = tool_name4llm
+        return tool_name4llm
+
+    def get_tool_name4mcp(self, tool_name4llm):
+        """Convert llm tool call name to (server_id, MCP tool name), ("", "") if unknown"""
+        return self._to_mcp.get(tool_name4llm, ("", ""))
+
+    def get_tool_name4llm(self, server_id, tool_name):
+        return self._to_llm.get((server_id, tool_name), "")
+
+    @classmethod
+    def merge(cls, registries):
+        merged = cls()
+        for registry in registries:
+            merged._to_mcp.update(registry._to_mcp)
+            merged._to_llm.update(registry._to_llm)
+        return merged
+
+    def __len__(self):
+        return len(self._to_mcp)
+
 class MCPClient:
     """Manage MCP sessions.
 
@@ -42,6 +92,13 @@ class MCPClient:
         # self.sessions: Dict[str, Optional[ClientSession]] = {}
         self.session = None
         self.exit_stack = AsyncExitStack()
+        # tool catalog cache, invalidated by notifications/tools/list_changed
+        self.tools = None
+        self.tools_version = 0
+        self._tool_configs = {}
+        self._tools_lock = asyncio.Lock()
+        # called with the tool catalog each time it is fetched from the server
+        self.on_tools_loaded = None
 
     @staticmethod
     def normalize_tool_name( tool_name):
@@ -50,23 +107,9 @@ class MCPClient:
     @staticmethod
     def get_tool_name4llm( server_id, tool_name, norm=True, ns_delimiter=delimiter):
         """Convert MCP server tool name to llm tool call"""
-        global tool_name_mapping, tool_name_mapping_r
         # prepend server prefix namespace to support multi-mcp-server
         tool_key = server_id + ns_delimiter + tool_name
-        tool_name4llm = tool_key if not norm else MCPClient.normalize_tool_name(tool_key)
-        tool_name_mapping[tool_key] = tool_name4llm
-        tool_name_mapping_r[tool_name4llm] = tool_key
-        return tool_name4llm
-    
-    @staticmethod
-    def get_tool_name4mcp( tool_name4llm, ns_delimiter=delimiter):
-        """Convert llm tool call name to MCP server original name"""
-        global  tool_name_mapping_r
-        server_id, tool_name = "", ""
-        tool_name4mcp = tool_name_mapping_r.get(tool_name4llm, "")
-        if len(tool_name4mcp.split(ns_delimiter)) == 2:
-            server_id, tool_name = tool_name4mcp.split(ns_delimiter)
-        return server_id, tool_name
+        return tool_key if not norm else MCPClient.normalize_tool_name(tool_key)
 
     async def disconnect_to_server(self):
         await self.cleanup()
@@ -79,6 +122,50 @@ class MCPClient:
     async def handle_resource_change(params: NotificationParams):
         print(f"资源变更类型: {params['changeType']}")
         print(f"受影响URI: {params['resourceURIs']}")
+
+    async def handle_notification(self, notification):
+        """Drop the cached tool catalog when the server's tool list changes"""
+        if getattr(notification.root, "method", None) == TOOLS_LIST_CHANGED:
+            logger.info(f"\n{self.name} tools list changed, invalidate tool catalog")
+            self.invalidate_tools()
+
+    def invalidate_tools(self):
+        self.tools = None
+        self._tool_configs = {}
+        self.tools_version += 1
+
+    async def list_tools(self):
+        """Cached list_tools, one RPC per catalog version"""
+        if self.tools is None:
+            async with self._tools_lock:
+                if self.tools is None:
+                    version = self.tools_version
+                    response = await self.session.list_tools()
+                    tools = [{
+                        "name": tool.name,
+                        "description": tool.description,
+                        "inputSchema": tool.inputSchema,
+                    } for tool in (response.tools if response else [])]
+                    if self.on_tools_loaded is not None:
+                        self.on_tools_loaded(tools)
+                    # a list_changed notification may arrive while fetching
+                    if version == self.tools_version:
+                        self.tools = tools
+                    return tools
+        return self.tools
+
+    @staticmethod
+    def build_tool_config(server_id, tools):
+        """Build bedrock tool config and its tool name registry from a tool catalog"""
+        tool_names = ToolNameRegistry()
+        return {"tools": [{
+            "toolSpec":{
+                # mcp tool's original name to llm tool name (with server id namespace)
+                "name": tool_names.add(server_id, tool["name"], norm=True),
+                "description": tool["description"],
+                "inputSchema": {"json": tool["inputSchema"]}
+            }
+        } for tool in tools], "tool_names": tool_names}
     
     
     async def connect_to_server(self, server_script_path: str = "", server_script_args: list = [], 
@@ -135,7 +222,8 @@ class MCPClient:
     
         stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
         _stdio, _write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(_stdio, _write))
+        self.session = await self.exit_stack.enter_async_context(
+            NotifyingClientSession(_stdio, _write, on_notification=self.handle_notification))
         # logger.info(f"\n{server_id} set_notification_handler")
         # self.sessions[server_id].set_notification_handler(
         #     "resources/list_changed", 
@@ -147,52 +235,42 @@ class MCPClient:
         
         logger.info(f"\n{self.name} session initialize")
         await self.session.initialize()   
-        try:
- 
-            resource = await self.session.list_resources()
-            logger.info(f"\n{self.name} list_resources:{resource}")
-        except McpError as e:
-            logger.info(f"\n{self.name} list_resources:{str(e)}")
-        # List available tools
-        response = await self.session.list_tools()
-        tools = response.tools
-        logger.info(f"\nConnected to server [{self.name}] with tools: " + str([tool.name for tool in tools]))
+        # List available tools, populate the tool catalog cache
+        tools = await self.list_tools()
+        logger.info(f"\nConnected to server [{self.name}] with tools: " + str([tool["name"] for tool in tools]))
 
     async def get_tool_config(self, model_provider='bedrock', server_id : str = ''):
         """Get llm's tool usage config via MCP server"""
-        # list tools via mcp server
-        response = await self.session.list_tools()
-        if not response:
-            return None
+        tool_config = self._tool_configs.get(server_id)
+        if tool_config is not None:
+            return tool_config
+
+        # list tools via mcp server (cached)
+        version = self.tools_version
+        tools = await self.list_tools()
 
         # for bedrock tool config
-        tool_config = {"tools": []}
-        tool_config["tools"].extend([{
-            "toolSpec":{
-                # mcp tool's original name to llm tool name (with server id namespace)
-                "name": MCPClient.get_tool_name4llm(server_id, tool.name, norm=True),
-                "description": tool.description, 
-                "inputSchema": {"json": tool.inputSchema}
-            }
-        } for tool in response.tools])
+        tool_config = MCPClient.build_tool_config(server_id, tools)
+        if version == self.tools_version:
+            self._tool_configs[server_id] = tool_config
 
         return tool_config
 
-    async def call_tool(self, tool_name, tool_args):
-        """Call tool via MCP server"""
-        try:
-            result = await self.session.call_tool(tool_name, tool_args)
+    async def call_tool(self, tool_name, tool_args, conversation_id: str = ''):
+        """Call tool via MCP server (conversation_id is only used by cached pool handles)"""
+        with tracer.span("mcp.call_tool", server=self.name, tool=tool_name) as span:
+            try:
+                result = await self.session.call_tool(tool_name, tool_args)
+            except ValidationError as e:
+                # Extract the actual tool result from the validation error
+                raw_data = e.errors() if hasattr(e, 'errors') else None
+                log_sampled(logger, "raw_data:%s", raw_data)
+                if not raw_data:
+                    # Re-raise the exception if the result cannot be extracted
+                    raise
+                result = CallToolResult.model_validate(raw_data[0]['input'])
+            span.set(is_error=bool(result.isError))
             return result
-        except ValidationError as e:
-            # Extract the actual tool result from the validation error
-            raw_data = e.errors() if hasattr(e, 'errors') else None
-            logger.info(f"raw_data:{raw_data}")
-            if raw_data and len(raw_data) > 0:
-                tool_result = raw_data[0]['input']
-                
-                return CallToolResult.model_validate(tool_result)
-            # Re-raise the exception if the result cannot be extracted
-            raise
 
     async def cleanup(self):
         """Clean up resources"""
@@ -0,0 +1,414 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+MCP server process multiplexer
+
+Identical server configs (command/args/env) share one process, or K replicas, across
+all user sessions. Sessions get a lightweight MCPServerHandle with the MCPClient call
+interface; the process is stopped when the last handle is released.
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+from mcp_client import MCPClient
+from tool_catalog_store import tool_catalog_store
+from tool_result_cache import tool_result_cache, tool_cache_policy, tool_cache_key
+
+logger = logging.getLogger(__name__)
+
+MCP_SHARED_REPLICAS = int(os.environ.get("MCP_SHARED_REPLICAS", 1))
+
+
+def server_config_key(config: dict) -> str:
+    """Stable hash of the parts of a server config that define the process"""
+    canonical = json.dumps({
+        "command": config.get("command", ""),
+        "args": config.get("args", []),
+        "env": config.get("env", {}) or {},
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+class _ServerReplica:
+    """One MCP server process, owned by a dedicated task.
+
+    stdio_client is an anyio context that must be entered and exited by the same task,
+    so connect and cleanup both run inside _run instead of in whichever request task
+    happened to create or release it.
+    """
+
+    def __init__(self, name: str, config: dict):
+        self.client = MCPClient(name=name)
+        self.config = config
+        self.inflight = 0
+        self._stop = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        ready = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(ready))
+        await ready
+
+    async def _run(self, ready: asyncio.Future):
+        try:
+            await self.client.connect_to_server(
+                command=self.config["command"],
+                server_script_args=self.config.get("args", []),
+                server_script_envs=self.config.get("env", {}) or {},
+            )
+        except BaseException as e:
+            try:
+                await self.client.cleanup()
+            except Exception:
+                pass
+            if not ready.done():
+                ready.set_exception(e)
+            return
+        ready.set_result(None)
+        await self._stop.wait()
+        try:
+            await self.client.cleanup()
+        except Exception as e:
+            logger.error(f"{self.client.name} cleanup error: {e}")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            await self._task
+
+
+class _SharedServer:
+    def __init__(self, key: str, name: str, config: dict, replicas: int):
+        self.key = key
+        self.name = name
+        self.config = config
+        self.replicas = [_ServerReplica(f"{name}#{i}", config) for i in range(replicas)]
+        for replica in self.replicas:
+            # 持久化工具目录，供后续会话在未启动服务器时使用
+            replica.client.on_tools_loaded = lambda tools: tool_catalog_store.put(key, tools)
+        self.refcount = 0
+        self.slot = key  # key in MCPServerPool._servers, unique for private servers
+        self.starting: Optional[asyncio.Task] = None
+
+    async def start(self):
+        results = await asyncio.gather(*[r.start() for r in self.replicas], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await self.stop()
+            raise errors[0]
+
+    def pick(self) -> _ServerReplica:
+        # 选择当前并发调用最少的副本
+        return min(self.replicas, key=lambda r: r.inflight)
+
+    async def stop(self):
+        await asyncio.gather(*[r.stop() for r in self.replicas], return_exceptions=True)
+
+
+class MCPServerHandle:
+    """Per-session reference to a (possibly shared) MCP server.
+
+    Exposes the MCPClient methods used by the chat clients; cleanup() only drops this
+    session's reference.
+    """
+
+    def __init__(self, pool: "MCPServerPool", server: _SharedServer, name: str):
+        self._pool = pool
+        self._server = server
+        self.name = name
+        self._released = False
+
+    @property
+    def key(self) -> str:
+        return self._server.key
+
+    async def get_tool_config(self, model_provider='bedrock', server_id: str = ''):
+        return await self._server.pick().client.get_tool_config(model_provider=model_provider, server_id=server_id)
+
+    async def call_tool(self, tool_name, tool_args, conversation_id: str = ''):
+        replica = self._server.pick()
+        replica.inflight += 1
+        try:
+            return await replica.client.call_tool(tool_name, tool_args)
+        finally:
+            replica.inflight -= 1
+
+    async def cleanup(self):
+        if not self._released:
+            self._released = True
+            await self._pool.release(self._server)
+
+    async def disconnect_to_server(self):
+        await self.cleanup()
+
+
+class LazyMCPServerHandle:
+    """Session's entry for an MCP server that is only spawned when needed.
+
+    Tool configs come from the persisted catalog while the server is not running (and
+    start it in the background); the first call_tool, or a catalog miss, waits for it.
+    Once cleaned up the handle is closed and never acquires the server again.
+    """
+    __slots__ = ("_pool", "name", "config", "_key", "_handle", "_connecting", "_closed")
+
+    def __init__(self, pool: "MCPServerPool", name: str, config: dict):
+        self._pool = pool
+        self.name = name
+        self.config = config
+        self._key: Optional[str] = None
+        self._handle: Optional[MCPServerHandle] = None
+        self._connecting: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def key(self) -> str:
+        # 首次使用时才计算，空闲会话不为每个服务器保存一份key
+        if self._key is None:
+            self._key = server_config_key(self.config)
+        return self._key
+
+    @property
+    def connected(self) -> bool:
+        return self._handle is not None
+
+    def _start(self) -> asyncio.Task:
+        if self._closed:
+            # 会话已被淘汰或服务器已被移除，再acquire的引用将无人释放
+            raise RuntimeError(f"MCP server {self.name} handle is closed")
+        if self._connecting is None or (self._connecting.done() and self._handle is None):
+            self._connecting = asyncio.create_task(self._acquire())
+            # background starts may never be awaited, retrieve their exception
+            self._connecting.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return self._connecting
+
+    async def _acquire(self):
+        try:
+            self._handle = await self._pool.acquire(self.name, self.config)
+        except Exception as e:
+            logger.error(f"MCP server {self.name} start failed: {e}")
+            raise
+
+    async def connect(self) -> MCPServerHandle:
+        if self._handle is None:
+            await asyncio.shield(self._start())
+        return self._handle
+
+    async def get_tool_config(self, model_provider='bedrock', server_id: str = ''):
+        if self._handle is None:
+            tools = tool_catalog_store.get(self.key)
+            if tools is not None:
+                self._start()
+                return self._pool.catalog_tool_config(self.key, server_id, tools)
+        handle = await self.connect()
+        return await handle.get_tool_config(model_provider=model_provider, server_id=server_id)
+
+    async def call_tool(self, tool_name, tool_args, conversation_id: str = ''):
+        # 配置了tool_cache的工具先查结果缓存，命中时无需启动服务器
+        policy = tool_cache_policy(self.config, tool_name)
+        if policy is None:
+            handle = await self.connect()
+            return await handle.call_tool(tool_name, tool_args)
+        ttl, scope = policy
+        key = tool_cache_key(self.key, tool_name, tool_args,
+                             conversation_id if scope == "conversation" else '')
+        result = tool_result_cache.get(key)
+        if result is not None:
+            return result
+        handle = await self.connect()
+        start = time.monotonic()
+        result = await handle.call_tool(tool_name, tool_args)
+        tool_result_cache.put(key, result, ttl, time.monotonic() - start)
+        return result
+
+    async def cleanup(self):
+        self._closed = True
+        if self._connecting is not None and not self._connecting.done():
+            try:
+                await self._connecting
+            except Exception:
+                pass
+        if self._handle is not None:
+            handle, self._handle = self._handle, None
+            await handle.cleanup()
+
+    async def disconnect_to_server(self):
+        await self.cleanup()
+
+
+class MCPServerPool:
+    """Reference-counted registry of running MCP server processes.
+
+    Optionally keeps a warm pool of started servers per config (set_warm_pool), handed
+    out on acquire and refilled in the background.
+    """
+
+    def __init__(self, default_replicas: int = 1):
+        self.default_replicas = default_replicas
+        self._servers: Dict[str, _SharedServer] = {}
+        # warm pool: config key -> started servers with no references
+        self._warm: Dict[str, List[_SharedServer]] = {}
+        self._warm_targets: Dict[str, Tuple[dict, int]] = {}
+        self._refilling: Dict[str, asyncio.Task] = {}
+        # config key -> server_id -> (catalog, tool config)，所有会话共享；
+        # 该配置没有运行中或预热的服务器后丢弃
+        self._catalog_configs: Dict[str, Dict[str, Tuple[list, dict]]] = {}
+        self.warm_hits = 0
+        self.warm_misses = 0
+
+    def _new_server(self, key: str, name: str, config: dict, shareable: bool) -> _SharedServer:
+        replicas = max(1, int(config.get("replicas", self.default_replicas))) if shareable else 1
+        server = _SharedServer(key, name, config, replicas)
+        server.starting = asyncio.create_task(server.start())
+        return server
+
+    async def acquire(self, name: str, config: dict, shareable: bool = True) -> MCPServerHandle:
+        """Get a handle to a running server for config, spawning it if needed.
+
+        config may set "shareable": false to always get a private process, and
+        "replicas": K to spread calls over K processes.
+        """
+        shareable = shareable and config.get("shareable", True)
+        key = server_config_key(config)
+        slot = key if shareable else f"private-{uuid.uuid4().hex}"
+        server = self._servers.get(slot)
+        if server is None:
+            server = self._take_warm(key) or self._new_server(key, name, config, shareable)
+            server.slot = slot
+            self._servers[slot] = server
+        server.refcount += 1
+        try:
+            await asyncio.shield(server.starting)
+        except BaseException:
+            if server.starting.done():
+                # 启动失败
+                server.refcount -= 1
+                if self._servers.get(slot) is server:
+                    del self._servers[slot]
+                self._forget_catalog_configs(key)
+            else:
+                # 调用方被取消，启动完成后再释放引用
+                server.starting.add_done_callback(
+                    lambda _: asyncio.ensure_future(self.release(server)))
+            raise
+        logger.info(f"MCP server {name} acquired [{slot}] refcount={server.refcount}")
+        return MCPServerHandle(self, server, name)
+
+    def catalog_tool_config(self, key: str, server_id: str, tools: list) -> dict:
+        """Tool config built from a persisted catalog, shared by every session using it"""
+        configs = self._catalog_configs.setdefault(key, {})
+        cached = configs.get(server_id)
+        if cached is None or cached[0] is not tools:
+            cached = (tools, MCPClient.build_tool_config(server_id, tools))
+            configs[server_id] = cached
+        return cached[1]
+
+    def _forget_catalog_configs(self, key: str):
+        if self._warm.get(key) or any(s.key == key for s in self._servers.values()):
+            return
+        self._catalog_configs.pop(key, None)
+
+    def lazy(self, name: str, config: dict) -> LazyMCPServerHandle:
+        """Handle that spawns (or joins) the server on first use"""
+        return LazyMCPServerHandle(self, name, config)
+
+    async def release(self, server: _SharedServer):
+        server.refcount -= 1
+        if server.refcount > 0:
+            return
+        if self._servers.get(server.slot) is server:
+            del self._servers[server.slot]
+        # 可共享的服务器放回预热池，私有服务器可能带有会话状态，直接停止
+        if server.slot == server.key and self._warm_deficit(server.key) > 0:
+            self._warm.setdefault(server.key, []).append(server)
+            logger.info(f"MCP server {server.name} [{server.key}] has no references, back to warm pool")
+            return
+        logger.info(f"MCP server {server.name} [{server.slot}] has no references, stopping")
+        self._forget_catalog_configs(server.key)
+        await server.stop()
+
+    def set_warm_pool(self, config: dict, size: int):
+        """Keep size started servers ready for config.
+
+        For shareable configs the running shared server counts towards size, so size=1
+        keeps it alive even when no session references it.
+        """
+        key = server_config_key(config)
+        if size <= 0:
+            self._warm_targets.pop(key, None)
+            return
+        self._warm_targets[key] = (config, size)
+        self._schedule_refill(key)
+
+    def _warm_deficit(self, key: str) -> int:
+        if key not in self._warm_targets:
+            return 0
+        _, size = self._warm_targets[key]
+        return size - len(self._warm.get(key, [])) - (1 if key in self._servers else 0)
+
+    def _take_warm(self, key: str) -> Optional[_SharedServer]:
+        if key not in self._warm_targets:
+            return None
+        ready = self._warm.get(key)
+        server = ready.pop() if ready else None
+        if server is not None:
+            self.warm_hits += 1
+        else:
+            self.warm_misses += 1
+        self._schedule_refill(key)
+        return server
+
+    def _schedule_refill(self, key: str):
+        task = self._refilling.get(key)
+        if task is None or task.done():
+            self._refilling[key] = asyncio.create_task(self._refill(key))
+
+    async def _refill(self, key: str):
+        # 让出一次，使触发补充的acquire先登记服务器
+        await asyncio.sleep(0)
+        while self._warm_deficit(key) > 0:
+            config, _ = self._warm_targets[key]
+            server = self._new_server(key, f"warm_{key}", config, shareable=True)
+            server.slot = key
+            try:
+                await server.starting
+            except Exception as e:
+                logger.error(f"Warm pool refill for [{key}] failed: {e}")
+                return
+            if key not in self._warm_targets:
+                await server.stop()
+                return
+            self._warm.setdefault(key, []).append(server)
+            logger.info(f"Warm pool [{key}] ready={len(self._warm[key])}")
+
+    async def shutdown(self):
+        self._warm_targets.clear()
+        for task in self._refilling.values():
+            task.cancel()
+        self._refilling.clear()
+        servers = list(self._servers.values()) + [s for ready in self._warm.values() for s in ready]
+        self._servers.clear()
+        self._warm.clear()
+        self._catalog_configs.clear()
+        await asyncio.gather(*[s.stop() for s in servers], return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "servers": len(self._servers),
+            "processes": sum(len(s.replicas) for s in self._servers.values()),
+            "references": sum(s.refcount for s in self._servers.values()),
+            "warm_ready": sum(len(ready) for ready in self._warm.values()),
+            "warm_hits": self.warm_hits,
+            "warm_misses": self.warm_misses,
+            "catalog_configs": len(self._catalog_configs),
+            **tool_result_cache.stats(),
+        }
+
+
+mcp_server_pool = MCPServerPool(default_replicas=MCP_SHARED_REPLICAS)
@@ -0,0 +1,124 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Bedrock prompt caching for the agent loop
+
+Every turn resends the same system prompt and tool config plus a history prefix that
+only grows. For models that support it, cachePoint blocks are added to the request
+(never to the stored history) after the system prompt, after the tools, and at a
+rolling history checkpoint: the last message of this call and the one of the previous
+call, so each turn reads the prefix the previous turn wrote.
+Cache read/write tokens come from the stream's metadata usage.
+"""
+import os
+import logging
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE", "1") == "1"
+# 支持cachePoint的模型（modelId子串，可用逗号分隔的环境变量覆盖）
+PROMPT_CACHE_MODELS = [m.strip() for m in os.environ.get(
+    "PROMPT_CACHE_MODELS",
+    "anthropic.claude-3-7-sonnet,anthropic.claude-3-5-haiku,anthropic.claude-sonnet-4,anthropic.claude-opus-4,"
+    "amazon.nova-micro,amazon.nova-lite,amazon.nova-pro,amazon.nova-premier").split(",") if m.strip()]
+# Nova只支持在system和messages中缓存，toolConfig中的cachePoint仅Claude支持
+TOOL_CACHE_MODEL_PREFIX = "anthropic.claude"
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def supports_prompt_cache(model_id: str) -> bool:
+    return any(m in model_id for m in PROMPT_CACHE_MODELS)
+
+
+class PromptCacheStats:
+    """Process-wide prompt cache counters"""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def stats(self) -> dict:
+        prompt_tokens = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        return {
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+            "cache_hit_ratio": round(self.cache_read_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+        }
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+class PromptCache:
+    """cachePoint placement and cache usage for one conversation (one process_query call)"""
+    __slots__ = ("enabled", "cache_tools", "_checkpoint", "calls", "input_tokens",
+                 "cache_read_tokens", "cache_write_tokens")
+
+    def __init__(self, model_id: str, enabled: bool = PROMPT_CACHE_ENABLED):
+        self.enabled = enabled and supports_prompt_cache(model_id)
+        self.cache_tools = self.enabled and TOOL_CACHE_MODEL_PREFIX in model_id
+        self._checkpoint = -1  # 上一次调用的历史缓存点位置
+        self.calls = 0
+        self.input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    @staticmethod
+    def _with_cache_point(message: dict) -> dict:
+        return {**message, "content": message["content"] + [CACHE_POINT]}
+
+    def apply(self, request_params: dict) -> dict:
+        """Request params with cachePoints added; the caller's messages are not modified"""
+        if not self.enabled:
+            return request_params
+        params = dict(request_params)
+        if params.get("system"):
+            params["system"] = list(params["system"]) + [CACHE_POINT]
+        tool_config = params.get("toolConfig")
+        if self.cache_tools and tool_config and tool_config.get("tools"):
+            params["toolConfig"] = {**tool_config, "tools": tool_config["tools"] + [CACHE_POINT]}
+
+        messages: List[dict] = params.get("messages") or []
+        last = len(messages) - 1
+        checkpoints = [i for i in (self._checkpoint, last)
+                       if 0 <= i <= last and isinstance(messages[i].get("content"), list)]
+        if checkpoints:
+            messages = list(messages)
+            for i in sorted(set(checkpoints)):
+                messages[i] = self._with_cache_point(messages[i])
+            params["messages"] = messages
+            self._checkpoint = last
+        return params
+
+    def reset_checkpoint(self):
+        """Forget the history checkpoint after earlier messages were rewritten"""
+        self._checkpoint = -1
+
+    def record_usage(self, usage: Dict[str, int]):
+        """Add the usage from a metadata event (or a converse response)"""
+        read = usage.get("cacheReadInputTokens", 0)
+        write = usage.get("cacheWriteInputTokens", 0)
+        self.calls += 1
+        self.input_tokens += usage.get("inputTokens", 0)
+        self.cache_read_tokens += read
+        self.cache_write_tokens += write
+        prompt_cache_stats.calls += 1
+        prompt_cache_stats.input_tokens += usage.get("inputTokens", 0)
+        prompt_cache_stats.cache_read_tokens += read
+        prompt_cache_stats.cache_write_tokens += write
+
+    def usage(self) -> dict:
+        return {
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+        }
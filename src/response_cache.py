@@ -0,0 +1,154 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Exact-match response cache for deterministic chat completions
+
+Keyed on a canonical hash of model, system, messages, tool catalog and inference
+params. The events yielded by process_query_stream / process_query are recorded and
+replayed on a hit, so SSE clients receive the same chunk shape. Entries are evicted by
+LRU, TTL and a total size cap in bytes.
+"""
+import os
+import copy
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional
+from image_blob import ImageBlob
+
+logger = logging.getLogger(__name__)
+
+# 缓存大小上限(MB)，0表示不启用
+RESPONSE_CACHE_MB = float(os.environ.get("RESPONSE_CACHE_MB", 0))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+# 不影响模型输出的参数，不参与缓存key
+_NON_SEMANTIC_PARAMS = {"sse_coalesce_ms", "sse_coalesce_bytes", "response_cache", "tool_result_refs"}
+
+
+def _json_default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return hashlib.sha256(obj).hexdigest()
+    if isinstance(obj, ImageBlob):
+        return obj.base64()
+    return str(obj)
+
+
+def tool_catalog_version(tools: List[dict]) -> str:
+    """Digest of the merged tool specs sent to the model"""
+    return hashlib.sha256(json.dumps(tools, sort_keys=True, default=_json_default).encode("utf-8")).hexdigest()[:16]
+
+
+def make_cache_key(model_id: str, system: list, messages: list, tool_version: str, params: dict) -> str:
+    params = {k: v for k, v in params.items() if k not in _NON_SEMANTIC_PARAMS}
+    canonical = json.dumps([model_id, system, messages, tool_version, params],
+                           sort_keys=True, separators=(",", ":"), default=_json_default)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("events", "size", "expires", "latency")
+
+    def __init__(self, events: list, size: int, expires: float, latency: float):
+        self.events = events
+        self.size = size
+        self.expires = expires
+        self.latency = latency
+
+
+class ResponseCache:
+    """LRU + TTL cache of recorded event streams, bounded by total bytes"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_latency = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def eligible(self, temperature: float, extra_params: Optional[dict]) -> bool:
+        """Opt-in: temperature 0 requests, or extra_params response_cache=true; false always skips"""
+        if not self.enabled:
+            return False
+        flag = (extra_params or {}).get("response_cache")
+        if flag is not None:
+            return bool(flag)
+        return temperature == 0
+
+    def get(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def put(self, key: str, events: list, latency: float):
+        size = len(json.dumps(events, default=_json_default))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(events, size, time.monotonic() + self.ttl, latency)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def wrap(self, key: str, source: AsyncIterator[Dict]) -> AsyncIterator[Dict]:
+        """Replay a cached stream, or pass `source` through and record it.
+
+        Only streams consumed to the end without an error event are stored.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            start = time.monotonic()
+            for event in entry.events:
+                yield event
+            self.saved_latency += max(0.0, entry.latency - (time.monotonic() - start))
+            return
+
+        self.misses += 1
+        start = time.monotonic()
+        recorded = []
+        failed = False
+        async for event in source:
+            # 事件在产出后可能被修改（如message_stop追加tool_results），记录当时的副本
+            recorded.append(copy.deepcopy(event))
+            if isinstance(event, dict) and event.get("type") == "error":
+                failed = True
+            yield event
+        if not failed:
+            self.put(key, recorded, time.monotonic() - start)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "saved_latency_seconds": round(self.saved_latency, 3),
+        }
+
+
+response_cache = ResponseCache(max_bytes=int(RESPONSE_CACHE_MB * 1024 * 1024), ttl=RESPONSE_CACHE_TTL)
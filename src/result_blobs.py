@@ -0,0 +1,129 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Out-of-band tool result payloads for the SSE stream
+
+With extra_params tool_result_refs=true (or TOOL_RESULT_REFS=1), large text blocks and
+images in the message_stop tool results are replaced by references
+
+    {"blob_ref": {"id": ..., "size": ..., "mime": ..., "preview": ...}}
+
+and the payload is kept in a per-session LRU cache (SESSION_BLOB_CACHE_MB), served by
+GET /v1/blobs/{id} with Range support. Images are stored as the ImageBlob's bytes
+(no extra copy) and served raw instead of base64.
+"""
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from image_blob import ImageBlob
+
+logger = logging.getLogger(__name__)
+
+TOOL_RESULT_REFS = os.environ.get("TOOL_RESULT_REFS", "0") == "1"
+TOOL_RESULT_REF_MIN_BYTES = int(os.environ.get("TOOL_RESULT_REF_MIN_BYTES", 2048))  # 小于该大小的内容仍然内联
+TOOL_RESULT_PREVIEW_CHARS = int(os.environ.get("TOOL_RESULT_PREVIEW_CHARS", 200))
+SESSION_BLOB_CACHE_MB = float(os.environ.get("SESSION_BLOB_CACHE_MB", 32))  # 每个会话的缓存上限
+
+
+class _Blob:
+    __slots__ = ("data", "mime", "size")
+
+    def __init__(self, data, mime: str):
+        self.data = data  # bytes或mmap
+        self.mime = mime
+        self.size = len(data)
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """(start, end inclusive) of a single "bytes=" range, None for the whole body.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None  # 不支持的形式按整个内容返回
+    first, _, last = spec.strip().partition("-")
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # 后缀形式：最后N个字节
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        raise ValueError(header)
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class SessionBlobCache:
+    """LRU of one session's tool result payloads, bounded by total bytes"""
+
+    def __init__(self, max_bytes: int = int(SESSION_BLOB_CACHE_MB * 1024 * 1024),
+                 min_bytes: int = TOOL_RESULT_REF_MIN_BYTES):
+        self.max_bytes = max_bytes
+        self.min_bytes = min_bytes
+        self._blobs: "OrderedDict[str, _Blob]" = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def get(self, blob_id: str) -> Optional[_Blob]:
+        blob = self._blobs.get(blob_id)
+        if blob is not None:
+            self._blobs.move_to_end(blob_id)
+        return blob
+
+    def _put(self, blob_id: str, data, mime: str) -> bool:
+        if blob_id in self._blobs:
+            self._blobs.move_to_end(blob_id)
+            return True
+        blob = _Blob(data, mime)
+        if blob.size > self.max_bytes:
+            return False
+        self._blobs[blob_id] = blob
+        self._bytes += blob.size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._blobs.popitem(last=False)
+            self._bytes -= evicted.size
+        return True
+
+    def _ref_block(self, block: dict) -> dict:
+        """Reference for a large text/image block, the block itself otherwise"""
+        if isinstance(block.get("text"), str) and len(block["text"]) * 4 >= self.min_bytes:
+            data = block["text"].encode("utf-8")
+            if len(data) < self.min_bytes:
+                return block
+            blob_id = hashlib.sha256(data).hexdigest()[:32]
+            if self._put(blob_id, data, "text/plain; charset=utf-8"):
+                return {"blob_ref": {"id": blob_id, "size": len(data), "mime": "text/plain; charset=utf-8",
+                                     "preview": block["text"][:TOOL_RESULT_PREVIEW_CHARS]}}
+        image = block.get("image")
+        if image is not None:
+            source = image.get("source", {}).get("base64")
+            if isinstance(source, ImageBlob) and source.size >= self.min_bytes:
+                mime = f"image/{source.format}"
+                blob_id = source.digest[:32]
+                if self._put(blob_id, source.data, mime):
+                    return {"blob_ref": {"id": blob_id, "size": source.size, "mime": mime, "preview": None}}
+        return block
+
+    def compact(self, tool_results: List[dict]) -> List[dict]:
+        """Copy of the [toolUse, toolResult, ...] list with large result blocks as references"""
+        compacted = []
+        for item in tool_results:
+            if isinstance(item.get("content"), list):
+                item = {**item, "content": [self._ref_block(block) for block in item["content"]]}
+            compacted.append(item)
+        return compacted
+
+    def stats(self) -> dict:
+        return {"blobs": len(self._blobs), "bytes": self._bytes}
@@ -0,0 +1,209 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Asyncio-native user session manager
+
+- sessions in an LRU, capped by session count and by total MCP processes
+- per-user locks sharded over a fixed set of asyncio.Locks
+- inactivity expiry from a deadline heap instead of periodic full scans
+- evicted sessions are cleaned up in background tasks, in parallel
+"""
+import time
+import heapq
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager:
+    """user_id -> session with LRU/process-capped eviction and timer-based expiry.
+
+    create_session(user_id) builds and initializes a session; sessions must expose
+    `last_active` (time.monotonic() of last use) and `async cleanup()`.
+    """
+
+    def __init__(self, create_session: Callable[[str], Awaitable], inactive_seconds: float,
+                 max_sessions: int = 0, max_mcp_processes: int = 0,
+                 process_count: Optional[Callable[[], int]] = None, lock_shards: int = 64):
+        self.create_session = create_session
+        self.inactive_seconds = inactive_seconds
+        self.max_sessions = max_sessions
+        self.max_mcp_processes = max_mcp_processes
+        self.process_count = process_count
+        self._sessions: "OrderedDict[str, object]" = OrderedDict()
+        self._locks = [asyncio.Lock() for _ in range(lock_shards)]
+        self._deadlines: List[Tuple[float, str]] = []  # (expire_at, user_id)
+        # user_id -> 当前有效条目的expire_at；会话被移除或重建后，堆中的旧条目与之不符，出堆时丢弃
+        self._scheduled: Dict[str, float] = {}
+        self._deadline_changed = asyncio.Event()
+        self._expiry_task: Optional[asyncio.Task] = None
+        self._enforce_task: Optional[asyncio.Task] = None
+        self._cleanup_tasks = set()
+        self._unfreeable_processes = 0  # 淘汰会话也无法释放的进程数（共享/常驻进程）
+        self.evicted = 0
+        self.expired = 0
+
+    def _lock_for(self, user_id: str) -> asyncio.Lock:
+        return self._locks[hash(user_id) % len(self._locks)]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def sessions(self) -> Dict[str, object]:
+        return dict(self._sessions)
+
+    def get(self, user_id: str):
+        return self._sessions.get(user_id)
+
+    def touch(self, session):
+        session.last_active = time.monotonic()
+        if self._sessions.get(session.user_id) is session:
+            self._sessions.move_to_end(session.user_id)
+
+    async def get_or_create(self, user_id: str):
+        """Return (session, is_new); concurrent first requests of a user share one init"""
+        session = self._sessions.get(user_id)
+        if session is None:
+            async with self._lock_for(user_id):
+                session = self._sessions.get(user_id)
+                if session is None:
+                    session = await self.create_session(user_id)
+                    self._sessions[user_id] = session
+                    self.touch(session)
+                    self._push_deadline(session)
+                    self._schedule_enforce()
+                    return session, True
+        self.touch(session)
+        return session, False
+
+    async def remove(self, user_id: str):
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            self._scheduled.pop(user_id, None)
+            await session.cleanup()
+
+    # ---- expiry ----
+    def _push_deadline(self, session):
+        expire_at = session.last_active + self.inactive_seconds
+        self._scheduled[session.user_id] = expire_at
+        heapq.heappush(self._deadlines, (expire_at, session.user_id))
+        if self._deadlines[0] == (expire_at, session.user_id):
+            self._deadline_changed.set()
+
+    async def _expiry_loop(self):
+        while True:
+            now = time.monotonic()
+            expired = []
+            while self._deadlines and self._deadlines[0][0] <= now:
+                expire_at, user_id = heapq.heappop(self._deadlines)
+                if self._scheduled.get(user_id) != expire_at:
+                    continue  # 过期的旧条目
+                session = self._sessions.get(user_id)
+                if session is None:
+                    del self._scheduled[user_id]
+                    continue
+                if session.last_active + self.inactive_seconds > now:
+                    # 期间有活动，按新的截止时间重新入堆
+                    self._push_deadline(session)
+                    continue
+                expired.append(user_id)
+            if expired:
+                self.expired += len(expired)
+                self._evict(expired)
+                logger.info(f"已清理 {len(expired)} 个不活跃用户会话")
+
+            self._deadline_changed.clear()
+            timeout = self._deadlines[0][0] - time.monotonic() if self._deadlines else None
+            try:
+                await asyncio.wait_for(self._deadline_changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    # ---- capacity ----
+    def _over_sessions(self) -> bool:
+        return bool(self.max_sessions) and len(self._sessions) > self.max_sessions
+
+    def _over_processes(self) -> bool:
+        if not (self.max_mcp_processes and self.process_count):
+            return False
+        count = self.process_count()
+        if count <= self.max_mcp_processes:
+            self._unfreeable_processes = 0
+            return False
+        return count > self._unfreeable_processes
+
+    def _over_capacity(self) -> bool:
+        return len(self._sessions) > 1 and (self._over_sessions() or self._over_processes())
+
+    def _schedule_enforce(self):
+        if self._over_capacity() and (self._enforce_task is None or self._enforce_task.done()):
+            self._enforce_task = asyncio.create_task(self._enforce_capacity())
+
+    async def _enforce_capacity(self):
+        while self._over_capacity():
+            user_id = next(iter(self._sessions))  # least recently used
+            over_sessions = self._over_sessions()
+            before = self.process_count() if self.process_count else 0
+            self.evicted += 1
+            logger.info(f"会话数量或MCP进程数超出上限，淘汰用户 {user_id} 的会话")
+            # 进程数在清理完成后才会下降，等待这一批完成再重新检查
+            await asyncio.gather(*self._evict([user_id]))
+            if over_sessions or not self.process_count:
+                continue
+            after = self.process_count()
+            if after >= before:
+                # 剩下的进程属于共享/常驻服务器，继续淘汰会话也释放不了，记下后停止
+                self._unfreeable_processes = after
+                logger.warning(f"MCP进程数 {after} 超出上限 {self.max_mcp_processes}，"
+                               f"但淘汰会话无法释放这些进程，停止淘汰")
+                return
+            self._unfreeable_processes = 0
+
+    def _evict(self, user_ids: List[str]) -> List[asyncio.Task]:
+        """Drop sessions and clean them up concurrently in the background"""
+        tasks = []
+        for user_id in user_ids:
+            session = self._sessions.pop(user_id, None)
+            if session is None:
+                continue
+            self._scheduled.pop(user_id, None)
+            task = asyncio.create_task(self._cleanup(user_id, session))
+            self._cleanup_tasks.add(task)
+            task.add_done_callback(self._cleanup_tasks.discard)
+            tasks.append(task)
+        return tasks
+
+    async def _cleanup(self, user_id, session):
+        try:
+            await session.cleanup()
+        except Exception as e:
+            logger.error(f"清理用户 {user_id} 会话失败: {e}")
+
+    # ---- lifecycle ----
+    def start(self):
+        if self._expiry_task is None:
+            self._expiry_task = asyncio.create_task(self._expiry_loop())
+
+    async def close(self):
+        """Stop expiry and clean up every session"""
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+        tasks = self._evict(list(self._sessions.keys()))
+        tasks += list(self._cleanup_tasks)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info(f"已清理所有 {len(tasks)} 个用户会话")
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "cleanups_pending": len(self._cleanup_tasks),
+        }
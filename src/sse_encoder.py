@@ -0,0 +1,89 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Low-overhead SSE encoder for chat.completion.chunk frames
+
+The envelope (id, created, model) is serialized once per stream; each frame only
+encodes its delta. Consecutive text deltas can be coalesced by size and/or time.
+"""
+import json
+import time
+
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    _dumps = json.dumps
+
+DONE_FRAME = "data: [DONE]\n\n"
+
+
+class SSEEncoder:
+    """Encode stream events into OpenAI-style SSE chunks.
+
+    coalesce_ms / coalesce_bytes: buffer text deltas until this much time has passed
+    since the first buffered delta, or this many characters are buffered (0 disables
+    that limit; both 0 sends every delta). The buffer is checked when the next event
+    arrives and always flushed before a non-text frame.
+    """
+    __slots__ = ("_prefix", "coalesce_ms", "coalesce_bytes", "_buffer", "_buffered", "_buffer_since",
+                 "frames", "bytes")
+
+    def __init__(self, model: str, coalesce_ms: float = 0, coalesce_bytes: int = 0):
+        self._prefix = ('data: {"id": "chat%d", "object": "chat.completion.chunk", "created": %d, '
+                        '"model": %s, "choices": [{"index": 0, "delta": ') % (
+                            time.time_ns(), int(time.time()), _dumps(model))
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_bytes = coalesce_bytes
+        self._buffer = []
+        self._buffered = 0
+        self._buffer_since = 0.0
+        self.frames = 0
+        self.bytes = 0
+
+    def _frame(self, delta_json: str, finish_reason=None, extras_json: str = "", tail_json: str = "") -> str:
+        frame = "%s%s, \"finish_reason\": %s%s}]%s}\n\n" % (
+            self._prefix, delta_json, _dumps(finish_reason), extras_json, tail_json)
+        self.frames += 1
+        self.bytes += len(frame)
+        return frame
+
+    def flush(self) -> str:
+        """Frame for buffered text deltas, '' if nothing is buffered"""
+        if not self._buffer:
+            return ""
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        return self._frame('{"content": %s}' % _dumps(text))
+
+    def role(self) -> str:
+        return self.flush() + self._frame('{"role": "assistant"}')
+
+    def content(self, text: str) -> str:
+        """Frame(s) for a text delta, '' while it is being coalesced"""
+        if not text:
+            return ""
+        if not (self.coalesce_ms or self.coalesce_bytes):
+            return self._frame('{"content": %s}' % _dumps(text))
+        if not self._buffer:
+            self._buffer_since = time.monotonic()
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if (self.coalesce_bytes and self._buffered >= self.coalesce_bytes) or \
+                (self.coalesce_ms and (time.monotonic() - self._buffer_since) * 1000 >= self.coalesce_ms):
+            return self.flush()
+        return ""
+
+    def finish(self, finish_reason: str, message_extras: dict = None, usage: dict = None) -> str:
+        """Final frame of a turn; usage (OpenAI form) goes next to "choices" like OpenAI's last chunk"""
+        extras_json = ', "message_extras": %s' % _dumps(message_extras) if message_extras else ""
+        tail_json = ', "usage": %s' % _dumps(usage) if usage else ""
+        return self.flush() + self._frame("{}", finish_reason, extras_json, tail_json)
+
+    def error(self, message: str) -> str:
+        return self.flush() + self._frame('{"content": %s}' % _dumps(f"Error: {message}"), "error")
@@ -0,0 +1,132 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Pluggable backend for state shared between API workers
+
+Namespaced key/value store for state every worker must see (shared server
+descriptions, session metadata). Values are JSON. Calls are async and run on a
+single background thread so SQLite I/O stays off the event loop.
+- MemoryStateBackend: single process (default for one worker)
+- SQLiteStateBackend: WAL-mode SQLite file shared by all workers on a host
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(ABC):
+    @abstractmethod
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        """Value of key in namespace, None when missing"""
+
+    @abstractmethod
+    async def set(self, namespace: str, key: str, value: Any):
+        """Store a JSON-serializable value"""
+
+    @abstractmethod
+    async def delete(self, namespace: str, key: str):
+        """Remove key; missing keys are ignored"""
+
+    @abstractmethod
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        """Snapshot of every key and value in namespace"""
+
+    def close(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    def __init__(self):
+        self._data: Dict[str, Dict[str, Any]] = {}
+
+    async def get(self, namespace, key):
+        return self._data.get(namespace, {}).get(key)
+
+    async def set(self, namespace, key, value):
+        self._data.setdefault(namespace, {})[key] = value
+
+    async def delete(self, namespace, key):
+        self._data.get(namespace, {}).pop(key, None)
+
+    async def items(self, namespace):
+        return dict(self._data.get(namespace, {}))
+
+
+class SQLiteStateBackend(StateBackend):
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-backend")
+
+    def _connect(self):
+        if self._conn is None:
+            # 多个worker进程同时写入时等待锁
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                "value TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (namespace, key))")
+        return self._conn
+
+    async def _run(self, func, *args):
+        def _locked():
+            with self._lock:
+                return func(self._connect(), *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _locked)
+
+    async def get(self, namespace, key):
+        def _get(conn):
+            row = conn.execute("SELECT value FROM kv WHERE namespace=? AND key=?", (namespace, key)).fetchone()
+            return json.loads(row[0]) if row else None
+        return await self._run(_get)
+
+    async def set(self, namespace, key, value):
+        value = json.dumps(value, ensure_ascii=False)
+
+        def _set(conn):
+            with conn:
+                conn.execute(
+                    "INSERT INTO kv (namespace, key, value, updated) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET value=excluded.value, updated=excluded.updated",
+                    (namespace, key, value, time.time()))
+        await self._run(_set)
+
+    async def delete(self, namespace, key):
+        def _delete(conn):
+            with conn:
+                conn.execute("DELETE FROM kv WHERE namespace=? AND key=?", (namespace, key))
+        await self._run(_delete)
+
+    async def items(self, namespace):
+        def _items(conn):
+            rows = conn.execute("SELECT key, value FROM kv WHERE namespace=?", (namespace,)).fetchall()
+            return {key: json.loads(value) for key, value in rows}
+        return await self._run(_items)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def create_state_backend() -> StateBackend:
+    """Backend selected by STATE_BACKEND (memory|sqlite)"""
+    backend = os.environ.get("STATE_BACKEND", "memory")
+    if backend == "sqlite":
+        return SQLiteStateBackend(os.environ.get("STATE_BACKEND_DB", "conf/shared_state.db"))
+    return MemoryStateBackend()
@@ -0,0 +1,126 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Process-wide throttling backoff for Bedrock calls
+
+All sessions share one scheduler: backoff grows with the aggregate throttle rate seen
+across the process, and retries are paid from a shared budget so a throttled account
+does not turn into a retry storm.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudgetExhausted(Exception):
+    """Raised when the process-wide retry budget has no tokens left"""
+
+
+class ThrottleScheduler:
+    """Async backoff scheduler with a shared retry budget.
+
+    - throttle rate: throttles / calls over a sliding window, across all sessions
+    - backoff: base_delay * 2**(attempt + pressure), pressure derived from throttle rate
+    - retry budget: token bucket refilled by successful calls and a small time-based floor
+    """
+
+    def __init__(self, base_delay=2.0, max_delay=60.0, window=60.0,
+                 max_pressure=4, budget_capacity=100.0, budget_ratio=0.2, budget_min_rate=1.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.max_pressure = max_pressure
+        self.budget_capacity = budget_capacity
+        self.budget_ratio = budget_ratio  # 每次成功调用返还的重试额度
+        self.budget_min_rate = budget_min_rate  # 每秒最少补充的重试额度
+        self._budget = budget_capacity
+        self._budget_ts = time.monotonic()
+        self._calls = deque()  # (timestamp, throttled)
+        self._throttled_in_window = 0
+        self.total_calls = 0
+        self.total_throttles = 0
+        self.total_retries = 0
+        self.total_rejected = 0
+
+    def _trim(self, now):
+        cutoff = now - self.window
+        while self._calls and self._calls[0][0] < cutoff:
+            _, throttled = self._calls.popleft()
+            if throttled:
+                self._throttled_in_window -= 1
+
+    def _record(self, throttled):
+        now = time.monotonic()
+        self._trim(now)
+        self._calls.append((now, throttled))
+        self.total_calls += 1
+        if throttled:
+            self._throttled_in_window += 1
+            self.total_throttles += 1
+
+    def record_success(self):
+        self._record(False)
+        self._budget = min(self.budget_capacity, self._budget + self.budget_ratio)
+
+    def record_throttle(self):
+        self._record(True)
+
+    def throttle_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self._calls:
+            return 0.0
+        return self._throttled_in_window / len(self._calls)
+
+    def acquire_retry(self) -> bool:
+        """Take one token from the shared retry budget"""
+        now = time.monotonic()
+        self._budget = min(self.budget_capacity,
+                           self._budget + (now - self._budget_ts) * self.budget_min_rate)
+        self._budget_ts = now
+        if self._budget < 1:
+            self.total_rejected += 1
+            return False
+        self._budget -= 1
+        self.total_retries += 1
+        return True
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Delay before the next retry, scaled by this request's attempt and global pressure"""
+        pressure = round(self.throttle_rate() * self.max_pressure)
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt + pressure)))
+        # equal jitter，避免所有会话同时重试
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def wait(self, attempt: int) -> float:
+        """Wait for a retry slot without blocking the event loop"""
+        if not self.acquire_retry():
+            raise RetryBudgetExhausted("Retry budget exhausted. Service is still throttling requests.")
+        delay = self.backoff_delay(attempt)
+        logger.warning(f"Throttling exception encountered. Retrying in {delay:.2f} seconds "
+                       f"(attempt {attempt+1}, throttle rate {self.throttle_rate():.2f})")
+        await asyncio.sleep(delay)
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            "throttle_rate": self.throttle_rate(),
+            "retry_budget": self._budget,
+            "total_calls": self.total_calls,
+            "total_throttles": self.total_throttles,
+            "total_retries": self.total_retries,
+            "total_rejected": self.total_rejected,
+        }
+
+
+throttle_scheduler = ThrottleScheduler(
+    base_delay=float(os.environ.get("BEDROCK_RETRY_BASE_DELAY", 2)),
+    max_delay=float(os.environ.get("BEDROCK_RETRY_MAX_DELAY", 60)),
+    budget_capacity=float(os.environ.get("BEDROCK_RETRY_BUDGET", 100)),
+)
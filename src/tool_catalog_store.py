@@ -0,0 +1,75 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Persisted MCP tool catalogs
+
+Tool catalogs fetched from running servers are saved by server config key, so a new
+session can build its tool config without spawning the server first.
+"""
+import os
+import json
+import asyncio
+import logging
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ToolCatalogStore:
+    """server config key -> tool catalog, backed by a JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._catalogs: Dict[str, List[dict]] = {}
+        self._write_lock = threading.Lock()
+        self._seq = 0
+        self._written_seq = 0
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    self._catalogs = json.load(f)
+                logger.info(f"已加载 {len(self._catalogs)} 个MCP服务器的工具目录")
+        except Exception as e:
+            logger.error(f"加载工具目录失败: {e}")
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        return self._catalogs.get(key)
+
+    def put(self, key: str, tools: List[dict]):
+        if self._catalogs.get(key) == tools:
+            return
+        self._catalogs[key] = tools
+        self._seq += 1
+        snapshot = json.dumps(self._catalogs, ensure_ascii=False)
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write, self._seq, snapshot)
+        except RuntimeError:
+            self._write(self._seq, snapshot)
+
+    def _write(self, seq: int, snapshot: str):
+        with self._write_lock:
+            # a newer snapshot has already been written
+            if seq <= self._written_seq:
+                return
+            self._written_seq = seq
+            tmp_path = None
+            try:
+                # 每个进程用自己的临时文件，多worker同时保存时不会截断或替换彼此的临时文件
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".",
+                                                prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+                with os.fdopen(fd, 'w') as f:
+                    f.write(snapshot)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.error(f"保存工具目录失败: {e}")
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+tool_catalog_store = ToolCatalogStore(os.environ.get("TOOL_CATALOG_FILE", "conf/tool_catalogs.json"))
@@ -0,0 +1,198 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Bounded, timed and cancellable tool execution for the agent loop
+
+Tool calls of one turn run concurrently (streaming dispatches each call as soon as its
+toolUse block is complete and joins them at message_stop), but:
+- each MCP server has a process-wide concurrency limit (config "max_concurrency")
+- each call has a deadline (config "tool_timeout", per tool "tool_timeouts")
+- the whole turn has a deadline; calls still running then are cancelled
+A timed-out or cancelled call comes back as an error toolResult so the model can
+continue. Latency histograms are kept per server/tool.
+"""
+import os
+import time
+import bisect
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOOL_MAX_CONCURRENCY = int(os.environ.get("TOOL_MAX_CONCURRENCY", 8))  # 每个MCP服务器同时执行的工具调用数
+TOOL_CALL_TIMEOUT = float(os.environ.get("TOOL_CALL_TIMEOUT", 120))  # 单个工具调用超时(秒)
+TOOL_TURN_TIMEOUT = float(os.environ.get("TOOL_TURN_TIMEOUT", 300))  # 一轮所有工具调用的超时(秒)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "total", "max", "outcomes")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.outcomes: Dict[str, int] = {}
+
+    def observe(self, seconds: float, outcome: str):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def to_dict(self) -> dict:
+        buckets = {f"le_{b}": c for b, c in zip(LATENCY_BUCKETS, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 4) if self.count else 0.0,
+            "max": round(self.max, 4),
+            "outcomes": dict(self.outcomes),
+            "buckets": buckets,
+        }
+
+
+class ToolExecutor:
+    """Run one turn's tool calls under concurrency limits and deadlines"""
+
+    def __init__(self, max_concurrency: int = TOOL_MAX_CONCURRENCY,
+                 tool_timeout: float = TOOL_CALL_TIMEOUT, turn_timeout: float = TOOL_TURN_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.tool_timeout = tool_timeout
+        self.turn_timeout = turn_timeout
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._histograms: Dict[str, LatencyHistogram] = {}
+
+    def _semaphore(self, key: str, config: dict) -> asyncio.Semaphore:
+        # 按服务器配置共享：多个会话共用同一个MCP进程时一起受限
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(int(config.get("max_concurrency", self.max_concurrency)))
+            self._semaphores[key] = semaphore
+        return semaphore
+
+    def _timeout(self, config: dict, tool_name: str) -> float:
+        return float(config.get("tool_timeouts", {}).get(tool_name, config.get("tool_timeout", self.tool_timeout)))
+
+    def _observe(self, server_id: str, tool_name: str, seconds: float, outcome: str):
+        name = f"{server_id}/{tool_name}"
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        histogram.observe(seconds, outcome)
+
+    async def _run_one(self, tool: dict, execute, on_error, resolve, mcp_clients):
+        try:
+            server_id, tool_name = resolve(tool)
+        except Exception:
+            server_id, tool_name = '', tool.get('name', '')
+        client = (mcp_clients or {}).get(server_id)
+        config = getattr(client, "config", None) or {}
+        timeout = self._timeout(config, tool_name)
+        start = None
+        try:
+            async with self._semaphore(getattr(client, "key", None) or server_id, config):
+                start = time.monotonic()
+                result = await asyncio.wait_for(execute(tool), timeout)
+            self._observe(server_id, tool_name, time.monotonic() - start, "ok")
+            return result
+        except asyncio.TimeoutError:
+            self._observe(server_id, tool_name, time.monotonic() - start, "timeout")
+            logger.warning(f"工具调用超时 {server_id}/{tool_name} ({timeout:g}s)")
+            return on_error(tool, f"{tool.get('name')} tool call timed out after {timeout:g}s")
+        except asyncio.CancelledError:
+            if start is not None:
+                self._observe(server_id, tool_name, time.monotonic() - start, "cancelled")
+            raise
+        except Exception:
+            if start is not None:
+                self._observe(server_id, tool_name, time.monotonic() - start, "error")
+            raise
+
+    def batch(self, execute: Callable[[dict], "asyncio.Future"],
+              on_error: Callable[[dict, str], object],
+              resolve: Callable[[dict], Tuple[str, str]],
+              mcp_clients: Optional[dict] = None,
+              turn_timeout: Optional[float] = None) -> "ToolBatch":
+        """Batch for one turn: dispatch() calls as they become known, join() the results.
+
+        execute(tool) runs the call; on_error(tool, message) builds the result for
+        calls that time out, are cancelled at the turn deadline or raise;
+        resolve(tool) -> (server_id, mcp tool name) selects the server's limits.
+        """
+        return ToolBatch(self, execute, on_error, resolve, mcp_clients, turn_timeout or self.turn_timeout)
+
+    async def run(self, tool_calls: List[dict], execute, on_error, resolve,
+                  mcp_clients: Optional[dict] = None, turn_timeout: Optional[float] = None) -> list:
+        """Run all tool_calls now, results in tool_calls order (see batch())"""
+        return await self.batch(execute, on_error, resolve, mcp_clients, turn_timeout).join(tool_calls)
+
+    def stats(self) -> dict:
+        return {name: histogram.to_dict() for name, histogram in sorted(self._histograms.items())}
+
+
+class ToolBatch:
+    """Tool calls of one turn; the turn deadline starts at the first dispatch"""
+
+    def __init__(self, executor: ToolExecutor, execute, on_error, resolve, mcp_clients, turn_timeout: float):
+        self._executor = executor
+        self._execute = execute
+        self._on_error = on_error
+        self._resolve = resolve
+        self._mcp_clients = mcp_clients
+        self.turn_timeout = turn_timeout
+        self._tasks: Dict[int, asyncio.Task] = {}  # id(tool) -> task
+        self._started: Optional[float] = None
+
+    def dispatch(self, tool: dict):
+        """Start a call now (no-op if this tool was already dispatched)"""
+        if id(tool) in self._tasks:
+            return
+        if self._started is None:
+            self._started = time.monotonic()
+        self._tasks[id(tool)] = asyncio.create_task(self._executor._run_one(
+            tool, self._execute, self._on_error, self._resolve, self._mcp_clients))
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    async def join(self, tool_calls: List[dict]) -> list:
+        """Dispatch any remaining calls and wait for all, results in tool_calls order"""
+        for tool in tool_calls:
+            self.dispatch(tool)
+        tasks = [self._tasks[id(tool)] for tool in tool_calls]
+        remaining = max(0.0, self.turn_timeout - (time.monotonic() - self._started)) if tasks else 0
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=remaining) if tasks else (set(), set())
+        except asyncio.CancelledError:
+            # 请求被取消（如客户端断开），同时取消所有工具调用
+            self.cancel()
+            raise
+        if pending:
+            logger.warning(f"{len(pending)} 个工具调用超过本轮时限 {self.turn_timeout:g}s，已取消")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        results = []
+        for tool, task in zip(tool_calls, tasks):
+            if task in pending or task.cancelled():
+                results.append(self._on_error(tool, f"{tool.get('name')} tool call cancelled: "
+                                                    f"turn deadline of {self.turn_timeout:g}s exceeded"))
+            elif task.exception() is not None:
+                results.append(self._on_error(tool, f"{tool.get('name')} tool call is failed. error:{task.exception()}"))
+            else:
+                results.append(task.result())
+        self._tasks.clear()
+        self._started = None
+        return results
+
+
+tool_executor = ToolExecutor()
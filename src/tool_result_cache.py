@@ -0,0 +1,130 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Memoization of idempotent MCP tool calls
+
+Opt-in per server in config.json, e.g.
+
+    "local_fs": {
+        "command": "npx", "args": [...],
+        "tool_cache": {
+            "ttl": 60,
+            "tools": {"read_file": {}, "list_directory": {"ttl": 10}, "search_files": {"scope": "conversation"}}
+        }
+    }
+
+"tools" may use "*" for every tool. Results are keyed on (server config hash, tool
+name, canonical args); "shared" entries are reused across conversations and users,
+"conversation" entries only within one process_query call (default for servers with
+"shareable": false). Error results are never cached. Entries are evicted by LRU, TTL
+and a total size cap.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOOL_CACHE_MB = float(os.environ.get("TOOL_CACHE_MB", 64))
+DEFAULT_TOOL_CACHE_TTL = 300.0
+
+
+def tool_cache_policy(config: dict, tool_name: str) -> Optional[Tuple[float, str]]:
+    """(ttl, scope) for this tool, None when it is not cached"""
+    cache_conf = config.get("tool_cache")
+    if not cache_conf:
+        return None
+    tools = cache_conf.get("tools", {})
+    if isinstance(tools, list):
+        tools = {name: {} for name in tools}
+    tool_conf = tools.get(tool_name, tools.get("*"))
+    if tool_conf is None or tool_conf is False:
+        return None
+    if not isinstance(tool_conf, dict):
+        tool_conf = {}
+    ttl = float(tool_conf.get("ttl", cache_conf.get("ttl", DEFAULT_TOOL_CACHE_TTL)))
+    default_scope = "shared" if config.get("shareable", True) else "conversation"
+    scope = tool_conf.get("scope", cache_conf.get("scope", default_scope))
+    return ttl, scope
+
+
+def tool_cache_key(server_key: str, tool_name: str, tool_args: dict, conversation_id: str = '') -> str:
+    canonical = json.dumps([server_key, tool_name, tool_args or {}, conversation_id],
+                           sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("result", "size", "expires", "latency")
+
+    def __init__(self, result, size: int, expires: float, latency: float):
+        self.result = result
+        self.size = size
+        self.expires = expires
+        self.latency = latency
+
+
+class ToolResultCache:
+    """LRU + TTL cache of CallToolResult objects, bounded by total bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_latency = 0.0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_latency += entry.latency
+        return entry.result
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def put(self, key: str, result, ttl: float, latency: float):
+        if getattr(result, "isError", False) or ttl <= 0:
+            return
+        size = len(result.model_dump_json()) if hasattr(result, "model_dump_json") else len(str(result))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(result, size, time.monotonic() + ttl, latency)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "tool_cache_entries": len(self._entries),
+            "tool_cache_bytes": self._bytes,
+            "tool_cache_hits": self.hits,
+            "tool_cache_misses": self.misses,
+            "tool_cache_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "tool_cache_evictions": self.evictions,
+            "tool_cache_saved_seconds": round(self.saved_latency, 3),
+        }
+
+
+tool_result_cache = ToolResultCache(max_bytes=int(TOOL_CACHE_MB * 1024 * 1024))
@@ -0,0 +1,300 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Lightweight tracing for requests, agent turns, Bedrock calls and MCP tool calls
+
+Spans carry a trace id (the request's correlation id, taken from the X-Request-ID
+header when given) and are handed to a pluggable exporter:
+- TRACE_EXPORTER=jsonl (default): one JSON line per finished span in TRACE_FILE,
+  written by a background thread; the file is rotated at TRACE_FILE_MAX_MB, keeping
+  TRACE_FILE_BACKUPS older files. Workers started with --workers N write TRACE_FILE
+  with a .worker<WORKER_ID> suffix
+- TRACE_EXPORTER=otlp: OpenTelemetry OTLP/HTTP (needs opentelemetry-sdk and
+  opentelemetry-exporter-otlp-proto-http; endpoint from the standard OTEL_* env vars)
+- TRACE_EXPORTER=none: spans are dropped
+The current span is kept in a contextvar, so tasks created under a span (tool calls)
+become its children.
+
+log_sampled() is for verbose per-event logs: only LOG_SAMPLE_RATE of the calls are
+formatted and written.
+"""
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "jsonl")
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join(os.environ.get("LOG_DIR", "./logs"), "traces.jsonl"))
+if "WORKER_ID" in os.environ:
+    # 多worker模式下每个worker写自己的文件，避免交错写入和互相轮转
+    _root, _ext = os.path.splitext(TRACE_FILE)
+    TRACE_FILE = f"{_root}.worker{os.environ['WORKER_ID']}{_ext}"
+TRACE_FILE_MAX_MB = float(os.environ.get("TRACE_FILE_MAX_MB", 100))  # 超过该大小时轮转，0表示不轮转
+TRACE_FILE_BACKUPS = int(os.environ.get("TRACE_FILE_BACKUPS", 3))  # 保留的历史文件数
+TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "mcp-on-bedrock")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))  # 逐事件详细日志的采样率
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def new_id(nbytes: int = 8) -> str:
+    return os.urandom(nbytes).hex()
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent", "start_ns", "end_ns", "attributes", "status",
+                 "_tracer", "_handle")
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent: Optional["Span"],
+                 start_ns: int, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent = parent
+        self.start_ns = start_ns
+        self.end_ns = 0
+        self.attributes = attributes
+        self.status = "ok"
+        self._tracer = tracer
+        self._handle = None  # 导出器自己的span对象（OTLP）
+
+    @property
+    def ended(self) -> bool:
+        return self.end_ns != 0
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_error(self, message: str):
+        self.status = "error"
+        self.attributes["error"] = message
+
+    def activate(self):
+        """Make this the current span (parent of spans started afterwards in this context)"""
+        _current_span.set(self)
+        return self
+
+    def end(self, error: Optional[str] = None, **attributes):
+        """End the span once; later calls are ignored"""
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        if attributes:
+            self.attributes.update(attributes)
+        if error is not None:
+            self.record_error(error)
+        # 不用token.reset：span可能跨越异步生成器的yield，结束时所在的上下文不一定相同
+        if _current_span.get() is self:
+            _current_span.set(self.parent)
+        self._tracer._exporter.on_end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class SpanExporter:
+    """Exporter interface; the default drops spans"""
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class JsonlSpanExporter(SpanExporter):
+    """Append finished spans to a JSONL file from a background thread, rotating it by size"""
+
+    def __init__(self, path: str, max_bytes: int = int(TRACE_FILE_MAX_MB * 1024 * 1024),
+                 backups: int = TRACE_FILE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: "queue.SimpleQueue[Optional[dict]]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span: Span):
+        # 请求路径上只入队，序列化和写文件在后台线程
+        self._queue.put(span.to_dict())
+
+    def _rotate(self):
+        """traces.jsonl -> traces.jsonl.1 -> ... -> traces.jsonl.N (the oldest is dropped)"""
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _run(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = open(self.path, "a", encoding="utf-8")
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                while not self._queue.empty() and len(batch) < 1000:
+                    batch.append(self._queue.get())
+                stop = None in batch
+                lines = [json.dumps(x, ensure_ascii=False, default=str) for x in batch if x is not None]
+                if lines:
+                    f.write("\n".join(lines) + "\n")
+                    f.flush()
+                    if self.max_bytes and f.tell() >= self.max_bytes:
+                        f.close()
+                        try:
+                            self._rotate()
+                        except OSError as e:
+                            logger.warning(f"轮转trace文件失败: {e}")
+                        f = open(self.path, "a", encoding="utf-8")
+                if stop:
+                    return
+        finally:
+            f.close()
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class OtlpSpanExporter(SpanExporter):
+    """Mirror spans into OpenTelemetry and export them with OTLP/HTTP"""
+
+    def __init__(self, service_name: str):
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        self._trace = trace
+        self._provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self._tracer = self._provider.get_tracer(__name__)
+
+    def on_start(self, span: Span):
+        context = None
+        if span.parent is not None and span.parent._handle is not None:
+            context = self._trace.set_span_in_context(span.parent._handle)
+        span._handle = self._tracer.start_span(span.name, context=context, start_time=span.start_ns,
+                                               attributes={"correlation_id": span.trace_id})
+
+    def on_end(self, span: Span):
+        handle = span._handle
+        if handle is None:
+            return
+        for key, value in span.attributes.items():
+            if value is not None:
+                handle.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        if span.status == "error":
+            handle.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.attributes.get("error")))
+        handle.end(end_time=span.end_ns)
+        span._handle = None
+
+    def shutdown(self):
+        self._provider.shutdown()
+
+
+def create_exporter(kind: str = TRACE_EXPORTER) -> SpanExporter:
+    if kind == "otlp":
+        try:
+            return OtlpSpanExporter(TRACE_SERVICE_NAME)
+        except ImportError as e:
+            logger.warning(f"OTLP导出需要opentelemetry-sdk和opentelemetry-exporter-otlp，改用JSONL: {e}")
+            return JsonlSpanExporter(TRACE_FILE)
+    if kind == "jsonl":
+        return JsonlSpanExporter(TRACE_FILE)
+    return SpanExporter()
+
+
+class Tracer:
+    def __init__(self, exporter: Optional[SpanExporter] = None):
+        self._exporter = exporter
+
+    @property
+    def exporter(self) -> SpanExporter:
+        # 首次使用时才创建，避免仅import模块就启动后台线程
+        if self._exporter is None:
+            self._exporter = create_exporter()
+        return self._exporter
+
+    def start_span(self, name: str, parent: Optional[Span] = None, trace_id: Optional[str] = None,
+                   start_ns: Optional[int] = None, activate: bool = False, **attributes) -> Span:
+        """Start a span; parent defaults to the current span, trace_id to the parent's (or a new id)"""
+        exporter = self.exporter
+        if parent is None:
+            parent = _current_span.get()
+        if trace_id is None:
+            trace_id = parent.trace_id if parent is not None else new_id(16)
+        span = Span(self, name, trace_id, parent, start_ns or time.time_ns(), attributes)
+        exporter.on_start(span)
+        if activate:
+            span.activate()
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Current span for the duration of the block; exceptions are recorded as errors"""
+        span = self.start_span(name, activate=True, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.end()
+
+    def shutdown(self):
+        if self._exporter is not None:
+            self._exporter.shutdown()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def correlation_id() -> str:
+    span = _current_span.get()
+    return span.trace_id if span is not None else "-"
+
+
+def log_sampled(log: logging.Logger, msg: str, *args, rate: Optional[float] = None):
+    """Log a verbose message for a sample of calls; args are only formatted when it is written"""
+    if random.random() >= (LOG_SAMPLE_RATE if rate is None else rate):
+        return
+    if log.isEnabledFor(logging.INFO):
+        log.info("[%s] " + msg, correlation_id(), *args)
+
+
+tracer = Tracer()
@@ -0,0 +1,96 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Token usage accounting
+
+UsageTotals sums the usage/metrics of every Bedrock call in one process_query(_stream)
+run; it is returned to the client in OpenAI "usage" form. UsageMetrics keeps
+in-memory per-user/per-model counters for capacity planning.
+"""
+import heapq
+import logging
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UsageTotals:
+    __slots__ = ("calls", "input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens", "latency_ms")
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.latency_ms = 0
+
+    def add(self, usage: Optional[dict], metrics: Optional[dict] = None):
+        """Add the usage/metrics of one converse call or converse_stream metadata event"""
+        usage = usage or {}
+        self.calls += 1
+        self.input_tokens += usage.get("inputTokens", 0)
+        self.output_tokens += usage.get("outputTokens", 0)
+        self.cache_read_tokens += usage.get("cacheReadInputTokens", 0)
+        self.cache_write_tokens += usage.get("cacheWriteInputTokens", 0)
+        self.latency_ms += (metrics or {}).get("latencyMs", 0)
+
+    def merge(self, other: "UsageTotals"):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def prompt_tokens(self) -> int:
+        # Bedrock的inputTokens不含缓存读写的token
+        return self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+    def to_openai(self) -> Dict[str, int]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+            "bedrock_latency_ms": self.latency_ms,
+            "bedrock_calls": self.calls,
+        }
+
+
+class UsageMetrics:
+    """Per (user, model) usage counters"""
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, str], UsageTotals] = {}
+        self.requests = 0
+
+    def record(self, user_id: str, model_id: str, totals: UsageTotals):
+        if not totals.calls:
+            return
+        self.requests += 1
+        counter = self._counters.get((user_id, model_id))
+        if counter is None:
+            counter = self._counters[(user_id, model_id)] = UsageTotals()
+        counter.merge(totals)
+
+    def stats(self, top: int = 20) -> dict:
+        models: Dict[str, UsageTotals] = {}
+        users: Dict[str, UsageTotals] = {}
+        for (user_id, model_id), counter in self._counters.items():
+            models.setdefault(model_id, UsageTotals()).merge(counter)
+            users.setdefault(user_id, UsageTotals()).merge(counter)
+        top_users = heapq.nlargest(top, users.items(), key=lambda item: item[1].total_tokens)
+        return {
+            "requests": self.requests,
+            "users": len(users),
+            "models": {model_id: totals.to_openai() for model_id, totals in models.items()},
+            "top_users": [{"user_id": user_id, **totals.to_openai()} for user_id, totals in top_users],
+        }
+
+
+usage_metrics = UsageMetrics()
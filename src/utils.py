@@ -1,3 +1,7 @@
+from collections import deque
+from typing import List
+
+
 def maybe_filter_to_n_most_recent_images(
     messages: list,
     images_to_keep: int,
@@ -12,33 +16,63 @@ def maybe_filter_to_n_most_recent_images(
     if not images_to_keep :
         return messages
 
-    tool_result_blocks =  [
-            item['toolResult']
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and "toolResult" in item
-        ]
-
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and  "image" in content
-    )
-
-    images_to_remove = total_images - images_to_keep
-    # for better cache behavior, we want to remove in chunks
-    images_to_remove -= images_to_remove % min_removal_threshold
-
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            new_content = []
-            for content in tool_result.get("content", []):
+    tracker = ImageTracker(images_to_keep, min_removal_threshold)
+    for message in messages:
+        tracker.add(message)
+    tracker.evict()
+    return messages
+
+
+class ImageTracker:
+    """
+    Incremental version of maybe_filter_to_n_most_recent_images for one conversation.
+    add() records the tool_result images of each message as it is appended and
+    evict() removes the oldest ones with the same chunking, so a tool turn costs
+    O(new blocks + removed images) instead of a rescan of the whole history.
+    """
+    __slots__ = ("images_to_keep", "min_removal_threshold", "_images")
+
+    def __init__(self, images_to_keep: int, min_removal_threshold: int):
+        self.images_to_keep = images_to_keep
+        self.min_removal_threshold = min_removal_threshold
+        self._images = deque()  # (message, toolResult, image content block)，按出现顺序
+
+    def __len__(self):
+        return len(self._images)
+
+    def add(self, message: dict):
+        if not isinstance(message.get("content"), list):
+            return
+        for item in message["content"]:
+            if not (isinstance(item, dict) and "toolResult" in item):
+                continue
+            tool_result = item["toolResult"]
+            if not isinstance(tool_result.get("content"), list):
+                continue
+            for content in tool_result["content"]:
                 if isinstance(content, dict) and "image" in content:
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
-                new_content.append(content)
-            tool_result["content"] = new_content
\ No newline at end of file
+                    self._images.append((message, tool_result, content))
+
+    def evict(self) -> List[dict]:
+        """Remove all but the newest images_to_keep images (in chunks).
+
+        Returns the messages whose tool results were edited in place, for
+        ContextWindow.invalidate().
+        """
+        if not self.images_to_keep:
+            return []
+        images_to_remove = len(self._images) - self.images_to_keep
+        # for better cache behavior, we want to remove in chunks
+        images_to_remove -= images_to_remove % self.min_removal_threshold
+        if images_to_remove <= 0:
+            return []
+
+        removed = {}  # id(toolResult) -> (toolResult, 要删除的image块id)
+        changed = {}  # id(message) -> message
+        for _ in range(images_to_remove):
+            message, tool_result, content = self._images.popleft()
+            removed.setdefault(id(tool_result), (tool_result, set()))[1].add(id(content))
+            changed[id(message)] = message
+        for tool_result, content_ids in removed.values():
+            tool_result["content"] = [x for x in tool_result["content"] if id(x) not in content_ids]
+        return list(changed.values())
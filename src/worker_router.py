@@ -0,0 +1,106 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Multi-worker front router
+
+Each API worker is a separate process owning its users' sessions and MCP processes.
+The router reads the request headers, picks the worker by consistent hashing on
+X-User-ID (falling back to the Authorization header, like the API does) and pipes the
+connection through unchanged, so SSE streams are forwarded as they are produced.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_SIZE = 64 * 1024
+
+
+class ConsistentHashRing:
+    """Hash ring with virtual nodes; adding a worker only moves ~1/N of the users"""
+
+    def __init__(self, nodes: List[str], vnodes: int = 128):
+        self._ring: List[Tuple[int, str]] = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def get_node(self, key: str) -> str:
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+def _route_key(header_block: bytes) -> str:
+    user_id, auth = "", ""
+    for line in header_block.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"x-user-id":
+            user_id = value.strip().decode("latin-1")
+        elif name == b"authorization":
+            auth = value.strip().decode("latin-1").removeprefix("Bearer ")
+    return user_id or auth
+
+
+def _force_close(header_block: bytes) -> bytes:
+    """One request per upstream connection, so every request is routed by its own user"""
+    lines = [line for line in header_block.split(b"\r\n")
+             if not line.lower().startswith(b"connection:")]
+    return b"\r\n".join(lines + [b"Connection: close"])
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        # 任一方向结束（含客户端断开）即关闭另一端，上游会取消正在进行的流
+        try:
+            writer.close()
+        except Exception:
+            pass
+
+
+class WorkerRouter:
+    def __init__(self, workers: List[Tuple[str, int]]):
+        self.workers = {f"{host}:{port}": (host, port) for host, port in workers}
+        self.ring = ConsistentHashRing(list(self.workers.keys()))
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        try:
+            header_block = await client_reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            client_writer.close()
+            return
+        node = self.ring.get_node(_route_key(header_block[:-4]))
+        host, port = self.workers[node]
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(host, port)
+        except OSError as e:
+            logger.error(f"worker {node} unavailable: {e}")
+            client_writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await client_writer.drain()
+            client_writer.close()
+            return
+        upstream_writer.write(_force_close(header_block[:-4]) + b"\r\n\r\n")
+        await asyncio.gather(_pipe(client_reader, upstream_writer), _pipe(upstream_reader, client_writer))
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_SIZE)
+        logger.info(f"Router listening on {host}:{port}, workers: {list(self.workers.keys())}")
+        async with server:
+            await server.serve_forever()
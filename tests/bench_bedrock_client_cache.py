@@ -0,0 +1,58 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-request Bedrock client overhead: a new boto3 client per call (previous behaviour)
+versus the process-wide client cache. No network calls are made; run with any
+AWS_REGION (defaults to us-east-1).
+
+Usage: python tests/bench_bedrock_client_cache.py [N]
+"""
+import os
+import sys
+import time
+import boto3
+from botocore.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+from bedrock_client_cache import get_bedrock_client
+
+AK, SK = "AKIAEXAMPLEBENCHKEY0", "bench/secret/key/not/used/for/any/calls000"
+
+
+def new_client():
+    return boto3.client(
+        service_name='bedrock-runtime',
+        aws_access_key_id=AK,
+        aws_secret_access_key=SK,
+        region_name=os.environ["AWS_REGION"],
+        config=Config(retries={"max_attempts": 3, "mode": "standard"}, read_timeout=300),
+    )
+
+
+def cached_client():
+    return get_bedrock_client(AK, SK, os.environ["AWS_REGION"])
+
+
+def run(name, factory, n):
+    factory()  # 首次创建（加载服务模型）不计入
+    start = time.perf_counter()
+    for _ in range(n):
+        factory()
+    per_call = (time.perf_counter() - start) / n
+    print(f"{name:<18} {per_call * 1e6:>10.1f} us/request")
+    return per_call
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    before = run("new client", new_client, n)
+    after = run("cached client", cached_client, n * 100)
+    print(f"speedup: {before / after:,.0f}x (plus one TLS handshake saved per request on the new-client path)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/bin/bash
+# Concurrency benchmark for streaming /v1/chat/completions.
+# Usage: bash tests/bench_chat_stream_concurrency.sh [N ...]   (default: 1 2 4 8 16)
+# Each stream uses its own X-User-ID. With a non-blocking stream engine the wall time
+# for N parallel streams stays close to the single-stream time instead of growing ~N x.
+
+BASE_URL=${MCP_BASE_URL:-http://127.0.0.1:7002}
+API_KEY=${API_KEY:-123456}
+MODEL=${MODEL:-us.amazon.nova-lite-v1:0}
+CONCURRENCY=${@:-1 2 4 8 16}
+
+run_stream() {
+  curl -s -N $BASE_URL/v1/chat/completions \
+    -H "Content-Type: application/json" \
+    -H "Authorization: Bearer $API_KEY" \
+    -H "X-User-ID: bench_user_$1" \
+    -d '{
+      "model": "'$MODEL'",
+      "stream": true,
+      "max_tokens": 512,
+      "messages": [
+        {
+          "role": "user",
+          "content": "Write a 300 word story about a lighthouse."
+        }
+      ]
+    }' > /dev/null
+}
+
+max_n=$(echo $CONCURRENCY | tr ' ' '\n' | sort -n | tail -1)
+# warm up: create every user session once so session init is not measured
+for i in $(seq 1 $max_n); do run_stream $i & done
+wait
+
+for n in $CONCURRENCY; do
+  start=$(date +%s.%N)
+  for i in $(seq 1 $n); do run_stream $i & done
+  wait
+  end=$(date +%s.%N)
+  echo "streams=$n wall_time=$(echo "$end - $start" | bc)s"
+done
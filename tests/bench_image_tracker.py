@@ -0,0 +1,135 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Image eviction benchmark for a long screenshot-heavy agent loop.
+
+Builds a history turn by turn (assistant toolUse + user toolResult with text and a
+screenshot, like a browser-automation server) and after each tool turn runs either
+the previous full-history rescan or ImageTracker.add()+evict(). Reports the total
+filtering time and checks that both leave the same history, and that the
+ContextWindow estimate follows the evictions.
+
+Usage: python tests/bench_image_tracker.py [TURNS] [IMAGES_TO_KEEP]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils import ImageTracker
+from context_window import ContextWindow, estimate_message_tokens
+
+SCREENSHOT = b"\x89PNG" + b"\x00" * 2048
+
+
+def legacy_filter(messages, images_to_keep, min_removal_threshold):
+    """Previous maybe_filter_to_n_most_recent_images: rescans every message each turn"""
+    tool_result_blocks = [
+        item['toolResult']
+        for message in messages
+        for item in (message["content"] if isinstance(message["content"], list) else [])
+        if isinstance(item, dict) and "toolResult" in item
+    ]
+    total_images = sum(
+        1
+        for tool_result in tool_result_blocks
+        for content in tool_result.get("content", [])
+        if isinstance(content, dict) and "image" in content
+    )
+    images_to_remove = total_images - images_to_keep
+    images_to_remove -= images_to_remove % min_removal_threshold
+    for tool_result in tool_result_blocks:
+        if isinstance(tool_result.get("content"), list):
+            new_content = []
+            for content in tool_result.get("content", []):
+                if isinstance(content, dict) and "image" in content:
+                    if images_to_remove > 0:
+                        images_to_remove -= 1
+                        continue
+                new_content.append(content)
+            tool_result["content"] = new_content
+
+
+def tool_turn(i):
+    assistant = {"role": "assistant", "content": [
+        {"text": f"Step {i}: clicking the next element."},
+        {"toolUse": {"toolUseId": f"tool{i}", "name": "browser___click", "input": {"selector": f"#item-{i}"}}},
+    ]}
+    result = {"role": "user", "content": [{"toolResult": {"toolUseId": f"tool{i}", "content": [
+        {"text": f"Clicked #item-{i}, page title: Result {i}"},
+        {"image": {"format": "png", "source": {"bytes": SCREENSHOT}}},
+    ]}}]}
+    return assistant, result
+
+
+def run_legacy(turns, keep):
+    messages = [{"role": "user", "content": [{"text": "Walk through the catalogue and report prices."}]}]
+    elapsed = 0.0
+    for i in range(turns):
+        assistant, result = tool_turn(i)
+        messages += [assistant, result]
+        start = time.perf_counter()
+        legacy_filter(messages, keep, keep)
+        elapsed += time.perf_counter() - start
+    return messages, elapsed
+
+
+def run_tracker(turns, keep):
+    messages = [{"role": "user", "content": [{"text": "Walk through the catalogue and report prices."}]}]
+    tracker = ImageTracker(keep, keep)
+    elapsed = 0.0
+    for i in range(turns):
+        assistant, result = tool_turn(i)
+        messages += [assistant, result]
+        start = time.perf_counter()
+        tracker.add(result)
+        tracker.evict()
+        elapsed += time.perf_counter() - start
+    return messages, elapsed
+
+
+def check_context_window(turns, keep):
+    """Evicted screenshots must stop counting in the cached ContextWindow estimate"""
+    messages = [{"role": "user", "content": [{"text": "Walk through the catalogue and report prices."}]}]
+    tracker = ImageTracker(keep, keep)
+    window = ContextWindow()
+    for i in range(turns):
+        assistant, result = tool_turn(i)
+        messages += [assistant, result]
+        window.count(messages)
+        tracker.add(result)
+        window.invalidate(tracker.evict())
+    cached = window.count(messages)
+    fresh = sum(estimate_message_tokens(m) for m in messages)
+    assert cached == fresh, f"stale ContextWindow estimate after eviction: {cached} != {fresh}"
+    return cached
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    keep = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rounds = 20
+
+    legacy_time = tracker_time = 0.0
+    for _ in range(rounds):
+        legacy_messages, elapsed = run_legacy(turns, keep)
+        legacy_time += elapsed
+        tracker_messages, elapsed = run_tracker(turns, keep)
+        tracker_time += elapsed
+    assert legacy_messages == tracker_messages, "tracker and full rescan disagree"
+    images = sum(1 for m in tracker_messages for item in m["content"] if "toolResult" in item
+                 for c in item["toolResult"]["content"] if "image" in c)
+
+    tokens = check_context_window(turns, keep)
+
+    print(f"turns={turns} images_to_keep={keep} images left={images} estimated tokens={tokens}")
+    print(f"full rescan per turn:  {legacy_time / rounds * 1000:8.2f} ms per conversation")
+    print(f"ImageTracker:          {tracker_time / rounds * 1000:8.2f} ms per conversation"
+          f"  ({legacy_time / tracker_time:.0f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+#!/bin/bash
+# MCP process sharing benchmark.
+# Usage: bash tests/bench_mcp_process_sharing.sh [N_USERS]   (default: 50)
+# Creates N user sessions, then reports the number of MCP server processes spawned by
+# the API service and their total RSS. With shared servers the count stays at
+# (global servers x replicas) instead of growing with N_USERS x global servers.
+
+BASE_URL=${MCP_BASE_URL:-http://127.0.0.1:7002}
+PORT=${MCP_SERVICE_PORT:-7002}
+API_KEY=${API_KEY:-123456}
+N_USERS=${1:-50}
+
+report() {
+  server_pid=$(lsof -t -i:$PORT -sTCP:LISTEN | head -1)
+  # all descendants of the API server process
+  ps -e -o pid=,ppid=,rss= | awk -v root=$server_pid '
+    { ppid[$1]=$2; rss[$1]=$3 }
+    END {
+      n=0; total=0
+      for (p in ppid) {
+        q=p
+        while (q in ppid && q!=root && q>1) q=ppid[q]
+        if (q==root && p!=root) { n++; total+=rss[p] }
+      }
+      printf "users=%s mcp_processes=%d mcp_rss=%.1fMB\n", "'$1'", n, total/1024
+    }'
+}
+
+report 0
+for i in $(seq 1 $N_USERS); do
+  curl -s $BASE_URL/v1/list/mcp_server \
+    -H "Authorization: Bearer $API_KEY" \
+    -H "X-User-ID: bench_share_$i" > /dev/null
+  if (( i % 10 == 0 )); then report $i; fi
+done
@@ -0,0 +1,47 @@
+#!/bin/bash
+# Throughput benchmark for the multi-worker mode.
+# Usage: bash tests/bench_multi_worker_throughput.sh [WORKERS ...]   (default: 1 2 4 8)
+# For each worker count, starts src/main.py --workers W on BENCH_PORT, sends REQUESTS
+# streaming chat requests from USERS distinct X-User-IDs with CONCURRENCY in flight,
+# and reports requests per second.
+
+API_KEY=${API_KEY:-123456}
+MODEL=${MODEL:-us.amazon.nova-lite-v1:0}
+BENCH_PORT=${BENCH_PORT:-7102}
+USERS=${USERS:-64}
+REQUESTS=${REQUESTS:-256}
+CONCURRENCY=${CONCURRENCY:-64}
+MCP_CONF=${MCP_CONF:-conf/config.json}
+WORKER_COUNTS=${@:-1 2 4 8}
+
+export API_KEY MODEL BENCH_PORT USERS
+
+run_request() {
+  curl -s -N http://127.0.0.1:$BENCH_PORT/v1/chat/completions \
+    -H "Content-Type: application/json" \
+    -H "Authorization: Bearer $API_KEY" \
+    -H "X-User-ID: bench_worker_user_$(( $1 % USERS ))" \
+    -d '{
+      "model": "'$MODEL'",
+      "stream": true,
+      "max_tokens": 256,
+      "messages": [{"role": "user", "content": "Say hello in five languages."}]
+    }' > /dev/null
+}
+export -f run_request
+
+for w in $WORKER_COUNTS; do
+  python src/main.py --workers $w --port $BENCH_PORT --mcp-conf $MCP_CONF > /tmp/bench_workers_$w.log 2>&1 &
+  router_pid=$!
+  sleep 10
+  # warm up: create every user session
+  seq 0 $(( USERS - 1 )) | xargs -P $CONCURRENCY -I{} bash -c 'run_request {}'
+
+  start=$(date +%s.%N)
+  seq 1 $REQUESTS | xargs -P $CONCURRENCY -I{} bash -c 'run_request {}'
+  end=$(date +%s.%N)
+  echo "workers=$w requests=$REQUESTS rps=$(echo "$REQUESTS / ($end - $start)" | bc -l | cut -c1-6)"
+
+  kill $router_pid
+  wait $router_pid 2>/dev/null
+done
@@ -0,0 +1,84 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Cold-start benchmark for a new session with 1, 5 and 20 MCP servers.
+
+Measures the time until the session's tool config is ready:
+- sequential: connect every server one after another (previous behaviour)
+- parallel:   connect every server concurrently (eager servers)
+- lazy:       tool config from persisted catalogs, servers spawn in the background
+
+Usage: python tests/bench_session_cold_start.py [N ...]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault("TOOL_CATALOG_FILE", os.path.join(tempfile.mkdtemp(), "tool_catalogs.json"))
+
+from mcp_server_pool import MCPServerPool
+from tool_catalog_store import tool_catalog_store
+
+SERVER_COMMAND = os.environ.get("BENCH_MCP_COMMAND", "npx")
+SERVER_ARGS = os.environ.get("BENCH_MCP_ARGS", "-y @modelcontextprotocol/server-filesystem ./docs").split()
+
+
+def server_configs(n):
+    # distinct env per server so the pool does not share them
+    return {f"bench_{i}": {"command": SERVER_COMMAND, "args": SERVER_ARGS, "env": {"BENCH_SERVER_INDEX": str(i)}}
+            for i in range(n)}
+
+
+async def run_sequential(configs):
+    pool = MCPServerPool()
+    start = time.perf_counter()
+    for server_id, config in configs.items():
+        handle = await pool.acquire(server_id, config)
+        await handle.get_tool_config(server_id=server_id)
+    elapsed = time.perf_counter() - start
+    await pool.shutdown()
+    return elapsed
+
+
+async def run_parallel(configs):
+    pool = MCPServerPool()
+    start = time.perf_counter()
+
+    async def connect(server_id, config):
+        handle = await pool.acquire(server_id, config)
+        return await handle.get_tool_config(server_id=server_id)
+    await asyncio.gather(*[connect(server_id, config) for server_id, config in configs.items()])
+    elapsed = time.perf_counter() - start
+    await pool.shutdown()
+    return elapsed
+
+
+async def run_lazy(configs):
+    pool = MCPServerPool()
+    start = time.perf_counter()
+    handles = {server_id: pool.lazy(server_id, config) for server_id, config in configs.items()}
+    await asyncio.gather(*[handle.get_tool_config(server_id=server_id) for server_id, handle in handles.items()])
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*[handle.cleanup() for handle in handles.values()])
+    await pool.shutdown()
+    return elapsed
+
+
+async def main():
+    tool_catalog_store.load()
+    for n in [int(x) for x in sys.argv[1:]] or [1, 5, 20]:
+        configs = server_configs(n)
+        sequential = await run_sequential(configs)
+        # catalogs were persisted by the sequential run
+        parallel = await run_parallel(configs)
+        lazy = await run_lazy(configs)
+        print(f"servers={n:<3} sequential={sequential:.2f}s parallel={parallel:.2f}s lazy={lazy*1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
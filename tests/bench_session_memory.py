@@ -0,0 +1,61 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-idle-session memory budget.
+
+Creates N idle user sessions through the session manager (each with lazy handles for
+the global MCP servers, no process started) and measures traced memory growth with
+tracemalloc. Exits with status 1 if the average per session is above the budget.
+
+Usage: python tests/bench_session_memory.py [N_SESSIONS] [BUDGET_BYTES]
+"""
+import os
+import sys
+import gc
+import asyncio
+import logging
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault("MCP_LAZY_START", "1")
+os.environ.setdefault("MAX_SESSIONS", "0")
+
+import main
+
+GLOBAL_SERVERS = {
+    f"server{i}": {"command": "uvx", "args": [f"mcp-server-{i}"], "env": {}} for i in range(5)
+}
+
+
+async def run(n_sessions, budget):
+    main.global_mcp_server_configs.update(GLOBAL_SERVERS)
+    main.get_chat_client()
+    await main.session_manager.get_or_create("warmup_user")
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    for i in range(n_sessions):
+        await main.session_manager.get_or_create(f"bench_user_{i}")
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_session = (current - baseline) / n_sessions
+    print(f"sessions={n_sessions} global_servers={len(GLOBAL_SERVERS)} "
+          f"total={(current - baseline) / 1024 / 1024:.1f}MB per_session={per_session:.0f}B budget={budget}B")
+    await main.session_manager.close()
+    return per_session <= budget
+
+
+def main_():
+    logging.disable(logging.CRITICAL)
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    budget = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    ok = asyncio.run(run(n_sessions, budget))
+    print("OK" if ok else "OVER BUDGET")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main_()
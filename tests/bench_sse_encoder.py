@@ -0,0 +1,92 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+SSE encoding benchmark for a long streamed answer.
+
+Replays a synthetic converse_stream event sequence (one text block of N token deltas
+plus block_start/block_stop/metadata events) through the previous per-event
+json.dumps encoding and through SSEEncoder with different coalescing settings, and
+reports frames, bytes on the wire and encode throughput.
+
+Usage: python tests/bench_sse_encoder.py [N_DELTAS]
+"""
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sse_encoder import SSEEncoder
+
+MODEL = "us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+
+
+def make_events(n_deltas):
+    events = [{"type": "message_start", "data": {"role": "assistant"}},
+              {"type": "block_start", "data": {"start": {}, "contentBlockIndex": 0}}]
+    words = ["The", " lighthouse", " keeper", " watched", " the", " 海", " storm", " roll", " in", "."]
+    events += [{"type": "block_delta", "data": {"delta": {"text": words[i % len(words)]}, "contentBlockIndex": 0}}
+               for i in range(n_deltas)]
+    events += [{"type": "block_stop", "data": {"contentBlockIndex": 0}},
+               {"type": "message_stop", "data": {"stopReason": "end_turn"}},
+               {"type": "metadata", "data": {"usage": {"inputTokens": 10, "outputTokens": n_deltas}}}]
+    return events
+
+
+def encode_legacy(events):
+    for response in events:
+        event_data = {
+            "id": f"chat{time.time_ns()}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": MODEL,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": None}]
+        }
+        if response["type"] == "message_start":
+            event_data["choices"][0]["delta"] = {"role": "assistant"}
+        elif response["type"] == "block_delta" and "text" in response["data"]["delta"]:
+            event_data["choices"][0]["delta"] = {"content": response["data"]["delta"]["text"]}
+        elif response["type"] == "message_stop":
+            event_data["choices"][0]["finish_reason"] = response["data"]["stopReason"]
+        yield f"data: {json.dumps(event_data)}\n\n"
+
+
+def encode_new(events, coalesce_ms=0, coalesce_bytes=0):
+    encoder = SSEEncoder(MODEL, coalesce_ms=coalesce_ms, coalesce_bytes=coalesce_bytes)
+    for response in events:
+        frame = ""
+        if response["type"] == "message_start":
+            frame = encoder.role()
+        elif response["type"] == "block_delta" and "text" in response["data"]["delta"]:
+            frame = encoder.content(response["data"]["delta"]["text"])
+        elif response["type"] == "message_stop":
+            frame = encoder.finish(response["data"]["stopReason"])
+        if frame:
+            yield frame
+
+
+def run(name, encode, events, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        frames = list(encode(events))
+    elapsed = (time.perf_counter() - start) / repeat
+    n_frames = sum(f.count("data: ") for f in frames)
+    n_bytes = sum(len(f.encode("utf-8")) for f in frames)
+    print(f"{name:<28} frames={n_frames:<6} bytes={n_bytes:<8} encode={elapsed*1000:.2f}ms "
+          f"frames/s={n_frames/elapsed:,.0f} events/s={len(events)/elapsed:,.0f}")
+
+
+def main():
+    n_deltas = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    events = make_events(n_deltas)
+    run("legacy json.dumps", encode_legacy, events)
+    run("SSEEncoder", encode_new, events)
+    run("SSEEncoder coalesce 64B", lambda e: encode_new(e, coalesce_bytes=64), events)
+    run("SSEEncoder coalesce 256B", lambda e: encode_new(e, coalesce_bytes=256), events)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-turn wall time with tool calls dispatched at contentBlockStop versus at message_stop.
+
+Replays a scripted converse_stream turn: N toolUse blocks (input streamed in small
+fragments), each followed by GEN_SECONDS of generation, then trailing text, then a
+final end_turn turn. Every tool takes TOOL_SECONDS. No AWS or MCP process is used.
+
+Usage: python tests/bench_tool_dispatch.py [N_TOOLS] [TOOL_SECONDS] [GEN_SECONDS]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+import chat_client_stream
+import tool_executor
+from chat_client_stream import ChatClientStream
+from mcp_client import MCPClient, ToolNameRegistry
+
+TOOL_NAME = MCPClient.get_tool_name4llm("fake", "lookup", norm=True)
+
+
+class FakeResult:
+    content = []
+
+
+class FakeMCPClient:
+    config = {}
+    key = "fake"
+
+    def __init__(self, tool_seconds):
+        self.tool_seconds = tool_seconds
+
+    async def get_tool_config(self, model_provider='bedrock', server_id=''):
+        names = ToolNameRegistry()
+        names.add(server_id, "lookup")
+        return {"tools": [{"toolSpec": {"name": TOOL_NAME, "description": "lookup",
+                                        "inputSchema": {"json": {"type": "object"}}}}], "tool_names": names}
+
+    async def call_tool(self, tool_name, tool_args, conversation_id=''):
+        await asyncio.sleep(self.tool_seconds)
+        return FakeResult()
+
+
+class LateDispatchBatch(tool_executor.ToolBatch):
+    """Previous behaviour: every call starts only once message_stop arrives"""
+    joining = False
+
+    def dispatch(self, tool):
+        if self.joining:
+            super().dispatch(tool)
+
+    async def join(self, tool_calls):
+        self.joining = True
+        return await super().join(tool_calls)
+
+
+def scripted_turns(n_tools, gen_seconds):
+    tool_turn = [{"messageStart": {"role": "assistant"}}]
+    for i in range(n_tools):
+        tool_turn.append({"contentBlockStart": {"start": {"toolUse": {"toolUseId": f"t{i}", "name": TOOL_NAME}},
+                                                "contentBlockIndex": i}})
+        payload = json.dumps({"query": f"item {i}", "limit": 10})
+        for j in range(0, len(payload), 4):
+            tool_turn.append({"contentBlockDelta": {"delta": {"toolUse": {"input": payload[j:j + 4]}},
+                                                    "contentBlockIndex": i}})
+        tool_turn.append({"contentBlockStop": {"contentBlockIndex": i}})
+        tool_turn.append(("sleep", gen_seconds))
+    tool_turn += [{"contentBlockDelta": {"delta": {"text": "Looking these up."}, "contentBlockIndex": n_tools}},
+                  ("sleep", gen_seconds),
+                  {"messageStop": {"stopReason": "tool_use"}}]
+    final_turn = [{"messageStart": {"role": "assistant"}},
+                  {"contentBlockDelta": {"delta": {"text": "Done."}, "contentBlockIndex": 0}},
+                  {"messageStop": {"stopReason": "end_turn"}}]
+    return [tool_turn, final_turn]
+
+
+async def run(n_tools, tool_seconds, gen_seconds, early_dispatch):
+    turns = iter(scripted_turns(n_tools, gen_seconds))
+
+    async def fake_converse_stream_async(client, **params):
+        return {"stream": next(turns)}
+
+    async def fake_iter_event_stream(stream):
+        for event in stream:
+            if isinstance(event, tuple):
+                await asyncio.sleep(event[1])
+            else:
+                yield event
+
+    chat_client_stream.converse_stream_async = fake_converse_stream_async
+    chat_client_stream.iter_event_stream = fake_iter_event_stream
+    original_batch = tool_executor.ToolBatch
+    if not early_dispatch:
+        tool_executor.ToolBatch = LateDispatchBatch
+    client = ChatClientStream()
+    client._acquire_bedrock_client = lambda: (None, None)
+    start = time.monotonic()
+    tool_results = 0
+    try:
+        async for event in client.process_query_stream(
+                query="look up items", model_id="bench-model", history=[],
+                mcp_clients={"fake": FakeMCPClient(tool_seconds)}, mcp_server_ids=["fake"],
+                extra_params={"prompt_cache": False}):
+            assert event["type"] != "error", event
+            if event["type"] == "message_stop" and "tool_results" in event["data"]:
+                results = event["data"]["tool_results"][1::2]
+                assert not any(r.get("status") == "error" for r in results), results
+                tool_results = len(results)
+    finally:
+        tool_executor.ToolBatch = original_batch
+    assert tool_results == n_tools, tool_results
+    return time.monotonic() - start
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    n_tools = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    tool_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    gen_seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 0.3
+    late = asyncio.run(run(n_tools, tool_seconds, gen_seconds, early_dispatch=False))
+    early = asyncio.run(run(n_tools, tool_seconds, gen_seconds, early_dispatch=True))
+    print(f"tools={n_tools} tool={tool_seconds}s generation/block={gen_seconds}s")
+    print(f"dispatch at message_stop:      {late:.2f}s")
+    print(f"dispatch at contentBlockStop:  {early:.2f}s  ({(late - early) / late * 100:.0f}% lower)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Memory growth of tool configs and tool name registries over 10k sessions.
+
+Every session adds its own server config (like user-added servers) with a persisted
+30-tool catalog, gets its tool config through mcp_server_pool.lazy().get_tool_config(),
+resolves a few tool calls with the merged registry, then cleans the handle up. Process
+start/stop are replaced with no-ops, so only the pool's bookkeeping is measured.
+Traced memory must stay flat instead of growing with the number of sessions.
+
+Usage: python tests/bench_tool_name_registry_memory.py [N_SESSIONS]
+"""
+import os
+import sys
+import gc
+import json
+import asyncio
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault("TOOL_CATALOG_FILE", os.path.join(tempfile.mkdtemp(), "tool_catalogs.json"))
+
+import mcp_server_pool as pool_module
+from mcp_server_pool import mcp_server_pool, server_config_key
+from mcp_client import ToolNameRegistry
+from tool_catalog_store import tool_catalog_store
+
+CATALOG = [{"name": f"tool-{i}", "description": f"tool {i}", "inputSchema": {"type": "object"}}
+           for i in range(30)]
+MAX_GROWTH_KB = 256
+
+
+async def _no_process(self):
+    pass
+
+
+pool_module._SharedServer.start = _no_process
+pool_module._SharedServer.stop = _no_process
+
+
+def server_config(i):
+    return {"command": "npx", "args": ["-y", "@modelcontextprotocol/server-filesystem"],
+            "env": {"USER_ID": str(i)}}
+
+
+def persist_catalogs(n_sessions):
+    catalogs = {server_config_key(server_config(i)): CATALOG for i in range(-1, n_sessions)}
+    with open(tool_catalog_store.path, 'w') as f:
+        json.dump(catalogs, f)
+    tool_catalog_store.load()
+
+
+async def run_session(i):
+    server_id = f"user{i}_fs"
+    handle = mcp_server_pool.lazy(server_id, server_config(i))
+    tool_config = await handle.get_tool_config(server_id=server_id)
+    tool_names = ToolNameRegistry.merge([tool_config["tool_names"]])
+    for spec in tool_config["tools"][:3]:
+        assert tool_names.get_tool_name4mcp(spec["toolSpec"]["name"])[0] == server_id
+    await handle.cleanup()
+
+
+async def main():
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    persist_catalogs(n_sessions)
+    tracemalloc.start()
+    await run_session(-1)
+    gc.collect()
+    baseline, _ = tracemalloc.get_traced_memory()
+    growth = 0
+    for i in range(n_sessions):
+        await run_session(i)
+        if (i + 1) % (n_sessions // 5) == 0:
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            growth = current - baseline
+            print(f"sessions={i+1:<6} growth={growth / 1024:.1f}KB peak={(peak - baseline) / 1024:.1f}KB "
+                  f"pool={mcp_server_pool.stats()['catalog_configs']} catalog configs")
+    assert mcp_server_pool.stats()["catalog_configs"] == 0, "catalog tool configs outlive their sessions"
+    assert growth < MAX_GROWTH_KB * 1024, f"memory grew by {growth / 1024:.1f}KB over {n_sessions} sessions"
+
+
+if __name__ == '__main__':
+    asyncio.run(main())